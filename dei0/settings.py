@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'recipes.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,6 +50,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'recipes.middleware.ReplicaPinMiddleware',
+    'recipes.middleware.BatchLoaderMiddleware',
 ]
 
 ROOT_URLCONF = 'dei0.urls'
@@ -74,17 +78,79 @@ WSGI_APPLICATION = 'dei0.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+def env_flag(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+
+# Connections are kept open and reused across requests for DB_CONN_MAX_AGE
+# seconds (0, the default, closes them after every request; none never does),
+# and checked before reuse when DB_CONN_HEALTH_CHECKS is on. Reuse suits WSGI
+# servers with a fixed number of threads; under ASGI every async request may
+# run on a new thread and leave its connection open, so keep 0 there. Behind pgbouncer in
+# transaction mode set DB_PGBOUNCER: pgbouncer does the pooling, and
+# server-side cursors cannot outlive the transaction that opened them there.
+# The recipes.storage.backends engines record pool statistics, see
+# GET /recipes/db/stats/ and recipes/storage/connection_stats.py.
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',  # Use 'mysql' for MySQL
-        'NAME': 'dei0',
-        'USER': 'dei0admin',
-        'PASSWORD': 'dei0dei0',
-        'HOST': 'localhost',  # Or your database host
-        'PORT': '5432',       # PostgreSQL default port
+        'ENGINE': os.environ.get('DB_ENGINE', 'recipes.storage.backends.postgresql'),
+        'NAME': os.environ.get('DB_NAME', 'dei0'),
+        'USER': os.environ.get('DB_USER', 'dei0admin'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', 'dei0dei0'),
+        'HOST': os.environ.get('DB_HOST', 'localhost'),  # Or your database host
+        'PORT': os.environ.get('DB_PORT', '5432'),       # PostgreSQL default port; pgbouncer listens on 6432
+        'CONN_MAX_AGE': None if os.environ.get('DB_CONN_MAX_AGE') == 'none' else int(os.environ.get('DB_CONN_MAX_AGE', 0)),
+        'CONN_HEALTH_CHECKS': env_flag('DB_CONN_HEALTH_CHECKS', True),
+        'DISABLE_SERVER_SIDE_CURSORS': env_flag('DB_PGBOUNCER', False),
     }
 }
+if DATABASES['default']['ENGINE'].endswith('postgresql'):
+    DATABASES['default']['OPTIONS'] = {'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5))}
+
+# Read replicas
+# Aliases in DATABASES that serve the read use cases (recipes/storage/router.py).
+# Writes, and reads by clients that wrote in the last REPLICA_PIN_SECONDS,
+# stay on 'default'. A replica that fails to connect is skipped for
+# REPLICA_RETRY_SECONDS. dei0/settings_sqlite_replica.py runs this locally.
+
+DATABASE_ROUTERS = ['recipes.storage.router.ReplicaRouter']
+DATABASE_REPLICAS = []
+
+# DB_REPLICA_HOSTS=host1,host2 adds replicas sharing the settings of 'default'
+for number, host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), 1):
+    DATABASES[f'replica{number}'] = dict(DATABASES['default'], HOST=host.strip(), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(f'replica{number}')
+REPLICA_PIN_SECONDS = 5
+REPLICA_RETRY_SECONDS = 30
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Point 'default' at memcached or redis in production so that all workers
+# share the entity cache tier and its invalidations.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Read-through cache of the read use cases (recipes/storage/entity_cache.py)
+RECIPES_CACHE = {
+    'ALIAS': 'default',
+    'LOCAL_MAX_ENTRIES': 1024,
+    'TTL': 300,
+    'NEGATIVE_TTL': 30,
+}
+
+# Metrics
+# Served in Prometheus text format at /metrics (recipes/metrics.py). With
+# several worker processes, point METRICS_DIR at a directory they share and
+# empty it on deploy; each process writes its values there every
+# METRICS_FLUSH_SECONDS and /metrics adds them up.
 
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_SECONDS = 1
 
 
 # Password validation
@@ -0,0 +1,27 @@
+"""
+Two SQLite databases standing in for a primary and a read replica, to try the
+replica routing without PostgreSQL:
+
+    python manage.py migrate --settings=dei0.settings_sqlite_replica
+    python manage.py migrate --database=replica --settings=dei0.settings_sqlite_replica
+    python manage.py test --settings=dei0.settings_sqlite_replica
+
+Nothing replicates between the two files: rows written to the primary only
+show up on the replica if it is copied over.
+"""
+
+from dei0.settings import *  # noqa: F401,F403
+from dei0.settings import BASE_DIR
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'recipes.storage.backends.sqlite3',
+        'NAME': BASE_DIR / 'primary.sqlite3',
+    },
+    'replica': {
+        'ENGINE': 'recipes.storage.backends.sqlite3',
+        'NAME': BASE_DIR / 'replica.sqlite3',
+    },
+}
+
+DATABASE_REPLICAS = ['replica']
@@ -17,7 +17,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from recipes.views import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('recipes/', include('recipes.urls')),  # Include your app's URLs
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -1,13 +1,67 @@
 # core/entities.py
+from decimal import Decimal
+from typing import List, Optional
+
+# Entities are slotted: no per-instance __dict__, which matters when a
+# listing or a stream builds thousands of them.
+
 class Ingredient:
-    def __init__(self, name, description, id):
+    __slots__ = ('id', 'name', 'description')
+
+    def __init__(self, name: str, description: str, id: Optional[int]):
         self.id = id
         self.name = name
         self.description = description
 
+class RecipeLine:
+    # One ingredient line of a recipe: the line id, the ingredient name and the quantity
+    __slots__ = ('id', 'name', 'quantity')
+
+    def __init__(self, name: str, quantity: Decimal, id: Optional[int]):
+        self.id = id
+        self.name = name
+        self.quantity = quantity
+
 class Recipe:
-    def __init__(self, name, ingredients, elaboration, id):
+    __slots__ = ('id', 'name', 'ingredients', 'elaboration')
+
+    def __init__(self, name: str, ingredients: List[RecipeLine], elaboration: str, id: Optional[int]):
         self.id = id
         self.name = name
         self.ingredients = ingredients
         self.elaboration = elaboration
+
+class RecipeSearchResult:
+    __slots__ = ('id', 'name', 'rank')
+
+    def __init__(self, name: str, rank: float, id: int):
+        self.id = id
+        self.name = name
+        self.rank = rank
+
+class PantryMatch:
+    __slots__ = ('id', 'name', 'missing')
+
+    def __init__(self, name: str, missing: List[dict], id: int):
+        self.id = id
+        self.name = name
+        self.missing = missing
+
+class ShoppingListItem:
+    # One ingredient of a meal plan: its total quantity over every recipe and serving
+    __slots__ = ('id', 'name', 'quantity')
+
+    def __init__(self, name: str, quantity: Decimal, id: Optional[int]):
+        self.id = id
+        self.name = name
+        self.quantity = quantity
+
+class IngredientUsage:
+    # How many recipes use an ingredient, and its quantity summed over them
+    __slots__ = ('id', 'name', 'recipes', 'total_quantity')
+
+    def __init__(self, name: str, recipes: int, total_quantity: Decimal, id: int):
+        self.id = id
+        self.name = name
+        self.recipes = recipes
+        self.total_quantity = total_quantity
@@ -0,0 +1,118 @@
+# core/loaders.py
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable
+
+# The loaders of the request being served, set by recipes.middleware.BatchLoaderMiddleware
+_loaders = contextvars.ContextVar('recipes_loaders', default=None)
+
+
+class BatchLoader:
+    """DataLoader-style batching in front of a batch lookup of a repository.
+
+    batch(keys) and abatch(keys) return {key: value} for the keys that exist.
+    Every result, misses included, is memoized for the life of the loader,
+    which is one request (see request_loader). load_many() asks for all the
+    keys not memoized yet in one call. aload() calls made in the same event
+    loop turn, e.g. from asyncio.gather(), are merged into one abatch() call.
+    """
+
+    def __init__(self, batch: Callable[[list], Dict], abatch: Callable[[list], Awaitable[Dict]]):
+        self.batch = batch
+        self.abatch = abatch
+        self._memo = {}
+        self._pending = {}
+        # The event loop only keeps weak references to tasks
+        self._tasks = set()
+
+    def load(self, key: Hashable) -> Any:
+        return self.load_many([key]).get(key)
+
+    def load_many(self, keys: Iterable[Hashable]) -> Dict:
+        keys = list(dict.fromkeys(keys))
+        missing = [key for key in keys if key not in self._memo]
+        if missing:
+            self._remember(missing, self.batch(missing))
+        return self._found(keys)
+
+    async def aload(self, key: Hashable) -> Any:
+        if key in self._memo:
+            return self._memo[key]
+        return await self._enqueue(key)
+
+    async def aload_many(self, keys: Iterable[Hashable]) -> Dict:
+        keys = list(dict.fromkeys(keys))
+        futures = [self._enqueue(key) for key in keys if key not in self._memo]
+        if futures:
+            await asyncio.gather(*futures)
+        return self._found(keys)
+
+    def clear(self):
+        self._memo.clear()
+
+    def _remember(self, keys, found):
+        for key in keys:
+            self._memo[key] = found.get(key)
+
+    def _found(self, keys):
+        return {key: self._memo[key] for key in keys if self._memo.get(key) is not None}
+
+    def _enqueue(self, key):
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._pending[key] = loop.create_future()
+            if len(self._pending) == 1:
+                # Runs once the coroutines that are ready now have queued their keys too
+                loop.call_soon(self._dispatch, loop)
+        return future
+
+    def _dispatch(self, loop):
+        pending, self._pending = self._pending, {}
+        task = loop.create_task(self._adispatch(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _adispatch(self, pending):
+        try:
+            found = await self.abatch(list(pending))
+        except Exception as error:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self._remember(pending, found)
+        for key, future in pending.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+
+def start_request():
+    # Returns the token to pass to finish_request()
+    return _loaders.set({})
+
+
+def finish_request(token):
+    _loaders.reset(token)
+
+
+def request_loader(repository, method: str) -> BatchLoader:
+    """The loader of the current request for repository.method (and its a-prefixed twin).
+
+    Outside a request every call gets a new loader, which batches but does
+    not remember anything.
+    """
+    loaders = _loaders.get()
+    key = (id(repository), method)
+    if loaders is not None and key in loaders:
+        return loaders[key]
+    loader = BatchLoader(getattr(repository, method), getattr(repository, f"a{method}"))
+    if loaders is not None:
+        loaders[key] = loader
+    return loader
+
+
+def clear_request_loaders():
+    # Writes call this so that the rest of the request reads what they wrote
+    for loader in (_loaders.get() or {}).values():
+        loader.clear()
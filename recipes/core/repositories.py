@@ -1,7 +1,84 @@
 # core/repositories.py
-from recipes.core.entities import Ingredient
+from abc import ABC, abstractmethod
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
 
-class IngredientRepository:
-    def get_by_name(self, name):
-        # Define method for retrieving an ingredient by name
-        pass
+from recipes.core.entities import Ingredient, Recipe, RecipeLine, ShoppingListItem
+
+# What the read use cases need from storage. Every lookup is batch-first: it
+# takes a collection of keys and returns {key: entity} for the keys that
+# exist, so n lookups cost one query however they are made. recipes/storage/
+# repositories.py has the Django implementations and in-memory ones for
+# tests. The async methods default to the sync ones, which suits storage that
+# does no I/O.
+
+class IngredientRepository(ABC):
+    @abstractmethod
+    def get_many(self, ids: Iterable[int]) -> Dict[int, Ingredient]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_by_names(self, names: Iterable[str]) -> Dict[str, Ingredient]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def page(self, after: Optional[int] = None, limit: Optional[int] = None) -> List[Ingredient]:
+        # In id order, after the id given (keyset pagination)
+        raise NotImplementedError
+
+    async def aget_many(self, ids: Iterable[int]) -> Dict[int, Ingredient]:
+        return self.get_many(ids)
+
+    async def aget_by_names(self, names: Iterable[str]) -> Dict[str, Ingredient]:
+        return self.get_by_names(names)
+
+    async def apage(self, after: Optional[int] = None, limit: Optional[int] = None) -> List[Ingredient]:
+        return self.page(after, limit)
+
+class RecipeLineRepository(ABC):
+    @abstractmethod
+    def lines_for_recipes(self, recipe_ids: Iterable[int]) -> Dict[int, List[RecipeLine]]:
+        # Lines in line id order; recipes without lines are left out
+        raise NotImplementedError
+
+    @abstractmethod
+    def shopping_list(self, servings: Dict[int, Decimal]) -> List[ShoppingListItem]:
+        # servings: {recipe_id: multiplier}. The exact sum of quantity ×
+        # multiplier over the lines of those recipes, per ingredient, in
+        # ingredient name order
+        raise NotImplementedError
+
+    async def alines_for_recipes(self, recipe_ids: Iterable[int]) -> Dict[int, List[RecipeLine]]:
+        return self.lines_for_recipes(recipe_ids)
+
+    async def ashopping_list(self, servings: Dict[int, Decimal]) -> List[ShoppingListItem]:
+        return self.shopping_list(servings)
+
+class RecipeRepository(ABC):
+    # Recipes come with their lines
+
+    @abstractmethod
+    def get_many(self, ids: Iterable[int]) -> Dict[int, Recipe]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_by_names(self, names: Iterable[str]) -> Dict[str, Recipe]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def page(self, after: Optional[int] = None, limit: Optional[int] = None) -> List[Recipe]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def names_for(self, ids: Iterable[int]) -> Dict[int, str]:
+        # Just the names, without reading the lines
+        raise NotImplementedError
+
+    async def aget_many(self, ids: Iterable[int]) -> Dict[int, Recipe]:
+        return self.get_many(ids)
+
+    async def aget_by_names(self, names: Iterable[str]) -> Dict[str, Recipe]:
+        return self.get_by_names(names)
+
+    async def apage(self, after: Optional[int] = None, limit: Optional[int] = None) -> List[Recipe]:
+        return self.page(after, limit)
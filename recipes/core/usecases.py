@@ -1,6 +1,24 @@
-from recipes.storage.models import IngredientModel, RecipeModel, RecipeIngredientModel
-from recipes.core.entities import Ingredient, Recipe
-from typing import List
+from django.db import connection, transaction
+from django.db.models import Q
+from recipes.storage.models import (IngredientModel, RecipeModel, RecipeIngredientModel, ImportCheckpointModel,
+                                    IngredientUsageModel)
+from recipes.metrics import timed_use_case
+from recipes.core.entities import Ingredient, IngredientUsage, PantryMatch, Recipe, RecipeLine, RecipeSearchResult, ShoppingListItem
+from recipes.core.loaders import BatchLoader, clear_request_loaders, request_loader
+from recipes.core.repositories import IngredientRepository, RecipeLineRepository, RecipeRepository
+from recipes.storage.entity_cache import EntityCache, ingredient_cache, recipe_cache
+from recipes.storage.ingredient_usage import UsageChanges, record_usage
+from recipes.storage.pantry_index import pantry_index
+from recipes.storage.read_model import recipes_using, refresh_documents, save_documents
+from recipes.storage.repositories import (DjangoIngredientRepository, DjangoRecipeLineRepository, DjangoRecipeRepository,
+                                          line_rows, lines_by_recipe)
+from recipes.storage.router import aread_alias, read_alias
+import re
+from decimal import ROUND_HALF_UP, Decimal
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+STREAM_CHUNK_SIZE = 2000
+BULK_BATCH_SIZE = 1000
 
 def create_ingredient(name,description):
     return Ingredient(name,description)
@@ -10,203 +28,717 @@ def create_recipe(name, ingredients, elaboration):
     # Validate data and perform any necessary operations
     return Recipe(name, ingredients, elaboration)
 
+def keyset_page(queryset, after=None, limit=None):
+    # Seek past the last seen id instead of using OFFSET, so every page costs
+    # the same index range scan no matter how deep it is.
+    if after is not None:
+        queryset = queryset.filter(id__gt=after)
+    if limit is not None:
+        queryset = queryset[:limit]
+    return queryset
+
+def invalidate_ingredients(ids=(), names=()):
+    # After commit, so that a concurrent read cannot cache the pre-write row again.
+    # The request's loaders forget at once: the rest of the request reads its writes.
+    clear_request_loaders()
+    ids, names = list(ids), list(names)
+    transaction.on_commit(lambda: ingredient_cache.invalidate(ids=ids, names=names))
+
+def invalidate_recipes(ids=(), names=()):
+    clear_request_loaders()
+    ids, names = list(ids), list(names)
+    transaction.on_commit(lambda: recipe_cache.invalidate(ids=ids, names=names))
+
+def invalidate_recipes_using(ingredient_ids):
+    # Recipe entities embed ingredient names, so ingredient writes reach them too.
+    # Call before deleting ingredients: the delete cascades to the lines.
+    rows = RecipeIngredientModel.objects.filter(
+        ingredient_id__in=ingredient_ids).values_list('recipe_id', 'recipe__name').distinct()
+    invalidate_recipes(ids=[recipe_id for recipe_id, _ in rows], names=[name for _, name in rows])
+
+def to_quantity(value) -> Decimal:
+    # Rounded the way the quantity column stores it
+    return Decimal(str(value)).quantize(Decimal("0.01"))
+
+def resolve_ingredient_names(names) -> dict:
+    # {name: id}: one IN lookup, then one insert for the missing names.
+    # ignore_conflicts lets concurrent writers race on the same new name:
+    # the unique index keeps a single row and the second lookup finds it.
+    names = set(names)
+    ingredient_ids = lookup_ingredient_names(names)
+    missing = names - ingredient_ids.keys()
+    if missing:
+        IngredientModel.objects.bulk_create(
+            [IngredientModel(name=name, description="") for name in missing], ignore_conflicts=True)
+        created = lookup_ingredient_names(missing)
+        invalidate_ingredients(ids=created.values(), names=created.keys())
+        ingredient_ids.update(created)
+    return ingredient_ids
+
+def lookup_ingredient_names(names) -> dict:
+    return dict(IngredientModel.objects.filter(name__in=names).values_list('name', 'id'))
+
+def lock_ingredient_names(ids) -> dict:
+    # {id: name} of the ingredients that exist, read under a row lock held
+    # until commit. Recipe writes take it before they render documents: an
+    # ingredient rename or delete locks the row FOR UPDATE, so it either
+    # waits for the recipe write to commit before it looks for the recipes
+    # to refresh, or commits first and the lock returns the new name.
+    # FOR KEY SHARE on PostgreSQL does not block other recipe writes.
+    ids = sorted(set(ids))
+    if not ids:
+        return {}
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT id, name FROM {IngredientModel._meta.db_table} "
+                           "WHERE id = ANY(%s) ORDER BY id FOR KEY SHARE", [ids])
+            return dict(cursor.fetchall())
+    # In id order, so two writers never wait on each other's rows
+    return dict(IngredientModel.objects.select_for_update().filter(id__in=ids).order_by('id')
+                .values_list('id', 'name'))
+
+# Listing rows: plain values_list() tuples that recipes/serializers.py turns
+# into JSON directly, without model instances or entities in between. A
+# client may ask for a subset of the fields (a subsequence of INGREDIENT_ROW
+# or RECIPE_ROW that starts with 'id'); the other columns are never read and
+# the lines query only runs when 'ingredients' is asked for. Recipe lines are
+# (line id, ingredient name, quantity) tuples.
+INGREDIENT_ROW = ('id', 'name', 'description')
+RECIPE_ROW = ('id', 'name', 'elaboration', 'ingredients')
+
+def ingredient_rows(fields, using):
+    return IngredientModel.objects.using(using).order_by('id').values_list(*fields)
+
+def recipe_rows(fields, using):
+    return (RecipeModel.objects.using(using).order_by('id')
+            .values_list(*[field for field in fields if field != 'ingredients']))
+
+def with_lines(recipe_rows, lines) -> list:
+    grouped = lines_by_recipe(lines)
+    return [(*recipe_row, grouped.get(recipe_row[0], [])) for recipe_row in recipe_rows]
+
+def attach_lines(recipe_rows, fields, using) -> list:
+    # One query for the lines of a whole page of recipes, if they are wanted
+    if 'ingredients' not in fields:
+        return recipe_rows
+    return with_lines(recipe_rows, line_rows([row[0] for row in recipe_rows], using) if recipe_rows else [])
+
+async def aattach_lines(recipe_rows, fields, using) -> list:
+    if 'ingredients' not in fields:
+        return recipe_rows
+    lines = [line async for line in line_rows([row[0] for row in recipe_rows], using)] if recipe_rows else []
+    return with_lines(recipe_rows, lines)
+
+@timed_use_case
 class ReadIngredientUseCase:
+    # Entities come from the repository through the entity cache and the
+    # request's batch loaders: lookups made while serving one request are
+    # merged into IN queries and never repeated.
+
+    def __init__(self, ingredients: IngredientRepository = None, cache: EntityCache = ingredient_cache):
+        self.ingredients = ingredients or DjangoIngredientRepository()
+        self.cache = cache
+
     def get_by_name(self, name) -> Ingredient:
-        try:
-            # Use Django's ORM to retrieve an ingredient by name
-            ingredient_model = IngredientModel.objects.get(name=name)
-
-            # Create an Ingredient entity from the retrieved model data
-            ingredient_entity = Ingredient(
-                id=ingredient_model.id,
-                name=ingredient_model.name,
-                description=ingredient_model.description,
-            )
+        return self.cache.get('name', name, lambda: self._by_name().load(name))
 
-            return ingredient_entity
-        except IngredientModel.DoesNotExist:
-            # If the ingredient does not exist, return None or handle the case as needed
-            return None
-        
     def get_by_id(self, ingredient_id) -> Ingredient:
-        try:
-            # Use Django's ORM to retrieve an ingredient by ID
-            ingredient_model = IngredientModel.objects.get(id=ingredient_id)
-
-            # Create an Ingredient entity from the retrieved model data
-            ingredient_entity = Ingredient(
-                id=ingredient_model.id,
-                name=ingredient_model.name,
-                description=ingredient_model.description,
-            )
+        return self.cache.get('id', ingredient_id, lambda: self._by_id().load(ingredient_id))
 
-            return ingredient_entity
-        except IngredientModel.DoesNotExist:
-            # If the ingredient does not exist, return None or handle the case as needed
-            return None        
-        
-    def get_all(self) -> List[Ingredient]:
-        # Use Django's ORM to retrieve all ingredients
-        ingredient_models = IngredientModel.objects.all().order_by('id')
-
-        # Create a list of Ingredient entities from the retrieved model data
-        ingredient_entities = [
-            Ingredient(
-                name=ingredient_model.name,
-                description=ingredient_model.description,
-                id=ingredient_model.id
-            )
-            for ingredient_model in ingredient_models
-        ]
+    def get_many(self, ids) -> List[Ingredient]:
+        # One entry per id, in order; None for the ids that do not exist.
+        # Whatever the cache does not hold comes from one IN query.
+        return self.cache.get_many('id', ids, self._by_id().load_many)
+
+    def get_all(self, after=None, limit=None) -> List[Ingredient]:
+        # One keyset page at a time, or everything
+        return self.ingredients.page(after, limit)
+
+    def _by_id(self) -> BatchLoader:
+        return request_loader(self.ingredients, 'get_many')
+
+    def _by_name(self) -> BatchLoader:
+        return request_loader(self.ingredients, 'get_by_names')
+
+    # Async versions of the reads above, for the async views served under ASGI
+
+    async def aget_by_name(self, name) -> Ingredient:
+        return await self.cache.aget('name', name, lambda: self._by_name().aload(name))
+
+    async def aget_by_id(self, ingredient_id) -> Ingredient:
+        return await self.cache.aget('id', ingredient_id, lambda: self._by_id().aload(ingredient_id))
 
-        return ingredient_entities
+    async def aget_many(self, ids) -> List[Ingredient]:
+        return await self.cache.aget_many('id', ids, self._by_id().aload_many)
+
+    # Row versions of the listings, for the serializers of the listing endpoints.
+    # Streams are read after the view has returned, so a view passes using,
+    # the database it picked while the request was being served.
+
+    def get_all_rows(self, after=None, limit=None, fields=INGREDIENT_ROW) -> List[tuple]:
+        return list(keyset_page(ingredient_rows(fields, read_alias()), after, limit))
+
+    def iter_rows(self, chunk_size=STREAM_CHUNK_SIZE, fields=INGREDIENT_ROW, using=None) -> Iterator[tuple]:
+        return ingredient_rows(fields, using or read_alias()).iterator(chunk_size=chunk_size)
+
+    async def aget_all_rows(self, after=None, limit=None, fields=INGREDIENT_ROW) -> List[tuple]:
+        return [row async for row in keyset_page(ingredient_rows(fields, await aread_alias()), after, limit)]
+
+    async def aiter_rows(self, chunk_size=STREAM_CHUNK_SIZE, fields=INGREDIENT_ROW,
+                         using=None) -> AsyncIterator[tuple]:
+        # Keyset pages of chunk_size: Django 4.2's aiterator() runs the values_list
+        # query in the event loop, which raises SynchronousOnlyOperation
+        using = using or await aread_alias()
+        after = None
+        while True:
+            rows = [row async for row in keyset_page(ingredient_rows(fields, using), after, chunk_size)]
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][0]
     
+@timed_use_case
+class IngredientUsageUseCase:
+    # Analytics served from the usage summary table: the top ingredients are
+    # an index range scan, the orphans an anti-join on the primary key. No
+    # query groups the lines.
+    ORDERS = {
+        'recipes': ('-recipe_count', 'ingredient_id'),
+        'quantity': ('-total_quantity', 'ingredient_id'),
+    }
+    USAGE_ROW = ('ingredient_id', 'ingredient__name', 'recipe_count', 'total_quantity')
+
+    def top(self, order='recipes', limit=20) -> List[IngredientUsage]:
+        return [self._usage(row) for row in self._top(read_alias(), order, limit)]
+
+    def orphans(self, after=None, limit=20) -> List[Ingredient]:
+        return [Ingredient(name=name, description=description, id=id)
+                for id, name, description in self._orphans(read_alias(), after, limit)]
+
+    def usage(self, ingredient_id) -> Optional[IngredientUsage]:
+        # None if the ingredient does not exist; zeros if no recipe uses it
+        row = self._one(read_alias(), ingredient_id).first()
+        return self._usage(row) if row else None
+
+    async def atop(self, order='recipes', limit=20) -> List[IngredientUsage]:
+        return [self._usage(row) async for row in self._top(await aread_alias(), order, limit)]
+
+    async def aorphans(self, after=None, limit=20) -> List[Ingredient]:
+        return [Ingredient(name=name, description=description, id=id)
+                async for id, name, description in self._orphans(await aread_alias(), after, limit)]
+
+    async def ausage(self, ingredient_id) -> Optional[IngredientUsage]:
+        row = await self._one(await aread_alias(), ingredient_id).afirst()
+        return self._usage(row) if row else None
+
+    def _top(self, using, order, limit):
+        return (IngredientUsageModel.objects.using(using).order_by(*self.ORDERS[order])
+                .values_list(*self.USAGE_ROW)[:limit])
+
+    def _orphans(self, using, after, limit):
+        rows = IngredientModel.objects.using(using).filter(usage__isnull=True).order_by('id')
+        if after is not None:
+            rows = rows.filter(id__gt=after)
+        return rows.values_list(*INGREDIENT_ROW)[:limit]
+
+    def _one(self, using, ingredient_id):
+        # The ingredient LEFT JOIN its usage row, in one query
+        return (IngredientModel.objects.using(using).filter(id=ingredient_id)
+                .values_list('id', 'name', 'usage__recipe_count', 'usage__total_quantity'))
+
+    def _usage(self, row) -> IngredientUsage:
+        id, name, recipes, total_quantity = row
+        return IngredientUsage(name=name, recipes=recipes or 0, total_quantity=total_quantity or Decimal("0.00"), id=id)
+
+@timed_use_case
 class UpdateIngredientUseCase:
     def update(self, ingredient, ingredient_id, new_name, new_description) -> Ingredient:
         try:
-            # Retrieve the original ingredient from the database by ID
-            original_ingredient_model = IngredientModel.objects.get(id=ingredient_id)
+            with transaction.atomic():
+                return self._update(ingredient, ingredient_id, new_name, new_description)
+        except IngredientModel.DoesNotExist:
+            raise ValueError("Ingredient not found.")
 
-            # Check if an ingredient with the same name already exists
-            existing_ingredient = IngredientModel.objects.exclude(id=ingredient_id).filter(name=new_name)
+    def _update(self, ingredient, ingredient_id, new_name, new_description) -> Ingredient:
+        # Retrieve the original ingredient from the database by ID
+        original_ingredient_model = IngredientModel.objects.select_for_update().get(id=ingredient_id)
 
-            if existing_ingredient.exists():
-                raise ValueError("An ingredient with the same name already exists.")
+        # Check if an ingredient with the same name already exists
+        existing_ingredient = IngredientModel.objects.exclude(id=ingredient_id).filter(name=new_name)
 
-            # Update the ingredient entity
-            ingredient.name = new_name
-            ingredient.description = new_description
+        if existing_ingredient.exists():
+            raise ValueError("An ingredient with the same name already exists.")
 
-            # Update the corresponding IngredientModel in the database
-            original_ingredient_model.name = new_name
-            original_ingredient_model.description = new_description
-            original_ingredient_model.save()
+        # Update the ingredient entity
+        ingredient.name = new_name
+        ingredient.description = new_description
 
-            return ingredient
-        except IngredientModel.DoesNotExist:
-            raise ValueError("Ingredient not found.")
-        
+        invalidate_ingredients(ids=[ingredient_id], names=[original_ingredient_model.name, new_name])
+        invalidate_recipes_using([ingredient_id])
+
+        # Update the corresponding IngredientModel in the database
+        renamed = original_ingredient_model.name != new_name
+        original_ingredient_model.name = new_name
+        original_ingredient_model.description = new_description
+        original_ingredient_model.save()
+        if renamed:
+            # Recipe documents embed ingredient names
+            refresh_documents(recipes_using([ingredient_id]))
+
+        return ingredient
+
+@timed_use_case
+class BulkCreateIngredientUseCase:
+    def create(self, ingredients, upsert=False, batch_size=BULK_BATCH_SIZE) -> List[Tuple[Ingredient, bool]]:
+        # Returns one (ingredient, created) pair per input item, in input order.
+        # Everything runs in one transaction: either the whole payload lands or none of it.
+        results = []
+        with transaction.atomic():
+            for start in range(0, len(ingredients), batch_size):
+                results.extend(self._create_batch(ingredients[start:start + batch_size], upsert))
+        return results
+
+    def _create_batch(self, batch, upsert):
+        if not upsert:
+            ingredient_models = [IngredientModel(name=ingredient_data["name"],
+                                                 description=ingredient_data.get("description", ""))
+                                 for ingredient_data in batch]
+            IngredientModel.objects.bulk_create(ingredient_models)
+            items = [(ingredient_model.name, ingredient_model.description, ingredient_model.id, True)
+                     for ingredient_model in ingredient_models]
+        else:
+            # Repeated name inside the payload: the last description wins
+            descriptions = {}
+            for ingredient_data in batch:
+                descriptions[ingredient_data["name"]] = ingredient_data.get("description", "")
+            # Only decides the created flag: a row another writer inserts
+            # after this lookup is updated by the INSERT below, not a conflict
+            existing = set(IngredientModel.objects.filter(name__in=descriptions).values_list('name', flat=True))
+            # One INSERT ... ON CONFLICT (name) DO UPDATE per batch
+            IngredientModel.objects.bulk_create(
+                [IngredientModel(name=name, description=description) for name, description in descriptions.items()],
+                update_conflicts=True, unique_fields=['name'], update_fields=['description'])
+            # The upsert does not return the ids of the rows it updated
+            ids = dict(IngredientModel.objects.filter(name__in=descriptions).values_list('name', 'id'))
+            items = [(ingredient_data["name"], descriptions[ingredient_data["name"]], ids[ingredient_data["name"]],
+                      ingredient_data["name"] not in existing)
+                     for ingredient_data in batch]
+        invalidate_ingredients(ids=[id for _, _, id, _ in items], names=[name for name, _, _, _ in items])
+
+        return [(Ingredient(name=name, description=description, id=id), created)
+                for name, description, id, created in items]
+
+@timed_use_case
 class DeleteIngredientUseCase:
     def delete(self, ingredient_id):
         try:
-            # Retrieve the ingredient to be deleted
-            ingredient_model = IngredientModel.objects.get(id=ingredient_id)
+            with transaction.atomic():
+                # Retrieve the ingredient to be deleted. Locked, like a rename, so
+                # the recipes looked up below include those of concurrent recipe writes.
+                ingredient_model = IngredientModel.objects.select_for_update().get(id=ingredient_id)
+
+                invalidate_ingredients(ids=[ingredient_id], names=[ingredient_model.name])
+                invalidate_recipes_using([ingredient_id])
 
-            # Delete the ingredient from the database
-            ingredient_model.delete()
+                # Delete the ingredient from the database. The delete cascades
+                # to its lines, so the documents of their recipes change too.
+                recipe_ids = recipes_using([ingredient_id])
+                ingredient_model.delete()
+                refresh_documents(recipe_ids)
+                transaction.on_commit(lambda: pantry_index.remove_ingredient(ingredient_id))
         except IngredientModel.DoesNotExist:
             raise ValueError("Ingredient not found.")
-        
 
-class ReadRecipeUseCase:  
+@timed_use_case
+class ReadRecipeUseCase:
+    # Recipes with their lines, through the entity cache and the request's
+    # batch loaders, as in ReadIngredientUseCase.
+
+    def __init__(self, recipes: RecipeRepository = None, cache: EntityCache = recipe_cache):
+        self.recipes = recipes or DjangoRecipeRepository()
+        self.cache = cache
+
     def get_by_name(self, name) -> Recipe:
-        try:
-            recipe_model = RecipeModel.objects.get(name=name)
-            recipe_ingredients_model = RecipeIngredientModel.objects.filter(recipe=recipe_model)
-            ingredients = []
-            for recipe_ingredient_model in recipe_ingredients_model:
-                ingredient_entity = {
-                    "id":recipe_ingredient_model.id,
-                    "name": recipe_ingredient_model.ingredient.name,
-                    "quantity": recipe_ingredient_model.quantity,
-                }
-                ingredients.append(ingredient_entity)
-            recipe_entity = Recipe(
-                name=recipe_model.name,
-                ingredients=ingredients,
-                elaboration=recipe_model.elaboration,
-                id=recipe_model.id
-            )
-            return recipe_entity
-        except RecipeModel.DoesNotExist:
-            return None
+        return self.cache.get('name', name, lambda: self._by_name().load(name))
 
     def get_by_id(self, recipe_id) -> Recipe:
-        try:
-            recipe_model = RecipeModel.objects.get(id=recipe_id)
-            recipe_ingredients_model = RecipeIngredientModel.objects.filter(recipe=recipe_model)
-            ingredients = []
-            for recipe_ingredient_model in recipe_ingredients_model:
-                ingredient_entity = {
-                    "id":recipe_ingredient_model.id,
-                    "name": recipe_ingredient_model.ingredient.name,
-                    "quantity": recipe_ingredient_model.quantity,
-                }
-                ingredients.append(ingredient_entity)
-            recipe_entity = Recipe(
+        return self.cache.get('id', recipe_id, lambda: self._by_id().load(recipe_id))
+
+    def get_many(self, ids) -> List[Recipe]:
+        # One entry per id, in order; None for the ids that do not exist.
+        # Whatever the cache does not hold comes from one IN query plus one lines query.
+        return self.cache.get_many('id', ids, self._by_id().load_many)
+
+    def get_all(self, after=None, limit=None) -> List[Recipe]:
+        return self.recipes.page(after, limit)
+
+    def _by_id(self) -> BatchLoader:
+        return request_loader(self.recipes, 'get_many')
+
+    def _by_name(self) -> BatchLoader:
+        return request_loader(self.recipes, 'get_by_names')
+
+    # Async versions of the reads above, for the async views served under ASGI
+
+    async def aget_by_name(self, name) -> Recipe:
+        return await self.cache.aget('name', name, lambda: self._by_name().aload(name))
+
+    async def aget_by_id(self, recipe_id) -> Recipe:
+        return await self.cache.aget('id', recipe_id, lambda: self._by_id().aload(recipe_id))
+
+    async def aget_many(self, ids) -> List[Recipe]:
+        return await self.cache.aget_many('id', ids, self._by_id().aload_many)
+
+    # Row versions of the listings, for the serializers of the listing endpoints.
+    # As for ingredients, streaming views pass using.
+
+    def get_all_rows(self, after=None, limit=None, fields=RECIPE_ROW, using=None) -> List[tuple]:
+        using = using or read_alias()
+        return attach_lines(list(keyset_page(recipe_rows(fields, using), after, limit)), fields, using)
+
+    def iter_rows(self, chunk_size=STREAM_CHUNK_SIZE, fields=RECIPE_ROW, using=None) -> Iterator[tuple]:
+        # Keyset pages of chunk_size, each with one lines query
+        after = None
+        while True:
+            rows = self.get_all_rows(after=after, limit=chunk_size, fields=fields, using=using)
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][0]
+
+    async def aget_all_rows(self, after=None, limit=None, fields=RECIPE_ROW, using=None) -> List[tuple]:
+        using = using or await aread_alias()
+        rows = [row async for row in keyset_page(recipe_rows(fields, using), after, limit)]
+        return await aattach_lines(rows, fields, using)
+
+    async def aiter_rows(self, chunk_size=STREAM_CHUNK_SIZE, fields=RECIPE_ROW, using=None) -> AsyncIterator[tuple]:
+        after = None
+        while True:
+            rows = await self.aget_all_rows(after=after, limit=chunk_size, fields=fields, using=using)
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][0]
+
+@timed_use_case
+class SearchRecipeUseCase:
+    # Ranked full-text search over name (weighted higher) and elaboration, served
+    # from the index created in migration 0005: a GIN-indexed generated tsvector
+    # on PostgreSQL and an FTS5 table on SQLite.
+    POSTGRESQL_SEARCH = """
+        SELECT id, name, ts_rank(search_vector, query) AS rank
+        FROM recipes_recipemodel, websearch_to_tsquery('english', %s) query
+        WHERE search_vector @@ query
+        ORDER BY rank DESC, id
+        LIMIT %s OFFSET %s
+    """
+    SQLITE_SEARCH = """
+        SELECT recipes_recipe_fts.rowid, recipes_recipe_fts.name,
+               -bm25(recipes_recipe_fts, 10.0, 1.0) AS rank
+        FROM recipes_recipe_fts
+        WHERE recipes_recipe_fts MATCH %s
+        ORDER BY rank DESC, recipes_recipe_fts.rowid
+        LIMIT %s OFFSET %s
+    """
+
+    def search(self, query, limit, offset=0) -> List[RecipeSearchResult]:
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        if connection.vendor == 'postgresql':
+            sql, terms = self.POSTGRESQL_SEARCH, query
+        elif connection.vendor == 'sqlite':
+            # Quoting every word keeps FTS5 operators in user input from being parsed
+            sql, terms = self.SQLITE_SEARCH, " ".join(f'"{word}"' for word in words)
+        else:
+            return self._search_unindexed(words, limit, offset)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [terms, limit, offset])
+            return [RecipeSearchResult(id=id, name=name, rank=rank) for id, name, rank in cursor.fetchall()]
+
+    def _search_unindexed(self, words, limit, offset):
+        recipe_models = RecipeModel.objects.all()
+        for word in words:
+            recipe_models = recipe_models.filter(Q(name__icontains=word) | Q(elaboration__icontains=word))
+        rows = recipe_models.order_by('id').values_list('id', 'name')[offset:offset + limit]
+        return [RecipeSearchResult(id=id, name=name, rank=0.0) for id, name in rows]
+
+@timed_use_case
+class PantryMatchUseCase:
+    def __init__(self, ingredients: IngredientRepository = None, recipes: RecipeRepository = None):
+        self.ingredients = ingredients or DjangoIngredientRepository()
+        self.recipes = recipes or DjangoRecipeRepository()
+
+    def match(self, ingredient_ids=(), ingredient_names=(), limit=20) -> List[PantryMatch]:
+        # Recipes using any pantry ingredient, fully cookable first, then by
+        # fewest missing ingredients. Ranking runs on the in-memory index; the
+        # database is only asked for names, one IN query per kind.
+        pantry = set(ingredient_ids)
+        if ingredient_names:
+            pantry.update(ingredient.id for ingredient in
+                          request_loader(self.ingredients, 'get_by_names').load_many(set(ingredient_names)).values())
+        if not pantry:
+            return []
+
+        ranked = pantry_index.match(pantry, limit)
+        recipe_names = self.recipes.names_for([recipe_id for recipe_id, _ in ranked])
+        missing_ingredients = request_loader(self.ingredients, 'get_many').load_many(
+            {ingredient_id for _, missing in ranked for ingredient_id in missing})
+        return [
+            PantryMatch(
+                id=recipe_id,
+                name=recipe_names.get(recipe_id),
+                missing=[{"id": ingredient_id, "name": getattr(missing_ingredients.get(ingredient_id), 'name', None)}
+                         for ingredient_id in missing],
+            )
+            for recipe_id, missing in ranked
+        ]
+
+@timed_use_case
+class ShoppingListUseCase:
+    # The ingredients of a meal plan, summed by the database in one query.
+    # MAX_SERVINGS per recipe keeps every product, and the sum over a plan
+    # of MAX_PAGE_SIZE recipes, within a 64-bit integer.
+    MAX_SERVINGS = 1000
+
+    def __init__(self, lines: RecipeLineRepository = None):
+        self.lines = lines or DjangoRecipeLineRepository()
+
+    def build(self, plan) -> List[ShoppingListItem]:
+        return self._rounded(self.lines.shopping_list(self._servings(plan)))
+
+    async def abuild(self, plan) -> List[ShoppingListItem]:
+        return self._rounded(await self.lines.ashopping_list(self._servings(plan)))
+
+    def _servings(self, plan) -> dict:
+        # plan: [(recipe_id, servings)]. Servings have the two decimals of a
+        # quantity at most, and a recipe listed twice adds up, to MAX_SERVINGS.
+        servings = {}
+        for recipe_id, value in plan:
+            value = Decimal(str(value))
+            if (not value.is_finite() or value <= 0 or value > self.MAX_SERVINGS
+                    or value != value.quantize(Decimal("0.01"))):
+                raise ValueError(f"Invalid servings for recipe {recipe_id}: {value}.")
+            servings[int(recipe_id)] = servings.get(int(recipe_id), Decimal(0)) + value
+            if servings[int(recipe_id)] > self.MAX_SERVINGS:
+                raise ValueError(f"More than {self.MAX_SERVINGS} servings of recipe {recipe_id}.")
+        return servings
+
+    def _rounded(self, items) -> List[ShoppingListItem]:
+        # The totals are exact; round them once, to the quantity column's precision
+        for item in items:
+            item.quantity = item.quantity.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        return items
+
+@timed_use_case
+class CreateRecipeUseCase:
+    def create(self, name, ingredients, elaboration) -> Recipe:
+        # ingredients: [{"ingredient_id", "quantity"}]; every id must exist.
+        # One line per ingredient, the first one wins. The recipe and all its
+        # lines commit together or not at all.
+        quantities = {}
+        for line in ingredients:
+            quantities.setdefault(int(line["ingredient_id"]), to_quantity(line["quantity"]))
+        with transaction.atomic():
+            names = lock_ingredient_names(quantities)
+            if quantities.keys() - names.keys():
+                raise ValueError(f"Ingredient not found: {min(quantities.keys() - names.keys())}.")
+            recipe_model = RecipeModel.objects.create(name=name, elaboration=elaboration)
+            line_models = RecipeIngredientModel.objects.bulk_create([
+                RecipeIngredientModel(recipe=recipe_model, ingredient_id=ingredient_id, quantity=quantity)
+                for ingredient_id, quantity in quantities.items()
+            ], batch_size=BULK_BATCH_SIZE)
+            record_usage(UsageChanges().add(quantities.items()))
+            recipe = Recipe(
                 name=recipe_model.name,
-                ingredients=ingredients,
+                ingredients=[
+                    RecipeLine(id=line_model.id, name=names[line_model.ingredient_id], quantity=line_model.quantity)
+                    for line_model in line_models
+                ],
                 elaboration=recipe_model.elaboration,
                 id=recipe_model.id
             )
+            save_documents([recipe])
+            invalidate_recipes(ids=[recipe_model.id], names=[recipe_model.name])
+            transaction.on_commit(lambda: pantry_index.update_recipe(recipe_model.id))
+        return recipe
 
-            return recipe_entity
-        except RecipeModel.DoesNotExist:
-            return None
+@timed_use_case
+class UpdateRecipeUseCase:
+    def update(self, recipe, recipe_id, new_name, new_ingredients, new_elaboration) -> Recipe:
+        # new_ingredients: [{"name", "quantity"}] or [{"id", "quantity"}]. Existing
+        # ingredients are reused, never rewritten or deleted, and only the lines
+        # that differ from the stored ones are written.
+        with transaction.atomic():
+            try:
+                recipe_model = RecipeModel.objects.select_for_update().get(id=recipe_id)
+            except RecipeModel.DoesNotExist:
+                raise ValueError("Recipe not found.")
 
-    def get_all(self) -> List[Recipe]:
-        try:
-            recipe_models = RecipeModel.objects.all().order_by('id')
+            ingredient_ids = self._resolve_ingredients(new_ingredients)
+            names = lock_ingredient_names(ingredient_ids)
+            if set(ingredient_ids) - names.keys():
+                raise ValueError(f"Ingredient not found: {min(set(ingredient_ids) - names.keys())}.")
+            quantities = {}
+            for ingredient_id, line in zip(ingredient_ids, new_ingredients):
+                # One line per ingredient; the first one wins
+                quantities.setdefault(ingredient_id, to_quantity(line["quantity"]))
 
-            recipe_entities = []
+            lines = {line.ingredient_id: line for line in RecipeIngredientModel.objects.filter(recipe_id=recipe_id)}
+            removed = lines.keys() - quantities.keys()
+            usage = UsageChanges().remove((ingredient_id, lines[ingredient_id].quantity) for ingredient_id in removed)
+            changed = []
+            for ingredient_id, line in lines.items():
+                if ingredient_id in quantities and line.quantity != quantities[ingredient_id]:
+                    usage.change(ingredient_id, line.quantity, quantities[ingredient_id])
+                    line.quantity = quantities[ingredient_id]
+                    changed.append(line)
+            added = [RecipeIngredientModel(recipe_id=recipe_id, ingredient_id=ingredient_id, quantity=quantity)
+                     for ingredient_id, quantity in quantities.items() if ingredient_id not in lines]
+            usage.add((line.ingredient_id, line.quantity) for line in added)
 
-            for recipe_model in recipe_models:
-                recipe_ingredients_model = RecipeIngredientModel.objects.filter(recipe=recipe_model)
-                ingredients = []
-                for recipe_ingredient_model in recipe_ingredients_model:
-                    ingredient_entity = {
-                        "name": recipe_ingredient_model.ingredient.name,
-                        "quantity": recipe_ingredient_model.quantity,
-                        "id": recipe_ingredient_model.id,
-                    }
-                    ingredients.append(ingredient_entity)
-                recipe_entities.append(Recipe(
-                    name=recipe_model.name,
-                    ingredients=ingredients,
-                    elaboration=recipe_model.elaboration,
-                    id=recipe_model.id
-                ))
-            return recipe_entities
-        except Exception:
-            return []
+            if removed:
+                RecipeIngredientModel.objects.filter(recipe_id=recipe_id, ingredient_id__in=removed).delete()
+            if changed:
+                RecipeIngredientModel.objects.bulk_update(changed, ['quantity'], batch_size=BULK_BATCH_SIZE)
+            if added:
+                RecipeIngredientModel.objects.bulk_create(added, batch_size=BULK_BATCH_SIZE)
+                lines.update((line.ingredient_id, line) for line in added)
+            if (recipe_model.name, recipe_model.elaboration) != (new_name, new_elaboration):
+                invalidate_recipes(names=[recipe_model.name])
+                recipe_model.name = new_name
+                recipe_model.elaboration = new_elaboration
+                recipe_model.save(update_fields=['name', 'elaboration'])
+            record_usage(usage)
 
-class UpdateRecipeUseCase:
-    def update(self, recipe, recipe_id, new_name, new_ingredients, new_elaboration) -> Recipe:
-        try:
-            original_recipe_model = RecipeModel.objects.get(id=recipe_id)
-            recipe_ingredients_model = RecipeIngredientModel.objects.filter(recipe=original_recipe_model)
-
-            recipe.name = new_name
-            recipe.ingredients = new_ingredients
-            recipe.elaboration = new_elaboration
-
-            original_recipe_model.name = new_name
-            #original_recipe_model.ingredients = new_ingredients
-            original_recipe_model.elaboration = new_elaboration
-            original_recipe_model.save()
-            for ingredient_original in recipe_ingredients_model:
-                original_ingredient=IngredientModel.objects.get(id=ingredient_original.ingredient_id)
-                original_ingredient.delete()
-            recipe_ingredients_model.delete()
-            for ingredient_data in new_ingredients:
-                ingredient_model = IngredientModel(name=ingredient_data["name"],description="")
-                ingredient_model.save()
-                # Create and save the RecipeIngredientModel linking the recipe and ingredient
-                recipe_ingredient_model = RecipeIngredientModel(recipe=original_recipe_model,
-                                                            ingredient=ingredient_model,
-                                                            quantity=ingredient_data["quantity"])
-                recipe_ingredient_model.save()
-            return recipe
-        except RecipeModel.DoesNotExist:
-            raise ValueError("Recipe not found.")
+            new_lines = [RecipeLine(id=lines[ingredient_id].id, name=names[ingredient_id], quantity=quantity)
+                         for ingredient_id, quantity in quantities.items()]
+            save_documents([Recipe(name=new_name, ingredients=new_lines, elaboration=new_elaboration, id=recipe_id)])
+            invalidate_recipes(ids=[recipe_id], names=[new_name])
+            if removed or added:
+                transaction.on_commit(lambda: pantry_index.update_recipe(recipe_id))
+
+        recipe.name = new_name
+        recipe.ingredients = new_lines
+        recipe.elaboration = new_elaboration
+        return recipe
+
+    def _resolve_ingredients(self, lines) -> List[int]:
+        # The ingredient id of every line: "id" if given, else found or created by "name"
+        names = resolve_ingredient_names(line["name"] for line in lines if "id" not in line)
+        return [int(line["id"]) if "id" in line else names[line["name"]] for line in lines]
 
+@timed_use_case
 class DeleteRecipeUseCase:
     def delete(self, recipe_id):
         try:
-            recipe_model = RecipeModel.objects.get(id=recipe_id)
-            recipe_ingredients_model = RecipeIngredientModel.objects.filter(recipe=recipe_model)
+            with transaction.atomic():
+                # Locked as UpdateRecipeUseCase does, so the lines read for the
+                # usage deltas are the ones the delete removes
+                recipe_model = RecipeModel.objects.select_for_update().get(id=recipe_id)
+                recipe_ingredients_model = RecipeIngredientModel.objects.filter(recipe=recipe_model)
 
-            recipe_model.delete()
-            recipe_ingredients_model.delete()
+                invalidate_recipes(ids=[recipe_id], names=[recipe_model.name])
+                record_usage(UsageChanges().remove(recipe_ingredients_model.values_list('ingredient_id', 'quantity')))
+                recipe_model.delete()
+                recipe_ingredients_model.delete()
+                transaction.on_commit(lambda: pantry_index.remove_recipe(recipe_id))
         except RecipeModel.DoesNotExist:
             raise ValueError("Recipe not found.")
+
+@timed_use_case
+class ImportCatalogUseCase:
+    # The quantity column: max_digits=5, decimal_places=2
+    MAX_QUANTITY = Decimal("999.99")
+    MAX_NAME_LENGTH = 255
+
+    def validate(self, records, first=0):
+        # Raises ValueError naming the first bad record by its index in the
+        # catalog, where records[0] is record number first
+        for index, record in enumerate(records, first):
+            try:
+                self._validate_record(record)
+            except ValueError as e:
+                raise ValueError(f"Record {index}: {e}")
+
+    def _validate_record(self, record):
+        if not isinstance(record, dict):
+            raise ValueError("not an object")
+        self._validate_name(record.get("name"), "name")
+        if not isinstance(record.get("elaboration", ""), str):
+            raise ValueError("elaboration is not a string")
+        if not isinstance(record.get("ingredients"), list):
+            raise ValueError("ingredients is not a list")
+        for number, line in enumerate(record["ingredients"]):
+            if not isinstance(line, dict):
+                raise ValueError(f"ingredient {number} is not an object")
+            self._validate_name(line.get("name"), f"ingredient {number} name")
+            try:
+                quantity = to_quantity(line.get("quantity"))
+            except ArithmeticError:
+                raise ValueError(f"ingredient {number} quantity {line.get('quantity')!r} is not a number")
+            if abs(quantity) > self.MAX_QUANTITY:
+                raise ValueError(f"ingredient {number} quantity {quantity} is over {self.MAX_QUANTITY}")
+
+    def _validate_name(self, name, field):
+        if not isinstance(name, str) or not name.strip():
+            raise ValueError(f"{field} is missing")
+        if len(name) > self.MAX_NAME_LENGTH:
+            raise ValueError(f"{field} is longer than {self.MAX_NAME_LENGTH} characters")
+
+    def committed_batches(self, source, batch_size) -> set:
+        checkpoints = ImportCheckpointModel.objects.filter(source=source)
+        if checkpoints.exclude(batch_size=batch_size).exists():
+            raise ValueError("The previous import of this source used a different batch size.")
+        return set(checkpoints.values_list('batch', flat=True))
+
+    def import_batch(self, records, source, batch, batch_size) -> int:
+        # records: [{"name", "elaboration", "ingredients": [{"name", "quantity"}]}]
+        # The batch and its checkpoint commit together, so a batch is either fully
+        # imported and recorded or not at all.
+        # Recipe names are unique: names already in the catalog, or repeated in
+        # the batch, are skipped and not counted as imported.
+        # A bad record fails the batch before it starts, with its index.
+        self.validate(records, batch * batch_size)
+        with transaction.atomic():
+            existing = set(RecipeModel.objects.filter(
+                name__in={record["name"] for record in records}).values_list('name', flat=True))
+            new_records = {}
+            for record in records:
+                if record["name"] not in existing:
+                    new_records.setdefault(record["name"], record)
+            new_records = list(new_records.values())
+
+            ingredient_ids = resolve_ingredient_names(
+                {line["name"] for record in new_records for line in record["ingredients"]})
+            # Before refresh_documents() renders their names
+            lock_ingredient_names(ingredient_ids.values())
+
+            recipe_models = RecipeModel.objects.bulk_create([
+                RecipeModel(name=record["name"], elaboration=record.get("elaboration", ""))
+                for record in new_records
+            ])
+            recipe_ingredient_models = {}
+            for recipe_model, record in zip(recipe_models, new_records):
+                for line in record["ingredients"]:
+                    # One line per ingredient and recipe; the first one wins
+                    recipe_ingredient_models.setdefault(
+                        (recipe_model.id, ingredient_ids[line["name"]]),
+                        RecipeIngredientModel(recipe=recipe_model,
+                                              ingredient_id=ingredient_ids[line["name"]],
+                                              quantity=Decimal(str(line["quantity"]))))
+            RecipeIngredientModel.objects.bulk_create(recipe_ingredient_models.values(),
+                                                      batch_size=BULK_BATCH_SIZE)
+            record_usage(UsageChanges().add((line.ingredient_id, line.quantity)
+                                            for line in recipe_ingredient_models.values()))
+            refresh_documents(recipe_model.id for recipe_model in recipe_models)
+
+            invalidate_recipes(ids=[recipe_model.id for recipe_model in recipe_models],
+                               names=[recipe_model.name for recipe_model in recipe_models])
+            ImportCheckpointModel.objects.create(source=source, batch=batch,
+                                                 batch_size=batch_size, records=len(new_records))
+            for recipe_model in recipe_models:
+                transaction.on_commit(lambda recipe_id=recipe_model.id: pantry_index.update_recipe(recipe_id))
+        return len(new_records)
@@ -0,0 +1,221 @@
+# jobs.py
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from recipes.core.usecases import BULK_BATCH_SIZE, BulkCreateIngredientUseCase, ImportCatalogUseCase
+from recipes.storage.entity_cache import recipe_cache
+from recipes.storage.ingredient_usage import reconcile_usage
+from recipes.storage.models import JobModel
+from recipes.storage.read_model import DOCUMENT_BATCH_SIZE, rebuild_documents
+
+logger = logging.getLogger(__name__)
+
+# Background jobs: heavy operations that would otherwise hold a request
+# worker. submit() queues a row of JobModel; `manage.py run_workers` claims
+# rows and runs the handler of their kind, which reports its progress
+# through the Job it is given and returns a JSON-serializable result.
+
+# A claimed job whose worker stopped heartbeating for this long is queued
+# again, up to MAX_ATTEMPTS claims in all
+STALE_SECONDS = 300
+MAX_ATTEMPTS = 3
+PROGRESS_INTERVAL = 0.5
+
+# kind: handler(job, payload) -> result
+HANDLERS = {}
+
+
+def handler(kind):
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+class Job:
+    """What a handler sees of its job: the id, and progress reporting.
+
+    progress() writes at most every PROGRESS_INTERVAL seconds, and always
+    when done reaches total; each write is also a heartbeat. Like finish(),
+    it only writes while worker still holds the claim.
+    """
+
+    def __init__(self, id, worker):
+        self.id = id
+        self.worker = worker
+        self._written = 0.0
+
+    def progress(self, done, total=None):
+        now = time.monotonic()
+        if now - self._written < PROGRESS_INTERVAL and done != total:
+            return
+        self._written = now
+        claimed(self.id, self.worker).update(progress=done, total=total, heartbeat_at=timezone.now())
+
+
+def submit(kind, payload) -> JobModel:
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind {kind!r}.")
+    if not isinstance(payload, dict):
+        raise ValueError("The payload must be an object.")
+    return JobModel.objects.create(kind=kind, payload=payload)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim(worker) -> int:
+    # The id of the oldest queued job, now running for worker, or None. The
+    # status condition of the UPDATE makes the claim atomic: of two workers
+    # racing for a job, one updates the row and the other moves on.
+    candidates = JobModel.objects.filter(status=JobModel.QUEUED).order_by('id').values_list('id', flat=True)[:10]
+    for job_id in candidates:
+        now = timezone.now()
+        if JobModel.objects.filter(id=job_id, status=JobModel.QUEUED).update(
+                status=JobModel.RUNNING, worker=worker, attempts=F('attempts') + 1,
+                started_at=now, heartbeat_at=now, error=''):
+            return job_id
+    return None
+
+
+def claimed(job_id, worker):
+    # The job, while worker is running it. A worker whose job was requeued as
+    # stale, and maybe claimed again by another, no longer matches.
+    return JobModel.objects.filter(id=job_id, worker=worker, status=JobModel.RUNNING)
+
+
+def heartbeat(job_ids, worker):
+    if job_ids:
+        JobModel.objects.filter(id__in=job_ids, worker=worker, status=JobModel.RUNNING).update(
+            heartbeat_at=timezone.now())
+
+
+@contextmanager
+def heartbeating(job_ids, worker, interval):
+    # Heartbeats from a thread every interval seconds while the block runs:
+    # handlers only heartbeat when they report progress, and some report
+    # none, or none for longer than STALE_SECONDS
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                heartbeat(job_ids, worker)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f"heartbeat {worker}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def requeue_stale(stale_seconds=STALE_SECONDS) -> int:
+    # Jobs of workers that died mid-run (killed, lost their host)
+    stale = JobModel.objects.filter(status=JobModel.RUNNING,
+                                    heartbeat_at__lt=timezone.now() - timedelta(seconds=stale_seconds))
+    return release(stale, "The worker running the job stopped.")
+
+
+def release(running, error) -> int:
+    # Running jobs whose run was lost go back to the queue, or fail once
+    # they have used up their attempts. Jobs of running that have finished
+    # meanwhile keep their outcome.
+    running = running.filter(status=JobModel.RUNNING)
+    failed = running.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=JobModel.FAILED, error=error, finished_at=timezone.now())
+    return failed + running.update(status=JobModel.QUEUED, error=error)
+
+
+def finish(job_id, worker, result=None, error=None) -> bool:
+    # False if worker lost the claim: the outcome of the run is dropped
+    return bool(claimed(job_id, worker).update(
+        status=JobModel.FAILED if error is not None else JobModel.SUCCEEDED,
+        result=result, error=error or '', finished_at=timezone.now()))
+
+
+def run(job_id):
+    """Run a claimed job to completion, in this process; returns its final status.
+
+    The handler's exceptions fail the job: the job keeps a one-line error,
+    which the result endpoint shows, and the traceback goes to the log. An
+    interrupted worker queues its job again before stopping.
+    """
+    job_model = JobModel.objects.get(id=job_id)
+    worker = job_model.worker
+    try:
+        result = HANDLERS[job_model.kind](Job(job_id, worker), job_model.payload)
+    except (KeyboardInterrupt, SystemExit):
+        claimed(job_id, worker).update(status=JobModel.QUEUED)
+        raise
+    except Exception as error:
+        logger.exception("Job %s (%s) failed", job_id, job_model.kind)
+        finish(job_id, worker, error=f"{type(error).__name__}: {error}"[:200])
+        return JobModel.FAILED
+    finish(job_id, worker, result=result)
+    return JobModel.SUCCEEDED
+
+
+@handler('import_catalog')
+def import_catalog(job, payload):
+    # {"records": [recipe records of import_catalog], "batch_size": 1000}. Batches
+    # commit with their checkpoint, so a job run again skips the committed ones.
+    records = payload['records']
+    batch_size = int(payload.get('batch_size', 1000))
+    source = payload.get('source') or f"job:{job.id}"
+    use_case = ImportCatalogUseCase()
+    # Fails the job before any batch commits
+    use_case.validate(records)
+    committed = use_case.committed_batches(source, batch_size)
+    batches = (len(records) + batch_size - 1) // batch_size
+    imported = 0
+    for batch in range(batches):
+        if batch not in committed:
+            imported += use_case.import_batch(records[batch * batch_size:(batch + 1) * batch_size],
+                                              source, batch, batch_size)
+        job.progress(batch + 1, batches)
+    return {'imported': imported, 'skipped_batches': len(committed)}
+
+
+@handler('bulk_create_ingredients')
+def bulk_create_ingredients(job, payload):
+    # {"items": [{"name", "description"}], "upsert": false}. Unlike the
+    # endpoint, every batch commits on its own, so progress is visible.
+    items = payload['items']
+    use_case = BulkCreateIngredientUseCase()
+    created = updated = 0
+    for start in range(0, len(items), BULK_BATCH_SIZE):
+        batch = items[start:start + BULK_BATCH_SIZE]
+        for _, was_created in use_case.create(batch, upsert=bool(payload.get('upsert'))):
+            created += was_created
+            updated += not was_created
+        job.progress(min(start + BULK_BATCH_SIZE, len(items)), len(items))
+    return {'created': created, 'updated': updated}
+
+
+@handler('rebuild_read_model')
+def rebuild_read_model(job, payload):
+    rebuilt = rebuild_documents(int(payload.get('batch_size', DOCUMENT_BATCH_SIZE)), progress=job.progress)
+    recipe_cache.invalidate()
+    return {'rebuilt': rebuilt}
+
+
+@handler('reconcile_ingredient_usage')
+def reconcile_ingredient_usage(job, payload):
+    # {"fix": false}: like the command, only rewrites the summary with "fix": true
+    computed, mismatches = reconcile_usage(fix=bool(payload.get('fix', False)))
+    return {'used_ingredients': len(computed), 'mismatches': len(mismatches)}
+
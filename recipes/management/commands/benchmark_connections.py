@@ -0,0 +1,55 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.signals import request_finished, request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from recipes.storage.models import IngredientModel
+
+
+class Command(BaseCommand):
+    help = ("Compare per-request latency with a new connection per request (CONN_MAX_AGE=0) against "
+            "persistent connections. Each request runs Django's request_started/request_finished "
+            "connection handling around one primary key lookup, as a view of the API would.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--max-age', type=int, default=60, help="CONN_MAX_AGE of the pooled run.")
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        connection = connections[alias]
+        original = connection.settings_dict['CONN_MAX_AGE']
+        opened = []
+        on_connect = lambda sender, connection, **kwargs: opened.append(connection.alias)
+        connection_created.connect(on_connect)
+        try:
+            self.stdout.write(f"{options['requests']} requests against {connection.vendor} '{alias}'")
+            self.stdout.write(f"{'mode':<22}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'opened':>8}")
+            for label, max_age in (("per request", 0), (f"pooled ({options['max_age']}s)", options['max_age'])):
+                connection.close()
+                connection.settings_dict['CONN_MAX_AGE'] = max_age
+                opened.clear()
+                timings = self.run(alias, options['requests'])
+                quantiles = statistics.quantiles(timings, n=100)
+                self.stdout.write(f"{label:<22}{statistics.fmean(timings):>10.3f}{quantiles[49]:>10.3f}"
+                                  f"{quantiles[94]:>10.3f}{quantiles[98]:>10.3f}{opened.count(alias):>8}")
+        finally:
+            connection_created.disconnect(on_connect)
+            connection.close()
+            connection.settings_dict['CONN_MAX_AGE'] = original
+
+    def run(self, alias, requests):
+        timings = []
+        for number in range(requests):
+            started = time.perf_counter()
+            request_started.send(sender=self.__class__)
+            try:
+                IngredientModel.objects.using(alias).filter(pk=number).first()
+            finally:
+                request_finished.send(sender=self.__class__)
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
@@ -0,0 +1,373 @@
+import datetime
+import http.client
+import json
+import platform
+import re
+import resource
+import secrets
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from recipes import urls
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+class ClientTransport:
+    """Requests through django.test.Client, in this process and on its DATABASES."""
+
+    label = 'client'
+
+    def __init__(self, session=None):
+        # 'localhost' passes the ALLOWED_HOSTS check DEBUG applies to an empty
+        # list; the test runner allows 'testserver' instead
+        self.client = Client(SERVER_NAME='testserver' if 'testserver' in settings.ALLOWED_HOSTS else 'localhost')
+        if session:
+            self.client.cookies[settings.SESSION_COOKIE_NAME] = session
+
+    def request(self, method, path, body=None):
+        response = self.client.generic(method, path, json.dumps(body) if body is not None else '',
+                                       content_type='application/json')
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response.status_code, response.headers.get('Server-Timing', ''), content
+
+
+class HttpTransport:
+    """Requests to a running server, over one keep-alive connection per thread."""
+
+    label = 'http'
+    # Sent again if the connection fails mid-request, as the server may have run them
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, url, session=None):
+        parts = urlsplit(url)
+        if parts.scheme != 'http' or not parts.hostname:
+            raise CommandError(f"Invalid URL {url!r}, expected http://host:port")
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.connections = {}
+        self.headers = {'Content-Type': 'application/json'}
+        if session:
+            # Session views check CSRF: any token passes when cookie and header agree
+            token = secrets.token_hex(16)
+            self.headers.update({'Cookie': f"{settings.SESSION_COOKIE_NAME}={session}; "
+                                           f"{settings.CSRF_COOKIE_NAME}={token}",
+                                 'X-CSRFToken': token})
+
+    def request(self, method, path, body=None):
+        thread = threading.get_ident()
+        conn = self.connections.get(thread)
+        if conn is None:
+            conn = self.connections[thread] = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        payload = json.dumps(body).encode() if body is not None else None
+        try:
+            conn.request(method, path, payload, self.headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException) as error:
+            # A reset means the server closed the keep-alive connection before
+            # reading the request: retry once on a new one. Other failures may
+            # come after the server ran it, so only idempotent requests retry.
+            conn.close()
+            if not isinstance(error, ConnectionResetError) and method not in self.IDEMPOTENT_METHODS:
+                raise
+            conn.request(method, path, payload, self.headers)
+            response = conn.getresponse()
+        return response.status, response.getheader('Server-Timing', ''), response.read()
+
+
+class Catalog:
+    """Sample ids and names read through the API, and the rows the write routes create.
+
+    Write routes only touch rows this run created, and the delete routes
+    remove them, so a run leaves the catalog as it found it.
+    """
+
+    def __init__(self, transport, run):
+        self.run = run
+        ingredients = self.fetch(transport, 'get-all-ingredients')
+        recipes = self.fetch(transport, 'get-all-recipes')
+        if not ingredients or not recipes:
+            raise CommandError("The catalog is empty; fill it with seed_catalog first.")
+        self.ingredient_ids = [row['id'] for row in ingredients]
+        self.ingredient_names = [row['name'] for row in ingredients]
+        self.recipe_ids = [row['id'] for row in recipes]
+        self.recipe_names = [row['name'] for row in recipes]
+        self.created_ingredients = []
+        self.created_recipes = []
+        self.created_jobs = []
+
+    def fetch(self, transport, name):
+        status, _, content = transport.request('GET', reverse(name) + '?limit=100&fields=id,name')
+        if status != 200:
+            raise CommandError(f"GET {reverse(name)} answered {status}")
+        return json.loads(content)['results']
+
+    def pick(self, values, index, count=1):
+        return [values[(index + offset) % len(values)] for offset in range(count)]
+
+    def ingredient_name(self, index):
+        return f"benchmark {self.run} ingredient {index}"
+
+    def created(self, values, index):
+        if not values:
+            raise CommandError("A write route ran before the route that creates its rows.")
+        return values[index % len(values)]
+
+
+def ids(values):
+    return ",".join(map(str, values))
+
+
+# URL name: (method, request(catalog, index) -> (path, body)), in the order they run.
+# Reads run first; each write route works on the rows of the ones before it.
+ROUTES = {
+    'get-all-ingredients': ('GET', lambda c, i: (reverse('get-all-ingredients') + '?limit=100', None)),
+    'get-ingredient-by-id': ('GET', lambda c, i: (
+        reverse('get-ingredient-by-id', args=c.pick(c.ingredient_ids, i)), None)),
+    'get-ingredient': ('GET', lambda c, i: (reverse('get-ingredient', args=c.pick(c.ingredient_names, i)), None)),
+    'get-ingredients-batch': ('GET', lambda c, i: (
+        reverse('get-ingredients-batch') + '?ids=' + ids(c.pick(c.ingredient_ids, i, 20)), None)),
+    'ingredient-stats': ('GET', lambda c, i: (reverse('ingredient-stats') + '?limit=20', None)),
+    'ingredient-usage': ('GET', lambda c, i: (reverse('ingredient-usage', args=c.pick(c.ingredient_ids, i)), None)),
+    'get-all-recipes': ('GET', lambda c, i: (reverse('get-all-recipes') + '?limit=100', None)),
+    'get-recipe-by-id': ('GET', lambda c, i: (reverse('get-recipe-by-id', args=c.pick(c.recipe_ids, i)), None)),
+    'get-recipe-by-name': ('GET', lambda c, i: (
+        reverse('get-recipe-by-name', args=c.pick(c.recipe_names, i)), None)),
+    'get-recipes-batch': ('GET', lambda c, i: (
+        reverse('get-recipes-batch') + '?ids=' + ids(c.pick(c.recipe_ids, i, 20)), None)),
+    'search-recipes': ('GET', lambda c, i: (
+        reverse('search-recipes') + '?q=' + c.pick(c.recipe_names, i)[0].split()[0], None)),
+    'pantry-match': ('GET', lambda c, i: (
+        reverse('pantry-match') + '?ids=' + ids(c.pick(c.ingredient_ids, i, 10)), None)),
+    'shopping-list': ('POST', lambda c, i: (
+        reverse('shopping-list'),
+        {'recipes': [{'id': recipe_id, 'servings': 1 + n % 4}
+                     for n, recipe_id in enumerate(c.pick(c.recipe_ids, i, 200))]})),
+    'cache-stats': ('GET', lambda c, i: (reverse('cache-stats'), None)),
+    'db-stats': ('GET', lambda c, i: (reverse('db-stats'), None)),
+    'ingredient-crud': ('POST', lambda c, i: (
+        reverse('ingredient-crud'), {'name': c.ingredient_name(i), 'description': "benchmark"})),
+    'bulk-create-ingredients': ('POST', lambda c, i: (
+        reverse('bulk-create-ingredients') + '?upsert=1',
+        [{'name': c.ingredient_name(f"{i}.{n}"), 'description': "benchmark"} for n in range(10)])),
+    'update-ingredient': ('PUT', lambda c, i: (
+        reverse('update-ingredient', args=[c.created(c.created_ingredients, i)]),
+        {'new_name': c.ingredient_name(f"{i}.updated"), 'new_description': "benchmark"})),
+    'create-recipe': ('POST', lambda c, i: (
+        reverse('create-recipe'),
+        {'name': f"benchmark {c.run} recipe {i}", 'elaboration': "benchmark",
+         'ingredients': [{'ingredient_id': ingredient_id, 'quantity': "1.5"}
+                         for ingredient_id in c.pick(c.ingredient_ids, i, 8)]})),
+    'update-recipe': ('PUT', lambda c, i: (
+        reverse('update-recipe', args=[c.created(c.created_recipes, i)]),
+        {'new_name': f"benchmark {c.run} recipe {i} updated", 'new_elaboration': "benchmark",
+         'new_ingredients': [{'id': ingredient_id, 'quantity': "2"}
+                             for ingredient_id in c.pick(c.ingredient_ids, i + 1, 8)]})),
+    'delete-recipe': ('DELETE', lambda c, i: (
+        reverse('delete-recipe', args=[c.created_recipes.pop()]), None)),
+    'delete-ingredient': ('DELETE', lambda c, i: (
+        reverse('delete-ingredient', args=[c.created_ingredients.pop()]), None)),
+    # Queues a read-only job: the rows stay in the jobs table, and run if a worker is up.
+    # Needs the --session of a staff user, as the job routes after it.
+    'submit-job': ('POST', lambda c, i: (
+        reverse('submit-job'), {'kind': 'reconcile_ingredient_usage', 'payload': {'fix': False}})),
+    'job-status': ('GET', lambda c, i: (reverse('job-status', args=[c.created(c.created_jobs, i)]), None)),
+    # Without a worker running, the jobs are still queued and this answers 202
+    'job-result': ('GET', lambda c, i: (reverse('job-result', args=[c.created(c.created_jobs, i)]), None)),
+}
+
+
+# Skipped without --session
+STAFF_ROUTES = ('submit-job', 'job-status', 'job-result')
+
+
+def collect_created(name, catalog, content):
+    # Ids of the rows a write route created, for the routes after it
+    if name == 'ingredient-crud':
+        catalog.created_ingredients.append(json.loads(content)['id'])
+    elif name == 'bulk-create-ingredients':
+        catalog.created_ingredients += [row['id'] for row in json.loads(content)['results']]
+    elif name == 'create-recipe':
+        catalog.created_recipes.append(json.loads(content)['id'])
+    elif name == 'submit-job':
+        catalog.created_jobs.append(json.loads(content)['id'])
+
+
+def peak_rss_kib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def compare(results, baseline, threshold, query_threshold, min_delta_ms=0.0):
+    # Regressions of results against baseline, as readable lines. A p95 must
+    # grow by both the fraction and min_delta_ms: a 1 ms route jitters by more
+    # than 25% between runs.
+    regressions = []
+    for name, route in results['routes'].items():
+        base = baseline.get('routes', {}).get(name)
+        if not base:
+            continue
+        if route['p95_ms'] > max(base['p95_ms'] * (1 + threshold), base['p95_ms'] + min_delta_ms):
+            regressions.append(f"{name}: p95 {route['p95_ms']:.2f} ms, baseline {base['p95_ms']:.2f} ms")
+        if route['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append(f"{name}: {route['throughput']:.0f} req/s, baseline {base['throughput']:.0f} req/s")
+        if (route['queries_mean'] is not None and base.get('queries_mean') is not None
+                and route['queries_mean'] > base['queries_mean'] + query_threshold):
+            regressions.append(f"{name}: {route['queries_mean']:.1f} queries per request, "
+                               f"baseline {base['queries_mean']:.1f}")
+        if route['errors'] > base.get('errors', 0):
+            regressions.append(f"{name}: {route['errors']} errors, baseline {base.get('errors', 0)}")
+    return regressions
+
+
+class Command(BaseCommand):
+    help = ("Benchmark every route of recipes/urls.py through the test client, or a running server with --url. "
+            "Records throughput, p50/p95/p99 latency, SQL queries per request (from Server-Timing), "
+            "and the peak RSS of the run, "
+            "writes them as JSON, and fails when a route regressed against --baseline. "
+            "Run seed_catalog first; write routes clean up the rows they create.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help="Base URL of a running server, e.g. http://127.0.0.1:8000.")
+        parser.add_argument('--requests', type=int, default=100, help="Timed requests per route.")
+        parser.add_argument('--warmup', type=int, default=10, help="Untimed requests per read route.")
+        parser.add_argument('--concurrency', type=int, default=1, help="Concurrent requests, with --url.")
+        parser.add_argument('--route', action='append', dest='routes', help="URL name to run; repeat for several.")
+        parser.add_argument('--session', help="Session key of a staff user, for the job routes.")
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+        parser.add_argument('--baseline', help="Results of an earlier run to compare against.")
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help="Allowed p95 latency increase and throughput drop, as a fraction.")
+        parser.add_argument('--query-threshold', type=float, default=0.5,
+                            help="Allowed increase of the mean SQL queries per request.")
+        parser.add_argument('--min-delta-ms', type=float, default=2.0,
+                            help="p95 increases smaller than this never count as regressions.")
+
+    def handle(self, *args, **options):
+        missing = {pattern.name for pattern in urls.urlpatterns} - set(ROUTES)
+        if missing:
+            raise CommandError(f"No benchmark scenario for {', '.join(sorted(missing))}; add them to ROUTES.")
+        names = options['routes'] or list(ROUTES)
+        unknown = set(names) - set(ROUTES)
+        if unknown:
+            raise CommandError(f"Unknown routes: {', '.join(sorted(unknown))}")
+        if not options['session'] and set(names) & set(STAFF_ROUTES):
+            self.stdout.write(f"Skipping {', '.join(STAFF_ROUTES)}: they need --session.")
+            names = [name for name in names if name not in STAFF_ROUTES]
+        if options['url']:
+            transport = HttpTransport(options['url'], options['session'])
+            concurrency = options['concurrency']
+        else:
+            transport = ClientTransport(options['session'])
+            concurrency = 1
+
+        run = time.strftime('%Y%m%d%H%M%S')
+        catalog = Catalog(transport, run)
+        results = {
+            'meta': {
+                'transport': transport.label,
+                'url': options['url'],
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'requests': options['requests'],
+                'concurrency': concurrency,
+                'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            },
+            'routes': {},
+        }
+        self.stdout.write(f"{'route':<26}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+                          f"{'queries':>9}{'errors':>8}")
+        # Routes run in ROUTES order so that write routes find their rows
+        for name in [name for name in ROUTES if name in names]:
+            route = self.run_route(name, transport, catalog, options, concurrency)
+            results['routes'][name] = route
+            queries = '-' if route['queries_mean'] is None else f"{route['queries_mean']:.1f}"
+            self.stdout.write(f"{name:<26}{route['throughput']:>9.0f}{route['p50_ms']:>9.2f}{route['p95_ms']:>9.2f}"
+                              f"{route['p99_ms']:>9.2f}{queries:>9}{route['errors']:>8}")
+        self.clean_up(transport, catalog)
+        # The high-water mark of the whole run: the routes that ran first set it for the
+        # others. Of this process: the server's own with the test client, the harness's with --url
+        results['meta']['peak_rss_kib'] = peak_rss_kib()
+        self.stdout.write(f"Peak RSS: {results['meta']['peak_rss_kib'] / 1024:.0f} MiB")
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(results, file, indent=2)
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)
+            if baseline['meta']['transport'] != results['meta']['transport']:
+                raise CommandError(f"The baseline was recorded through {baseline['meta']['transport']}, "
+                                   f"this run through {results['meta']['transport']}.")
+            regressions = compare(results, baseline, options['threshold'],
+                                  options['query_threshold'], options['min_delta_ms'])
+            if regressions:
+                raise CommandError("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline."))
+
+    def run_route(self, name, transport, catalog, options, concurrency):
+        method, build = ROUTES[name]
+        if method == 'GET':
+            for index in range(options['warmup']):
+                transport.request(method, *build(catalog, index))
+        if method == 'DELETE':
+            # One delete per created row at most
+            count = min(options['requests'],
+                        len(catalog.created_recipes if name == 'delete-recipe' else catalog.created_ingredients))
+        else:
+            count = options['requests']
+        # Requests are built up front: the write routes' builders are not thread-safe
+        requests = [build(catalog, index) for index in range(count)]
+
+        def timed(request):
+            started = time.perf_counter()
+            status, server_timing, content = transport.request(method, *request)
+            elapsed = time.perf_counter() - started
+            if status < 400:
+                collect_created(name, catalog, content)
+            match = SERVER_TIMING_QUERIES.search(server_timing)
+            return status, elapsed, int(match[1]) if match else None
+
+        started = time.perf_counter()
+        if concurrency > 1:
+            with ThreadPoolExecutor(concurrency) as pool:
+                outcomes = list(pool.map(timed, requests))
+        else:
+            outcomes = [timed(request) for request in requests]
+        wall = time.perf_counter() - started
+
+        latencies = sorted(elapsed * 1000 for _, elapsed, _ in outcomes) or [0.0]
+        queries = [count for _, _, count in outcomes if count is not None]
+        return {
+            'method': method,
+            'requests': len(outcomes),
+            'errors': sum(status >= 400 for status, _, _ in outcomes),
+            'throughput': len(outcomes) / wall if wall else 0.0,
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'queries_mean': statistics.fmean(queries) if queries else None,
+            'queries_max': max(queries) if queries else None,
+        }
+
+    def clean_up(self, transport, catalog):
+        # Rows left when --route skipped the delete routes
+        for recipe_id in catalog.created_recipes:
+            transport.request('DELETE', reverse('delete-recipe', args=[recipe_id]))
+        for ingredient_id in catalog.created_ingredients:
+            transport.request('DELETE', reverse('delete-ingredient', args=[ingredient_id]))
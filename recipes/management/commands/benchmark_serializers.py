@@ -0,0 +1,88 @@
+import json
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.http import JsonResponse
+
+from recipes.core.entities import Ingredient
+from recipes.core.usecases import INGREDIENT_ROW, RECIPE_ROW, ReadIngredientUseCase, ReadRecipeUseCase
+from recipes.serializers import ingredient_serializer, ingredient_to_dict, page_json, recipe_serializer, recipe_to_dict
+from recipes.storage.models import IngredientModel, RecipeIngredientModel, RecipeModel
+
+
+class DictIngredient:
+    # Ingredient as it was before __slots__, for the per-entity comparison
+    def __init__(self, name, description, id):
+        self.id = id
+        self.name = name
+        self.description = description
+
+
+def measure(function, repeat):
+    # (best wall time in seconds, peak traced allocation in bytes)
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+class Command(BaseCommand):
+    help = ("Compare the listing serialization paths: model instances -> entities -> dicts -> JsonResponse "
+            "against values_list() rows -> JSON bytes, with all fields and with ?fields=id,name. "
+            "Seeds a temporary catalog and rolls it back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help="Ingredients and recipes to seed.")
+        parser.add_argument('--lines', type=int, default=5, help="Ingredient lines per recipe.")
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        with transaction.atomic():
+            self.seed(rows, options['lines'])
+            ingredients, recipes = ReadIngredientUseCase(), ReadRecipeUseCase()
+            cases = [
+                ("ingredients", lambda: JsonResponse({'results': [ingredient_to_dict(i) for i in ingredients.get_all()],
+                                                      'next': None}).content,
+                 lambda: page_json(ingredients.get_all_rows(), ingredient_serializer(INGREDIENT_ROW), None),
+                 lambda: page_json(ingredients.get_all_rows(fields=('id', 'name')),
+                                   ingredient_serializer(('id', 'name')), None)),
+                ("recipes", lambda: JsonResponse({'results': [recipe_to_dict(r) for r in recipes.get_all()],
+                                                  'next': None}).content,
+                 lambda: page_json(recipes.get_all_rows(), recipe_serializer(RECIPE_ROW), None),
+                 lambda: page_json(recipes.get_all_rows(fields=('id', 'name')),
+                                   recipe_serializer(('id', 'name')), None)),
+            ]
+            self.stdout.write(f"Per {rows} rows (best of {repeat}; peak traced memory)")
+            self.stdout.write(f"{'listing':<12}{'path':<10}{'ms':>10}{'peak KiB':>12}")
+            for name, entities_path, rows_path, names_path in cases:
+                if json.loads(entities_path()) != json.loads(rows_path()):
+                    self.stderr.write(f"{name}: the two paths disagree")
+                for path, function in (("entities", entities_path), ("rows", rows_path), ("id,name", names_path)):
+                    seconds, peak = measure(function, repeat)
+                    self.stdout.write(f"{name:<12}{path:<10}{seconds * 1000:>10.1f}{peak / 1024:>12.0f}")
+
+            for label, cls in (("dict entity", DictIngredient), ("slotted", Ingredient)):
+                seconds, peak = measure(lambda: [cls(name="n", description="d", id=i) for i in range(rows)], repeat)
+                self.stdout.write(f"{label:<22}{seconds * 1000:>10.1f}{peak / 1024:>12.0f}")
+            transaction.set_rollback(True)
+
+    def seed(self, rows, lines):
+        ingredient_models = IngredientModel.objects.bulk_create(
+            [IngredientModel(name=f"benchmark ingredient {i}", description=f"description {i}") for i in range(rows)],
+            batch_size=1000)
+        recipe_models = RecipeModel.objects.bulk_create(
+            [RecipeModel(name=f"benchmark recipe {i}", elaboration=f"elaboration {i}") for i in range(rows)],
+            batch_size=1000)
+        RecipeIngredientModel.objects.bulk_create([
+            RecipeIngredientModel(recipe=recipe_model, ingredient=ingredient_models[(r + l) % rows], quantity=l + 1)
+            for r, recipe_model in enumerate(recipe_models) for l in range(min(lines, rows))
+        ], batch_size=1000)
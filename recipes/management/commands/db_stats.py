@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+ACTIVITY = """
+    SELECT coalesce(state, 'unknown'),
+           count(*),
+           coalesce(max(extract(epoch FROM now() - backend_start)), 0),
+           coalesce(max(extract(epoch FROM now() - state_change)) FILTER (WHERE wait_event_type = 'Lock'), 0)
+      FROM pg_stat_activity
+     WHERE datname = current_database() AND backend_type = 'client backend'
+     GROUP BY 1
+     ORDER BY 1
+"""
+
+
+class Command(BaseCommand):
+    help = ("Report the server side of the connection pool: connections to the database by state, "
+            "against max_connections, with the oldest connection and the longest lock wait. "
+            "GET /recipes/db/stats/ reports the same from inside a worker.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor != 'postgresql':
+            raise CommandError("db_stats reads pg_stat_activity and needs PostgreSQL.")
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW max_connections")
+            max_connections = int(cursor.fetchone()[0])
+            cursor.execute(ACTIVITY)
+            rows = cursor.fetchall()
+
+        total = sum(count for _, count, _, _ in rows)
+        self.stdout.write(f"{total} of {max_connections} connections in use ({total / max_connections:.0%})")
+        self.stdout.write(f"{'state':<32}{'count':>8}{'oldest s':>12}{'lock wait s':>14}")
+        for state, count, oldest, waiting in rows:
+            self.stdout.write(f"{state:<32}{count:>8}{float(oldest):>12.1f}{float(waiting):>14.1f}")
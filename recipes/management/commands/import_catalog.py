@@ -0,0 +1,144 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from recipes.core.usecases import ImportCatalogUseCase
+
+import_catalog_use_case = ImportCatalogUseCase()
+
+
+def read_ndjson(path):
+    # {"name": ..., "elaboration": ..., "ingredients": [{"name": ..., "quantity": ...}]} per line
+    with open(path, encoding='utf-8') as catalog:
+        index = 0
+        for line in catalog:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    raise ValueError(f"Record {index}: invalid JSON")
+                index += 1
+
+
+def read_csv(path):
+    # recipe,elaboration,ingredient,quantity with one row per recipe line;
+    # consecutive rows with the same recipe name form one recipe.
+    record = None
+    with open(path, encoding='utf-8', newline='') as catalog:
+        for row in csv.DictReader(catalog):
+            if record is None or row['recipe'] != record['name']:
+                if record is not None:
+                    yield record
+                record = {'name': row['recipe'], 'elaboration': row.get('elaboration', ''), 'ingredients': []}
+            if row.get('ingredient'):
+                record['ingredients'].append({'name': row['ingredient'], 'quantity': row['quantity']})
+    if record is not None:
+        yield record
+
+
+def read_batches(path, file_format, batch_size):
+    reader = read_csv if file_format == 'csv' else read_ndjson
+    batch = []
+    index = 0
+    for record in reader(path):
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield index, batch
+            index, batch = index + 1, []
+    if batch:
+        yield index, batch
+
+
+def init_worker():
+    # Needed with the spawn start method; a no-op for forked workers
+    django.setup()
+
+
+def import_batch(records, source, batch, batch_size):
+    return batch, import_catalog_use_case.import_batch(records, source, batch, batch_size)
+
+
+class Command(BaseCommand):
+    help = "Import recipes from an NDJSON or CSV catalog in batched, restartable transactions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['ndjson', 'csv'],
+                            help="Defaults to the file extension.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Records committed per transaction.")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Import batches in a pool of this many processes. "
+                                 "Needs a database with concurrent writers such as PostgreSQL.")
+        parser.add_argument('--source',
+                            help="Checkpoint key for restarts. Defaults to the absolute file path.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist.")
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError("--batch-size and --workers must be positive.")
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        source = options['source'] or os.path.abspath(path)
+        batch_size = options['batch_size']
+
+        try:
+            committed = import_catalog_use_case.committed_batches(source, batch_size)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if committed:
+            self.stdout.write(f"Resuming: skipping {len(committed)} committed batches.")
+        # A first pass over the file, so that a bad record stops the import
+        # before any batch commits
+        try:
+            for index, records in read_batches(path, file_format, batch_size):
+                import_catalog_use_case.validate(records, index * batch_size)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        pending = (
+            (index, records) for index, records in read_batches(path, file_format, batch_size)
+            if index not in committed
+        )
+        self.started = time.monotonic()
+        self.imported = 0
+        if options['workers'] == 1:
+            for index, records in pending:
+                self.report(*import_batch(records, source, index, batch_size))
+        else:
+            self.run_pool(pending, source, batch_size, options['workers'])
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {self.imported} recipes in {elapsed:.1f}s ({self.rate(elapsed):.0f} recipes/s)."))
+
+    def run_pool(self, pending, source, batch_size, workers):
+        # Workers must open their own connections; never share the parent's socket.
+        connections.close_all()
+        # Keep a bounded number of batches in flight so memory stays flat for any file size.
+        in_flight = set()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            for index, records in pending:
+                in_flight.add(pool.submit(import_batch, records, source, index, batch_size))
+                if len(in_flight) >= workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.report(*future.result())
+            for future in wait(in_flight).done:
+                self.report(*future.result())
+
+    def report(self, batch, records):
+        self.imported += records
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(
+            f"batch {batch}: {records} recipes committed, {self.imported} total, {self.rate(elapsed):.0f} recipes/s")
+
+    def rate(self, elapsed):
+        return self.imported / elapsed if elapsed else 0.0
@@ -0,0 +1,86 @@
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+DEFAULT_PATHS = [
+    '/recipes/ingredients/all/?limit=20',
+    '/recipes/recipes/all/?limit=20',
+]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def client(host, port, paths, deadline, client_delay, results):
+    # One slow client: it sends the request line, waits client_delay seconds
+    # before finishing the headers, then reads the whole response. A server
+    # that ties a thread to each connection stalls; an async one does not.
+    index = 0
+    while time.monotonic() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        started = time.monotonic()
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f"GET {path} HTTP/1.1\r\n".encode())
+            await writer.drain()
+            if client_delay:
+                await asyncio.sleep(client_delay)
+            writer.write(f"Host: {host}\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            status_line = await reader.readline()
+            await reader.read()
+            writer.close()
+            ok = status_line.split(b" ")[1:2] == [b"200"]
+        except (OSError, asyncio.IncompleteReadError, IndexError):
+            ok = False
+        results.append((ok, time.monotonic() - started))
+
+
+async def run_load(url, paths, concurrency, duration, client_delay):
+    parts = urlsplit(url)
+    if not parts.hostname:
+        raise CommandError(f"Invalid URL: {url}")
+    results = []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[
+        client(parts.hostname, parts.port or 80, paths, deadline, client_delay, results)
+        for _ in range(concurrency)
+    ])
+    return results
+
+
+class Command(BaseCommand):
+    help = ("Drive the GET endpoints of one or more running servers with concurrent slow clients "
+            "and compare throughput and latency, e.g. wsgi=http://127.0.0.1:8000 asgi=http://127.0.0.1:8001.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('targets', nargs='+', help="label=base_url, or just base_url")
+        parser.add_argument('--path', action='append', dest='paths',
+                            help="Path to request; repeat for several. Defaults to the listings.")
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--duration', type=float, default=10.0, help="Seconds per target.")
+        parser.add_argument('--client-delay', type=float, default=0.0,
+                            help="Seconds each client waits in the middle of sending its request.")
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or DEFAULT_PATHS
+        self.stdout.write(f"{'target':<12}{'requests':>10}{'errors':>8}{'req/s':>10}"
+                          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for target in options['targets']:
+            label, _, url = target.rpartition('=')
+            results = asyncio.run(run_load(url, paths, options['concurrency'], options['duration'],
+                                           options['client_delay']))
+            latencies = sorted(elapsed * 1000 for ok, elapsed in results if ok)
+            errors = sum(1 for ok, _ in results if not ok)
+            self.stdout.write(
+                f"{(label or url)[:11]:<12}{len(results):>10}{errors:>8}"
+                f"{len(latencies) / options['duration']:>10.1f}"
+                f"{statistics.median(latencies) if latencies else 0.0:>10.1f}"
+                f"{percentile(latencies, 0.95):>10.1f}{percentile(latencies, 0.99):>10.1f}")
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from recipes.storage.entity_cache import recipe_cache
+from recipes.storage.read_model import DOCUMENT_BATCH_SIZE, rebuild_documents
+
+
+class Command(BaseCommand):
+    help = ("Re-render every recipe document of the read model from the normalized tables. Run it after "
+            "writing to the tables outside the use cases, e.g. with SQL.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DOCUMENT_BATCH_SIZE,
+                            help="Recipes per transaction.")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        rebuilt = rebuild_documents(options['batch_size'],
+                                    progress=lambda done, total: self.stdout.write(f"{done} documents"))
+        recipe_cache.invalidate()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rebuilt} documents in {time.monotonic() - started:.1f}s."))
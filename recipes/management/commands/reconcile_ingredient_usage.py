@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes.storage.ingredient_usage import reconcile_usage
+
+
+def describe(usage):
+    return "no row" if usage is None else f"{usage[0]} recipes, {usage[1]}"
+
+
+class Command(BaseCommand):
+    help = ("Check the ingredient usage summary against the recipe lines. Mismatches fail the command, "
+            "so it can run from cron; --fix rewrites the rows that differ.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Rewrite the rows that differ.")
+        parser.add_argument('--show', type=int, default=20, help="Mismatches to list.")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        computed, mismatches = reconcile_usage(fix=options['fix'])
+
+        for ingredient_id in sorted(mismatches)[:options['show']]:
+            stored_row, computed_row = mismatches[ingredient_id]
+            self.stdout.write(f"ingredient {ingredient_id}: stored {describe(stored_row)}, "
+                              f"lines say {describe(computed_row)}")
+        summary = (f"{len(computed)} used ingredients, {len(mismatches)} mismatches "
+                   f"({time.monotonic() - started:.1f}s)")
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS(f"{summary}."))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f"{summary}, fixed."))
+        else:
+            raise CommandError(f"{summary}; run with --fix to rewrite them.")
@@ -0,0 +1,112 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+
+from recipes import jobs
+
+
+def init_worker():
+    # Needed with the spawn start method; a no-op for forked workers
+    django.setup()
+
+
+def run_job(job_id):
+    # Long-lived workers drop connections past CONN_MAX_AGE, as requests do
+    close_old_connections()
+    try:
+        return job_id, jobs.run(job_id)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = ("Run the queued background jobs on a pool of processes, polling the jobs table. "
+            "Any number of run_workers, on any number of hosts, can share one queue.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=2,
+                            help="Jobs run at once. With 1 they run in this process, without a pool.")
+        parser.add_argument('--poll', type=float, default=1.0, help="Seconds between polls of an empty queue.")
+        parser.add_argument('--stale-seconds', type=int, default=jobs.STALE_SECONDS,
+                            help="Requeue running jobs whose worker has not sent a heartbeat for this long.")
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError("--concurrency must be positive.")
+        self.options = options
+        self.worker = jobs.worker_name()
+        self.stdout.write(f"{self.worker}: running up to {options['concurrency']} jobs at once")
+        try:
+            if options['concurrency'] == 1:
+                self.run_inline()
+            else:
+                self.run_pool(options['concurrency'])
+        except KeyboardInterrupt:
+            # Interrupted jobs queued themselves again
+            self.stdout.write("Stopped.")
+
+    def run_inline(self):
+        while True:
+            jobs.requeue_stale(self.options['stale_seconds'])
+            job_id = jobs.claim(self.worker)
+            if job_id is None:
+                if self.options['once']:
+                    return
+                time.sleep(self.options['poll'])
+                continue
+            # No pool process to heartbeat for the job: a thread does, a few
+            # times per stale period
+            with jobs.heartbeating([job_id], self.worker, self.options['stale_seconds'] / 3):
+                outcome = run_job(job_id)
+            self.report(*outcome)
+
+    def run_pool(self, concurrency):
+        while not self.serve_pool(concurrency):
+            self.stdout.write(self.style.WARNING("A pool process died; starting a new pool."))
+
+    def serve_pool(self, concurrency):
+        # True once the queue is empty with --once; False if the pool broke
+        in_flight = {}
+        with ProcessPoolExecutor(max_workers=concurrency, initializer=init_worker) as pool:
+            while True:
+                jobs.requeue_stale(self.options['stale_seconds'])
+                # Pool processes only heartbeat when they report progress, so this one does too
+                jobs.heartbeat(list(in_flight.values()), self.worker)
+                while len(in_flight) < concurrency:
+                    job_id = jobs.claim(self.worker)
+                    if job_id is None:
+                        break
+                    # Pool processes may be forked now: they must open their own connections,
+                    # never share the parent's socket
+                    connections.close_all()
+                    in_flight[pool.submit(run_job, job_id)] = job_id
+                if not in_flight:
+                    if self.options['once']:
+                        return True
+                    time.sleep(self.options['poll'])
+                    continue
+                done, _ = wait(in_flight, timeout=self.options['poll'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id = in_flight.pop(future)
+                    try:
+                        self.report(*future.result())
+                    except BrokenProcessPool:
+                        # A process was killed, e.g. out of memory; every job in the pool is lost
+                        jobs.release(jobs.JobModel.objects.filter(id__in=[job_id, *in_flight.values()],
+                                                                  worker=self.worker),
+                                     "The worker process died.")
+                        return False
+                    except Exception as error:
+                        # The job ran, but its outcome could not come back from the process
+                        jobs.finish(job_id, self.worker, error=f"The worker process failed: {error!r}")
+                        self.report(job_id, jobs.JobModel.FAILED)
+                close_old_connections()
+
+    def report(self, job_id, status):
+        style = self.style.SUCCESS if status == jobs.JobModel.SUCCEEDED else self.style.ERROR
+        self.stdout.write(style(f"job {job_id}: {status}"))
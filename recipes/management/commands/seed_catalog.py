@@ -0,0 +1,108 @@
+import random
+import re
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from recipes.storage.entity_cache import ingredient_cache, recipe_cache
+from recipes.storage.ingredient_usage import reconcile_usage
+from recipes.storage.models import IngredientModel, RecipeIngredientModel, RecipeModel
+from recipes.storage.pantry_index import pantry_index
+from recipes.storage.read_model import refresh_documents
+
+ADJECTIVES = ["smoked", "roasted", "spicy", "sweet", "crispy", "braised", "grilled", "fresh", "creamy", "wild",
+              "pickled", "toasted", "salted", "golden", "tangy", "rustic"]
+NOUNS = ["tomato", "garlic", "onion", "lentil", "chickpea", "basil", "pepper", "lemon", "ginger", "mushroom",
+         "potato", "cabbage", "almond", "rice", "cod", "chicken", "paprika", "thyme", "butter", "noodle"]
+DISHES = ["stew", "salad", "soup", "curry", "pie", "risotto", "tart", "gratin", "broth", "skewers", "bake"]
+STEPS = ["chop", "simmer", "whisk", "fold", "roast", "season", "stir", "rest", "blend", "glaze", "serve"]
+
+
+def parse_range(value):
+    # "5..40" or "12"
+    match = re.fullmatch(r"(\d+)(?:\.\.(\d+))?", value)
+    if not match:
+        raise CommandError(f"Invalid range {value!r}, expected N or MIN..MAX")
+    low = int(match[1])
+    high = int(match[2] or low)
+    if low > high:
+        raise CommandError(f"Invalid range {value!r}, MIN is above MAX")
+    return low, high
+
+
+def words(rng, vocabulary, count):
+    return " ".join(rng.choice(vocabulary) for _ in range(count))
+
+
+def pick_ingredients(rng, ingredient_ids, count):
+    # Skewed towards the first ingredients, as real catalogs have staples
+    if count * 2 >= len(ingredient_ids):
+        return rng.sample(ingredient_ids, count)
+    picked = set()
+    while len(picked) < count:
+        picked.add(ingredient_ids[int(len(ingredient_ids) * rng.random() ** 2)])
+    return list(picked)
+
+
+class Command(BaseCommand):
+    help = ("Fill the catalog with a synthetic one. The same --seed and sizes give the same catalog, "
+            "so benchmark runs on different machines or commits compare like for like.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ingredients', type=int, default=2000)
+        parser.add_argument('--recipes', type=int, default=10000)
+        parser.add_argument('--lines-per-recipe', default='5..40', help="N or MIN..MAX ingredient lines.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=1000, help="Recipes per transaction.")
+        parser.add_argument('--clear', action='store_true', help="Delete the current catalog first.")
+
+    def handle(self, *args, **options):
+        low, high = parse_range(options['lines_per_recipe'])
+        if options['ingredients'] < high and options['recipes']:
+            raise CommandError("--ingredients must be at least the largest --lines-per-recipe.")
+        if options['clear']:
+            RecipeIngredientModel.objects.all().delete()
+            RecipeModel.objects.all().delete()
+            IngredientModel.objects.all().delete()
+        elif RecipeModel.objects.exists() or IngredientModel.objects.exists():
+            raise CommandError("The catalog is not empty; pass --clear to replace it.")
+
+        rng = random.Random(options['seed'])
+        started = time.monotonic()
+        with transaction.atomic():
+            ingredient_ids = [ingredient_model.id for ingredient_model in IngredientModel.objects.bulk_create([
+                IngredientModel(name=f"{words(rng, ADJECTIVES, 1)} {words(rng, NOUNS, 1)} {number}",
+                                description=words(rng, ADJECTIVES + NOUNS, 8))
+                for number in range(options['ingredients'])
+            ], batch_size=options['batch_size'])]
+
+        lines = 0
+        for first in range(0, options['recipes'], options['batch_size']):
+            with transaction.atomic():
+                recipe_models = RecipeModel.objects.bulk_create([
+                    RecipeModel(name=f"{words(rng, ADJECTIVES, 1)} {words(rng, NOUNS, 2)} {rng.choice(DISHES)} {number}",
+                                elaboration=". ".join(f"{rng.choice(STEPS)} the {words(rng, NOUNS, 2)}"
+                                                      for _ in range(rng.randint(3, 8))))
+                    for number in range(first, min(first + options['batch_size'], options['recipes']))
+                ])
+                line_models = [
+                    RecipeIngredientModel(recipe_id=recipe_model.id, ingredient_id=ingredient_id,
+                                          quantity=Decimal(rng.randint(1, 50000)) / 100)
+                    for recipe_model in recipe_models
+                    for ingredient_id in pick_ingredients(rng, ingredient_ids, rng.randint(low, high))
+                ]
+                RecipeIngredientModel.objects.bulk_create(line_models, batch_size=5000)
+                refresh_documents(recipe_model.id for recipe_model in recipe_models)
+            lines += len(line_models)
+            self.stdout.write(f"{first + len(recipe_models)} recipes, {lines} lines")
+
+        # Bulk writes skip the usage summary and the per-entity invalidation of the use cases
+        reconcile_usage(fix=True)
+        ingredient_cache.invalidate()
+        recipe_cache.invalidate()
+        pantry_index.invalidate()
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {len(ingredient_ids)} ingredients, {options['recipes']} recipes and {lines} lines "
+            f"in {time.monotonic() - started:.1f}s (seed {options['seed']})."))
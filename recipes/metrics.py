@@ -0,0 +1,256 @@
+# metrics.py
+import contextvars
+import functools
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# name: (type, help, buckets)
+METRICS = {
+    'recipes_http_requests_total': (
+        'counter', "Requests by URL name, method and status.", None),
+    'recipes_http_request_duration_seconds': (
+        'histogram', "Time to build the response, by URL name.", LATENCY_BUCKETS),
+    'recipes_http_request_db_queries': (
+        'histogram', "SQL queries per request, by URL name. A rising mean is an N+1 regression.", QUERY_BUCKETS),
+    'recipes_http_request_db_seconds': (
+        'histogram', "Time spent in SQL queries per request, by URL name.", LATENCY_BUCKETS),
+    'recipes_usecase_duration_seconds': (
+        'histogram', "Duration of use case methods.", LATENCY_BUCKETS),
+}
+
+# [queries, seconds] of the request being served, set by recipes.middleware.MetricsMiddleware
+_request_db = contextvars.ContextVar('recipes_request_db', default=None)
+
+
+class MetricsRegistry:
+    """Counters and histograms of this process, in the families of METRICS.
+
+    With METRICS_DIR set, every process writes its values to its own file
+    there, at most every METRICS_FLUSH_SECONDS, by atomic rename. render()
+    adds up the files of all processes, so /metrics reports the whole
+    deployment whichever worker answers it. Files of exited processes are
+    kept, as counters never go down; empty the directory on deploy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._file = f"{self._pid}-{uuid.uuid4().hex}.json"
+        self._values = {}
+        self._flushed_at = 0.0
+
+    def _series(self, name, labels):
+        # Values inherited over fork belong to the parent process
+        if os.getpid() != self._pid:
+            self._reset()
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self._values:
+            buckets = METRICS[name][2]
+            # Histograms: one count per bucket, then +Inf, then the sum
+            self._values[key] = 0 if buckets is None else [0] * (len(buckets) + 1) + [0.0]
+        return key
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            key = self._series(name, labels)
+            self._values[key] += amount
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            key = self._series(name, labels)
+            series = self._values[key]
+            for index, bound in enumerate(METRICS[name][2]):
+                if value <= bound:
+                    break
+            else:
+                index = -2
+            series[index] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return [[name, dict(labels), value] for (name, labels), value in self._values.items()]
+
+    def flush(self, force=False):
+        directory = getattr(settings, 'METRICS_DIR', None)
+        if not directory:
+            return
+        # Under the lock, so that threads neither flush twice in one interval
+        # nor replace the file with an older snapshot
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._flushed_at < getattr(settings, 'METRICS_FLUSH_SECONDS', 1):
+                return
+            self._flushed_at = now
+            # Not .json, so collect() never reads a partial file
+            handle, temporary = tempfile.mkstemp(dir=directory, prefix=f"{self._file}.", suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'w') as file:
+                    json.dump(self._snapshot(), file)
+                os.replace(temporary, os.path.join(directory, self._file))
+            except BaseException:
+                os.remove(temporary)
+                raise
+
+    def collect(self):
+        # Snapshots of every process, this one's current values included
+        snapshots = [self.snapshot()]
+        directory = getattr(settings, 'METRICS_DIR', None)
+        if directory:
+            for file_name in os.listdir(directory):
+                if not file_name.endswith('.json') or file_name == self._file:
+                    continue
+                try:
+                    with open(os.path.join(directory, file_name)) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    continue
+        totals = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot:
+                if name not in METRICS:
+                    continue
+                key = (name, tuple(sorted(labels.items())))
+                if key not in totals:
+                    totals[key] = value
+                elif isinstance(value, list):
+                    totals[key] = [a + b for a, b in zip(totals[key], value)]
+                else:
+                    totals[key] += value
+        return totals
+
+    def render(self) -> str:
+        totals = self.collect()
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for (series_name, labels), value in sorted(totals.items()):
+                if series_name != name:
+                    continue
+                if buckets is None:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+registry = MetricsRegistry()
+
+
+def start_request():
+    # Returns the [queries, seconds] the request accumulates, and the token to pass to finish_request()
+    totals = [0, 0.0]
+    return totals, _request_db.set(totals)
+
+
+def finish_request(token):
+    _request_db.reset(token)
+
+
+def count_query(execute, sql, params, many, context):
+    totals = _request_db.get()
+    if totals is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        totals[0] += 1
+        totals[1] += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    # The wrapper list lives as long as the DatabaseWrapper, across reconnects
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def timed_use_case(cls):
+    """Times the public methods of a use case class in recipes_usecase_duration_seconds.
+
+    Iterators are timed until exhausted or closed, as that is when their
+    queries run.
+    """
+    for attribute, method in list(vars(cls).items()):
+        if attribute.startswith('_') or not inspect.isfunction(method):
+            continue
+        setattr(cls, attribute, _timed(method, cls.__name__))
+    return cls
+
+
+def _timed(method, use_case):
+    labels = {'use_case': use_case, 'method': method.__name__}
+
+    def record(started):
+        registry.observe('recipes_usecase_duration_seconds', time.perf_counter() - started, **labels)
+
+    if inspect.isasyncgenfunction(method):
+        @functools.wraps(method)
+        async def async_generator_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                async for item in method(*args, **kwargs):
+                    yield item
+            finally:
+                record(started)
+        return async_generator_wrapper
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                yield from method(*args, **kwargs)
+            finally:
+                record(started)
+        return generator_wrapper
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                record(started)
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            record(started)
+    return wrapper
@@ -0,0 +1,169 @@
+# middleware.py
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.urls import Resolver404, resolve
+
+from recipes.core import loaders
+from recipes.metrics import finish_request, registry, start_request
+from recipes.storage.router import pin_to_primary, unpin
+
+PIN_COOKIE = 'recipes_primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def replica_ok(view):
+    # For views that only read but take a body, so are not GET: their
+    # requests are not pinned to the primary and do not pin their client
+    view.replica_ok = True
+    return view
+
+
+class ReplicaPinMiddleware:
+    """Read-your-writes on top of the replica routing of storage/router.py.
+
+    Requests that may write run pinned to the primary. Their response sets a
+    cookie that keeps the client's reads on the primary for the next
+    REPLICA_PIN_SECONDS, long enough for the replicas to catch up. Views
+    marked @replica_ok count as reads whatever their method.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = pin_to_primary(self.pinned(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            unpin(token)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        token = pin_to_primary(self.pinned(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            unpin(token)
+        return self.process_response(request, response)
+
+    def pinned(self, request):
+        if self.writes(request):
+            return True
+        try:
+            return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def writes(self, request):
+        if request.method in SAFE_METHODS:
+            return False
+        # The view is not resolved yet when the pin is set
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            try:
+                match = resolve(request.path_info, getattr(request, 'urlconf', None))
+            except Resolver404:
+                return True
+        return not getattr(match.func, 'replica_ok', False)
+
+    def process_response(self, request, response):
+        if self.writes(request) and response.status_code < 400:
+            seconds = getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+            response.set_cookie(PIN_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True,
+                                samesite='Lax')
+        return response
+
+
+class MetricsMiddleware:
+    """Counts the SQL queries and DB time of each request, see recipes/metrics.py.
+
+    Adds a Server-Timing header (db and total) to the response and records
+    the request under the name of its URL pattern in the registry that
+    /metrics renders. Queries a streaming response runs while it is sent are
+    not counted. Goes first in MIDDLEWARE so the total covers the others.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        db, token = start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            finish_request(token)
+        return self.process_response(request, response, started, db)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        db, token = start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            finish_request(token)
+        return self.process_response(request, response, started, db)
+
+    def process_response(self, request, response, started, db):
+        elapsed = time.perf_counter() - started
+        queries, db_seconds = db
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        registry.inc('recipes_http_requests_total', view=view, method=request.method,
+                     status=str(response.status_code))
+        registry.observe('recipes_http_request_duration_seconds', elapsed, view=view)
+        registry.observe('recipes_http_request_db_queries', queries, view=view)
+        registry.observe('recipes_http_request_db_seconds', db_seconds, view=view)
+        registry.flush()
+        response['Server-Timing'] = (f'db;dur={db_seconds * 1000:.1f};desc="{queries} queries", '
+                                     f'total;dur={elapsed * 1000:.1f}')
+        return response
+
+
+class BatchLoaderMiddleware:
+    """Gives every request its own batch loaders (recipes/core/loaders.py).
+
+    Lookups the use cases make while serving the request are batched and
+    memoized until the response is returned, and never shared with another
+    request.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = loaders.start_request()
+        try:
+            return self.get_response(request)
+        finally:
+            loaders.finish_request(token)
+
+    async def __acall__(self, request):
+        token = loaders.start_request()
+        try:
+            return await self.get_response(request)
+        finally:
+            loaders.finish_request(token)
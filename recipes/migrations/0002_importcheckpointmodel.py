@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpointModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('batch', models.IntegerField()),
+                ('batch_size', models.IntegerField()),
+                ('records', models.IntegerField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='importcheckpointmodel',
+            constraint=models.UniqueConstraint(fields=('source', 'batch'), name='unique_import_checkpoint'),
+        ),
+    ]
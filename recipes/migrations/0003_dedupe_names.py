@@ -0,0 +1,43 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def dedupe_names(apps, schema_editor):
+    # Make the data fit the unique constraints added in 0004.
+    IngredientModel = apps.get_model('recipes', 'IngredientModel')
+    RecipeModel = apps.get_model('recipes', 'RecipeModel')
+    RecipeIngredientModel = apps.get_model('recipes', 'RecipeIngredientModel')
+
+    # Duplicate ingredients are merged into the oldest row with that name
+    duplicated = (IngredientModel.objects.values('name')
+                  .annotate(keep=Min('id'), rows=Count('id')).filter(rows__gt=1))
+    for group in duplicated:
+        duplicates = IngredientModel.objects.filter(name=group['name']).exclude(id=group['keep'])
+        RecipeIngredientModel.objects.filter(ingredient__in=duplicates).update(ingredient_id=group['keep'])
+        duplicates.delete()
+
+    # A recipe keeps only its oldest line per ingredient
+    duplicated = (RecipeIngredientModel.objects.values('recipe', 'ingredient')
+                  .annotate(keep=Min('id'), rows=Count('id')).filter(rows__gt=1))
+    for group in duplicated:
+        RecipeIngredientModel.objects.filter(
+            recipe=group['recipe'], ingredient=group['ingredient']).exclude(id=group['keep']).delete()
+
+    # Recipes cannot be merged, so later duplicates get their id appended
+    duplicated = (RecipeModel.objects.values('name')
+                  .annotate(keep=Min('id'), rows=Count('id')).filter(rows__gt=1))
+    for group in duplicated:
+        for recipe_model in RecipeModel.objects.filter(name=group['name']).exclude(id=group['keep']):
+            recipe_model.name = f"{recipe_model.name[:240]} ({recipe_model.id})"
+            recipe_model.save(update_fields=['name'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0002_importcheckpointmodel'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_names, migrations.RunPython.noop),
+    ]
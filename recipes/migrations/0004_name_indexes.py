@@ -0,0 +1,59 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:07
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+PATTERN_INDEXES = [
+    ('ingredient_name_upper_like', 'recipes_ingredientmodel'),
+    ('recipe_name_upper_like', 'recipes_recipemodel'),
+]
+
+
+def create_pattern_indexes(apps, schema_editor):
+    # text_pattern_ops makes UPPER(name) LIKE 'PREFIX%' (istartswith) index-backed
+    # under any collation; the operator class only exists on PostgreSQL.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for index_name, table in PATTERN_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table}" (UPPER("name") text_pattern_ops)')
+
+
+def drop_pattern_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for index_name, _ in PATTERN_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS "{index_name}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_dedupe_names'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ingredientmodel',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='recipemodel',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='ingredientmodel',
+            index=models.Index(django.db.models.functions.text.Upper('name'), name='ingredient_name_upper'),
+        ),
+        migrations.AddIndex(
+            model_name='recipemodel',
+            index=models.Index(django.db.models.functions.text.Upper('name'), name='recipe_name_upper'),
+        ),
+        migrations.AddConstraint(
+            model_name='recipeingredientmodel',
+            constraint=models.UniqueConstraint(fields=('recipe', 'ingredient'), name='unique_recipe_ingredient'),
+        ),
+        migrations.RunPython(create_pattern_indexes, drop_pattern_indexes),
+    ]
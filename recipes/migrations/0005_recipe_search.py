@@ -0,0 +1,77 @@
+from django.db import migrations
+
+# The search index lives outside the ORM and is maintained by the database
+# itself on every INSERT/UPDATE/DELETE, including bulk_create/bulk_update.
+# On SQLite the triggers belong to recipes_recipemodel: a migration that
+# remakes that table must recreate them.
+
+POSTGRESQL_FORWARD = [
+    """
+    ALTER TABLE recipes_recipemodel ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(elaboration, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX recipe_search_vector ON recipes_recipemodel USING gin (search_vector)",
+]
+
+POSTGRESQL_BACKWARD = [
+    "DROP INDEX IF EXISTS recipe_search_vector",
+    "ALTER TABLE recipes_recipemodel DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE recipes_recipe_fts USING fts5(
+        name, elaboration, content='recipes_recipemodel', content_rowid='id',
+        tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER recipes_recipe_fts_insert AFTER INSERT ON recipes_recipemodel BEGIN
+        INSERT INTO recipes_recipe_fts(rowid, name, elaboration) VALUES (new.id, new.name, new.elaboration);
+    END
+    """,
+    """
+    CREATE TRIGGER recipes_recipe_fts_delete AFTER DELETE ON recipes_recipemodel BEGIN
+        INSERT INTO recipes_recipe_fts(recipes_recipe_fts, rowid, name, elaboration)
+        VALUES ('delete', old.id, old.name, old.elaboration);
+    END
+    """,
+    """
+    CREATE TRIGGER recipes_recipe_fts_update AFTER UPDATE ON recipes_recipemodel BEGIN
+        INSERT INTO recipes_recipe_fts(recipes_recipe_fts, rowid, name, elaboration)
+        VALUES ('delete', old.id, old.name, old.elaboration);
+        INSERT INTO recipes_recipe_fts(rowid, name, elaboration) VALUES (new.id, new.name, new.elaboration);
+    END
+    """,
+    "INSERT INTO recipes_recipe_fts(recipes_recipe_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS recipes_recipe_fts_insert",
+    "DROP TRIGGER IF EXISTS recipes_recipe_fts_delete",
+    "DROP TRIGGER IF EXISTS recipes_recipe_fts_update",
+    "DROP TABLE IF EXISTS recipes_recipe_fts",
+]
+
+
+def run_for_vendor(postgresql, sqlite):
+    def run(apps, schema_editor):
+        statements = {'postgresql': postgresql, 'sqlite': sqlite}.get(schema_editor.connection.vendor, [])
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_name_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_for_vendor(POSTGRESQL_FORWARD, SQLITE_FORWARD),
+                             run_for_vendor(POSTGRESQL_BACKWARD, SQLITE_BACKWARD)),
+    ]
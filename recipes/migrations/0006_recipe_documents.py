@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def render_existing_recipes(apps, schema_editor):
+    # Same documents as recipes/storage/read_model.py, from the historical models
+    RecipeModel = apps.get_model('recipes', 'RecipeModel')
+    RecipeIngredientModel = apps.get_model('recipes', 'RecipeIngredientModel')
+    RecipeDocumentModel = apps.get_model('recipes', 'RecipeDocumentModel')
+    using = schema_editor.connection.alias
+    documents = {
+        recipe_id: {'id': recipe_id, 'name': name, 'elaboration': elaboration, 'ingredients': []}
+        for recipe_id, name, elaboration in RecipeModel.objects.using(using).values_list('id', 'name', 'elaboration')
+    }
+    lines = (RecipeIngredientModel.objects.using(using).order_by('id')
+             .values_list('recipe_id', 'id', 'ingredient__name', 'quantity'))
+    for recipe_id, line_id, name, quantity in lines.iterator():
+        documents[recipe_id]['ingredients'].append({'id': line_id, 'name': name, 'quantity': str(quantity)})
+    RecipeDocumentModel.objects.using(using).bulk_create(
+        [RecipeDocumentModel(recipe_id=recipe_id, name=document['name'], document=document)
+         for recipe_id, document in documents.items()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0005_recipe_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeDocumentModel',
+            fields=[
+                ('recipe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='document', serialize=False, to='recipes.recipemodel')),
+                ('name', models.CharField(db_index=True, max_length=255)),
+                ('document', models.JSONField()),
+            ],
+        ),
+        migrations.RunPython(render_existing_recipes, migrations.RunPython.noop),
+    ]
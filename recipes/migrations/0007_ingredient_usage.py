@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:53
+
+from decimal import Decimal
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import Cast, Round
+
+
+def summarize_existing_lines(apps, schema_editor):
+    # Same totals as recipes/storage/ingredient_usage.py, from the historical models
+    RecipeIngredientModel = apps.get_model('recipes', 'RecipeIngredientModel')
+    IngredientUsageModel = apps.get_model('recipes', 'IngredientUsageModel')
+    using = schema_editor.connection.alias
+    rows = (RecipeIngredientModel.objects.using(using).values('ingredient_id')
+            .annotate(recipes=models.Count('id'),
+                      cents=models.Sum(Cast(Round(models.F('quantity') * 100), models.BigIntegerField())))
+            .values_list('ingredient_id', 'recipes', 'cents'))
+    IngredientUsageModel.objects.using(using).bulk_create(
+        [IngredientUsageModel(ingredient_id=ingredient_id, recipe_count=recipes,
+                              total_quantity=Decimal(cents).scaleb(-2))
+         for ingredient_id, recipes, cents in rows], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_recipe_documents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngredientUsageModel',
+            fields=[
+                ('ingredient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='usage', serialize=False, to='recipes.ingredientmodel')),
+                ('recipe_count', models.IntegerField()),
+                ('total_quantity', models.DecimalField(decimal_places=2, max_digits=14)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-recipe_count', 'ingredient'], name='usage_by_recipe_count'), models.Index(fields=['-total_quantity', 'ingredient'], name='usage_by_total_quantity')],
+            },
+        ),
+        migrations.RunPython(summarize_existing_lines, migrations.RunPython.noop),
+    ]
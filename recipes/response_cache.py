@@ -0,0 +1,108 @@
+# response_cache.py
+import asyncio
+import functools
+import gzip
+import hashlib
+import re
+
+from django.http import HttpResponse, HttpResponseNotModified
+
+from recipes.storage.entity_cache import EntityCache, shared_cache
+
+RESPONSE_CACHE_TTL = 3600
+
+
+def catalog_version(*entity_caches: EntityCache):
+    # Every write path bumps the generation of the entity caches it touches,
+    # so together they version everything a listing can contain.
+    return ".".join(str(entity_cache.generation()) for entity_cache in entity_caches)
+
+
+async def acatalog_version(*entity_caches: EntityCache):
+    return ".".join([str(await entity_cache.ageneration()) for entity_cache in entity_caches])
+
+
+def cached_listing(*entity_caches: EntityCache, bypass=None):
+    """Serve a GET listing view from pre-serialized, pre-compressed bytes.
+
+    Responses are keyed on the path, the query string and the catalog version,
+    and carry a strong ETag. A matching If-None-Match is answered with 304
+    before the view or the ORM runs. Requests for which bypass(request) is
+    true, streaming or non-200 responses, and replica reads the entity caches
+    would not cache (EntityCache.cacheable()) are not cached and get no ETag.
+    Works on sync and async views.
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method != 'GET' or (bypass and bypass(request)):
+                    return await view(request, *args, **kwargs)
+                key = response_key(request, await acatalog_version(*entity_caches))
+                response = not_modified(request, key)
+                if response is not None:
+                    return response
+                entry = await shared_cache().aget(f"recipes:response:{key}")
+                if entry is None:
+                    response = await view(request, *args, **kwargs)
+                    if (response.streaming or response.status_code != 200
+                            or not all([await entity_cache.acacheable() for entity_cache in entity_caches])):
+                        return response
+                    entry = cache_entry(response)
+                    await shared_cache().aset(f"recipes:response:{key}", entry, RESPONSE_CACHE_TTL)
+                return cached_response(request, key, entry)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or (bypass and bypass(request)):
+                return view(request, *args, **kwargs)
+            key = response_key(request, catalog_version(*entity_caches))
+            response = not_modified(request, key)
+            if response is not None:
+                return response
+            entry = shared_cache().get(f"recipes:response:{key}")
+            if entry is None:
+                response = view(request, *args, **kwargs)
+                if (response.streaming or response.status_code != 200
+                        or not all(entity_cache.cacheable() for entity_cache in entity_caches)):
+                    return response
+                entry = cache_entry(response)
+                shared_cache().set(f"recipes:response:{key}", entry, RESPONSE_CACHE_TTL)
+            return cached_response(request, key, entry)
+        return wrapper
+    return decorator
+
+
+def response_key(request, version):
+    query = "&".join(sorted(request.GET.urlencode().split("&")))
+    return hashlib.sha1(f"{request.path}?{query}#{version}".encode()).hexdigest()
+
+
+def not_modified(request, key):
+    # A 304 for a matching If-None-Match, else None
+    if_none_match = request.headers.get('If-None-Match', '')
+    for etag in (f'"{key}"', f'"{key}-gzip"'):
+        if etag in if_none_match:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+    return None
+
+
+def cache_entry(response):
+    return (response['Content-Type'], response.content, gzip.compress(response.content))
+
+
+def cached_response(request, key, entry):
+    content_type, body, compressed = entry
+    if re.search(r'\bgzip\b', request.headers.get('Accept-Encoding', '')):
+        response = HttpResponse(compressed, content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+        response['ETag'] = f'"{key}-gzip"'
+    else:
+        response = HttpResponse(body, content_type=content_type)
+        response['ETag'] = f'"{key}"'
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = 'no-cache'
+    return response
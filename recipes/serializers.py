@@ -0,0 +1,82 @@
+# serializers.py
+from json.encoder import encode_basestring_ascii as quote
+
+# JSON text built straight from the row tuples of the read use cases
+# (see INGREDIENT_ROW and RECIPE_ROW in core/usecases.py), with no model
+# instance, entity or dict per row. The output is what JsonResponse gives
+# for ingredient_to_dict and recipe_to_dict below, Decimal quantities as
+# strings included.
+
+def line_json(line) -> str:
+    line_id, name, quantity = line
+    return f'{{"id": {line_id}, "name": {quote(name)}, "quantity": "{quantity}"}}'
+
+def lines_json(lines) -> str:
+    return f'[{", ".join(map(line_json, lines))}]'
+
+# How each field's value is written; None for ints, which %s writes as is
+INGREDIENT_ENCODERS = {'id': None, 'name': quote, 'description': quote}
+RECIPE_ENCODERS = {'id': None, 'name': quote, 'elaboration': quote, 'ingredients': lines_json}
+
+
+class RowSerializer:
+    """Writes rows holding the values of fields, in that order, as JSON objects."""
+
+    def __init__(self, fields, encoders):
+        self.template = "{" + ", ".join(f'"{field}": %s' for field in fields) + "}"
+        self.encoders = [encoders[field] for field in fields]
+
+    def row(self, row) -> str:
+        return self.template % tuple(
+            value if encode is None else encode(value) for encode, value in zip(self.encoders, row))
+
+    def rows(self, rows):
+        # A page at a time: encoding column by column keeps the loops in C
+        columns = [column if encode is None else map(encode, column)
+                   for encode, column in zip(self.encoders, zip(*rows))]
+        return map(self.template.__mod__, zip(*columns))
+
+
+def ingredient_serializer(fields) -> RowSerializer:
+    return RowSerializer(fields, INGREDIENT_ENCODERS)
+
+def recipe_serializer(fields) -> RowSerializer:
+    return RowSerializer(fields, RECIPE_ENCODERS)
+
+def page_json(rows, serializer, next_cursor) -> bytes:
+    cursor = "null" if next_cursor is None else quote(next_cursor)
+    return f'{{"results": [{", ".join(serializer.rows(rows))}], "next": {cursor}}}'.encode()
+
+
+# Dicts of the entities, for the endpoints that serve entities rather than
+# rows; JsonResponse encodes them
+
+def ingredient_to_dict(ingredient):
+    return {
+        'id': ingredient.id,
+        'name': ingredient.name,
+        'description': ingredient.description,
+    }
+
+def usage_to_dict(usage):
+    return {
+        'id': usage.id,
+        'name': usage.name,
+        'recipes': usage.recipes,
+        'total_quantity': usage.total_quantity,
+    }
+
+def line_to_dict(line):
+    return {
+        'id': line.id,
+        'name': line.name,
+        'quantity': line.quantity,
+    }
+
+def recipe_to_dict(recipe):
+    return {
+        'id': recipe.id,
+        'name': recipe.name,
+        'elaboration': recipe.elaboration,
+        'ingredients': [line_to_dict(line) for line in recipe.ingredients],
+    }
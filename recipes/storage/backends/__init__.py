@@ -0,0 +1 @@
+# Django's database engines with the pool statistics of storage/connection_stats.py
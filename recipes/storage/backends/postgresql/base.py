@@ -0,0 +1,7 @@
+from django.db.backends.postgresql import base
+
+from recipes.storage.connection_stats import InstrumentedConnectionMixin
+
+
+class DatabaseWrapper(InstrumentedConnectionMixin, base.DatabaseWrapper):
+    pass
@@ -0,0 +1,113 @@
+# storage/connection_stats.py
+import threading
+import time
+import weakref
+
+from django.db import connections
+
+_lock = threading.Lock()
+_open = weakref.WeakSet()
+_totals = {}
+
+
+def _record(alias, **amounts):
+    with _lock:
+        totals = _totals.setdefault(alias, {'opened': 0, 'recycled': 0, 'checkouts': 0, 'reused': 0,
+                                            'connect_seconds': 0.0, 'connect_max_seconds': 0.0})
+        for name, amount in amounts.items():
+            if name == 'connect_max_seconds':
+                totals[name] = max(totals[name], amount)
+            else:
+                totals[name] += amount
+
+
+class InstrumentedConnectionMixin:
+    """Records, per process, how the persistent connections of a DatabaseWrapper are used.
+
+    A checkout is a request (or any other unit between two calls of
+    close_if_unusable_or_obsolete(), which Django makes when a request starts
+    and finishes) using the connection; it is reused when the connection was
+    already open. Opening one is what a request waits for when none is.
+    """
+
+    connected_at = None
+    in_use = False
+
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        elapsed = time.perf_counter() - started
+        self.connected_at = time.monotonic()
+        self.in_use = False
+        _record(self.alias, opened=1, connect_seconds=elapsed, connect_max_seconds=elapsed)
+        with _lock:
+            _open.add(self)
+
+    def _cursor(self, name=None):
+        if not self.in_use:
+            reused = self.connection is not None
+            cursor = super()._cursor(name)
+            self.in_use = True
+            _record(self.alias, checkouts=1, reused=int(reused))
+            return cursor
+        return super()._cursor(name)
+
+    def close_if_unusable_or_obsolete(self):
+        was_open = self.connection is not None
+        super().close_if_unusable_or_obsolete()
+        self.in_use = False
+        if was_open and self.connection is None:
+            _record(self.alias, recycled=1)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.connection is None:
+                with _lock:
+                    _open.discard(self)
+
+
+def connection_stats():
+    """Pool utilization, connection age and connection wait per alias, for this process."""
+    now = time.monotonic()
+    with _lock:
+        wrappers = [wrapper for wrapper in _open if wrapper.connection is not None]
+        totals = {alias: dict(values) for alias, values in _totals.items()}
+    stats = {}
+    for alias in connections:
+        settings_dict = connections.settings[alias]
+        open_ = [wrapper for wrapper in wrappers if wrapper.alias == alias]
+        ages = [now - wrapper.connected_at for wrapper in open_]
+        in_use = sum(wrapper.in_use for wrapper in open_)
+        alias_totals = totals.get(alias, {})
+        opened = alias_totals.get('opened', 0)
+        checkouts = alias_totals.get('checkouts', 0)
+        stats[alias] = {
+            'instrumented': isinstance(connections[alias], InstrumentedConnectionMixin),
+            'conn_max_age': settings_dict.get('CONN_MAX_AGE'),
+            'health_checks': settings_dict.get('CONN_HEALTH_CHECKS'),
+            'server_side_cursors': not settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'),
+            'open': len(open_),
+            'in_use': in_use,
+            'utilization': in_use / len(open_) if open_ else 0.0,
+            'age_seconds': {
+                'max': round(max(ages), 3) if ages else 0.0,
+                'mean': round(sum(ages) / len(ages), 3) if ages else 0.0,
+            },
+            'opened': opened,
+            'recycled': alias_totals.get('recycled', 0),
+            'checkouts': checkouts,
+            'reused': alias_totals.get('reused', 0),
+            'reuse_ratio': alias_totals.get('reused', 0) / checkouts if checkouts else 0.0,
+            'connect_ms': {
+                'mean': round(alias_totals.get('connect_seconds', 0.0) / opened * 1000, 3) if opened else 0.0,
+                'max': round(alias_totals.get('connect_max_seconds', 0.0) * 1000, 3),
+            },
+        }
+    return stats
+
+
+def reset_connection_stats():
+    with _lock:
+        _totals.clear()
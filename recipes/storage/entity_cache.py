@@ -0,0 +1,292 @@
+# storage/entity_cache.py
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from recipes.storage.router import reads_replicas
+
+# Stored in place of an entity that does not exist (negative caching)
+MISSING = "recipes.entity_cache.missing"
+
+DEFAULTS = {
+    'ALIAS': 'default',
+    'LOCAL_MAX_ENTRIES': 1024,
+    'TTL': 300,
+    'NEGATIVE_TTL': 30,
+}
+
+
+def options():
+    return dict(DEFAULTS, **getattr(settings, 'RECIPES_CACHE', {}))
+
+
+def shared_cache():
+    return caches[options()['ALIAS']]
+
+
+class EntityCache:
+    """Read-through cache for the entities of the read use cases.
+
+    Two tiers: a bounded in-process LRU, then the Django cache named by
+    RECIPES_CACHE['ALIAS']. Entries are keyed by id and by name. Writes delete
+    the affected keys from the shared tier and bump a generation counter kept
+    in the shared tier. Entries of both tiers carry the generation read before
+    their value was loaded, and entries from an older generation are ignored:
+    a write in any process is never followed by a stale read from another
+    process's LRU, nor from a shared entry set by a reader that loaded the
+    row before the write and stored it after the invalidation. Settings come
+    from RECIPES_CACHE (see DEFAULTS).
+
+    A replica may not have replayed a write yet. For REPLICA_PIN_SECONDS
+    after an invalidation, values loaded by requests that read replicas are
+    returned but not cached, so a lagging replica cannot put the old row, or
+    a miss, back in the cache for every client, the pinned writer included.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(['local_hits', 'shared_hits', 'misses', 'negative_hits', 'evictions'], 0)
+
+    def get(self, kind, key, loader):
+        # kind is 'id' or 'name'; loader() returns the entity or None
+        shared = shared_cache()
+        cache_key = self._key(kind, key)
+        generation = self.generation()
+        hit, value = self._local_get(cache_key, generation)
+        if hit:
+            return self._found(value)
+
+        value = self._current(shared.get(cache_key), generation)
+        if value is not None:
+            self._count('shared_hits')
+        else:
+            self._count('misses')
+            value = self._stored(loader())
+            if not self.cacheable():
+                return self._found(value)
+            shared.set(cache_key, (generation, value), self._ttl(value))
+        self._local_put(cache_key, generation, value)
+        return self._found(value)
+
+    async def aget(self, kind, key, loader):
+        # Same as get() for async callers; loader() returns an awaitable
+        shared = shared_cache()
+        cache_key = self._key(kind, key)
+        generation = await self.ageneration()
+        hit, value = self._local_get(cache_key, generation)
+        if hit:
+            return self._found(value)
+
+        value = self._current(await shared.aget(cache_key), generation)
+        if value is not None:
+            self._count('shared_hits')
+        else:
+            self._count('misses')
+            value = self._stored(await loader())
+            if not await self.acacheable():
+                return self._found(value)
+            await shared.aset(cache_key, (generation, value), self._ttl(value))
+        self._local_put(cache_key, generation, value)
+        return self._found(value)
+
+    def get_many(self, kind, keys, loader):
+        # [entity or None] in the order of keys. loader(missing keys) returns
+        # {key: entity} for those that exist, so a cold set costs one load.
+        shared = shared_cache()
+        generation = self.generation()
+        values, pending = self._local_get_many(kind, keys, generation)
+        if pending:
+            values.update(self._shared_hits(pending, self._current_many(shared.get_many(list(pending)), generation)))
+        if pending:
+            stored = self._loaded(pending, loader(list(pending.values())))
+            if self.cacheable():
+                for ttl, entries in self._by_ttl(stored, generation).items():
+                    shared.set_many(entries, ttl)
+                values.update(self._shared_hits(pending, stored, count=False))
+            else:
+                values.update(self._uncached(stored))
+        return self._many_found(kind, keys, generation, values)
+
+    async def aget_many(self, kind, keys, loader):
+        # Same as get_many() for async callers; loader() returns an awaitable
+        shared = shared_cache()
+        generation = await self.ageneration()
+        values, pending = self._local_get_many(kind, keys, generation)
+        if pending:
+            values.update(self._shared_hits(
+                pending, self._current_many(await shared.aget_many(list(pending)), generation)))
+        if pending:
+            stored = self._loaded(pending, await loader(list(pending.values())))
+            if await self.acacheable():
+                for ttl, entries in self._by_ttl(stored, generation).items():
+                    await shared.aset_many(entries, ttl)
+                values.update(self._shared_hits(pending, stored, count=False))
+            else:
+                values.update(self._uncached(stored))
+        return self._many_found(kind, keys, generation, values)
+
+    def invalidate(self, ids=(), names=()):
+        shared = shared_cache()
+        keys = [self._key('id', key) for key in ids] + [self._key('name', key) for key in names]
+        if keys:
+            shared.delete_many(keys)
+        try:
+            shared.incr(self._generation_key())
+        except ValueError:
+            self.generation()
+        shared.set(self._invalidated_key(), time.time(), None)
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+    def generation(self):
+        # Bumped by every invalidation. A lost counter (cache restart or eviction)
+        # restarts from the clock, never from a value an older entry may carry.
+        shared = shared_cache()
+        generation = shared.get(self._generation_key())
+        if generation is None:
+            shared.add(self._generation_key(), time.time_ns(), None)
+            generation = shared.get(self._generation_key())
+        return generation
+
+    async def ageneration(self):
+        shared = shared_cache()
+        generation = await shared.aget(self._generation_key())
+        if generation is None:
+            await shared.aadd(self._generation_key(), time.time_ns(), None)
+            generation = await shared.aget(self._generation_key())
+        return generation
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, local_entries=len(self._local))
+
+    def _local_get(self, cache_key, generation):
+        with self._lock:
+            entry = self._local.get(cache_key)
+            if entry is None or entry[0] != generation or entry[1] <= time.monotonic():
+                return False, None
+            self._local.move_to_end(cache_key)
+            self._stats['local_hits'] += 1
+            return True, entry[2]
+
+    def _local_put(self, cache_key, generation, value):
+        max_entries = options()['LOCAL_MAX_ENTRIES']
+        with self._lock:
+            self._local[cache_key] = (generation, time.monotonic() + self._ttl(value), value)
+            self._local.move_to_end(cache_key)
+            while len(self._local) > max_entries:
+                self._local.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def _local_get_many(self, kind, keys, generation):
+        # ({cache key: value} from the local tier, {cache key: key} still to find)
+        values, pending = {}, {}
+        for key in keys:
+            cache_key = self._key(kind, key)
+            hit, value = self._local_get(cache_key, generation)
+            if hit:
+                values[cache_key] = (value, True)
+            else:
+                pending[cache_key] = key
+        return values, pending
+
+    def _shared_hits(self, pending, stored, count=True):
+        # Takes the found entries out of pending
+        for cache_key in stored:
+            del pending[cache_key]
+        if count:
+            self._count('shared_hits', len(stored))
+        return {cache_key: (value, False) for cache_key, value in stored.items()}
+
+    def _loaded(self, pending, entities):
+        self._count('misses', len(pending))
+        return {cache_key: self._stored(entities.get(key)) for cache_key, key in pending.items()}
+
+    def _by_ttl(self, stored, generation):
+        # The shared entries to set, grouped by TTL
+        groups = {}
+        for cache_key, value in stored.items():
+            groups.setdefault(self._ttl(value), {})[cache_key] = (generation, value)
+        return groups
+
+    def _current(self, entry, generation):
+        # The value of a shared entry, or None if it is missing, from an older
+        # generation, or an untagged value of an older release
+        if not isinstance(entry, tuple) or entry[0] != generation:
+            return None
+        return entry[1]
+
+    def _current_many(self, entries, generation):
+        return {cache_key: entry[1] for cache_key, entry in entries.items()
+                if self._current(entry, generation) is not None}
+
+    def _uncached(self, stored):
+        # Flagged like local hits, so that they are not put in the local tier
+        return {cache_key: (value, True) for cache_key, value in stored.items()}
+
+    def cacheable(self):
+        # False while values read now may predate the last invalidation, see above
+        if not reads_replicas():
+            return True
+        return self._settled(shared_cache().get(self._invalidated_key()))
+
+    async def acacheable(self):
+        if not reads_replicas():
+            return True
+        return self._settled(await shared_cache().aget(self._invalidated_key()))
+
+    def _settled(self, invalidated_at):
+        # The replicas had REPLICA_PIN_SECONDS to catch up with the last invalidation
+        return invalidated_at is None or time.time() - invalidated_at > getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+
+    def _many_found(self, kind, keys, generation, values):
+        for cache_key, (value, local) in values.items():
+            if not local:
+                self._local_put(cache_key, generation, value)
+        return [self._found(values[self._key(kind, key)][0]) for key in keys]
+
+    def _stored(self, entity):
+        return MISSING if entity is None else entity
+
+    def _ttl(self, value):
+        cache_options = options()
+        return cache_options['NEGATIVE_TTL'] if value == MISSING else cache_options['TTL']
+
+    def _found(self, value):
+        if value == MISSING:
+            self._count('negative_hits')
+            return None
+        # Callers may mutate the entities they get back (UpdateIngredientUseCase does)
+        return copy.deepcopy(value)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _key(self, kind, key):
+        # Names may hold spaces or be long, which memcached keys cannot
+        if kind == 'name':
+            key = hashlib.sha1(str(key).encode()).hexdigest()
+        return f"recipes:{self.namespace}:{kind}:{key}"
+
+    def _generation_key(self):
+        return f"recipes:{self.namespace}:generation"
+
+    def _invalidated_key(self):
+        return f"recipes:{self.namespace}:invalidated_at"
+
+
+ingredient_cache = EntityCache('ingredient')
+recipe_cache = EntityCache('recipe')
@@ -0,0 +1,104 @@
+# storage/ingredient_usage.py
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import BigIntegerField, Count, F, Sum
+from django.db.models.functions import Cast, Round
+
+from recipes.storage.models import IngredientUsageModel, RecipeIngredientModel
+
+# IngredientUsageModel is written in the transaction of every recipe write,
+# as deltas: one upsert that adds to the stored counts, so concurrent writes
+# on the same ingredient never lose an update. Rows that reach zero recipes
+# are deleted.
+
+UPSERT = """
+    INSERT INTO recipes_ingredientusagemodel (ingredient_id, recipe_count, total_quantity)
+    VALUES {values}
+    ON CONFLICT (ingredient_id) DO UPDATE SET
+        recipe_count = recipes_ingredientusagemodel.recipe_count + excluded.recipe_count,
+        total_quantity = recipes_ingredientusagemodel.total_quantity + excluded.total_quantity
+"""
+
+class UsageChanges:
+    """The usage deltas of one write, applied with record_usage().
+
+    add() and remove() take (ingredient_id, quantity) lines of a recipe;
+    change() a line whose quantity went from old to new.
+    """
+
+    def __init__(self):
+        self.deltas = {}
+
+    def add(self, lines):
+        for ingredient_id, quantity in lines:
+            self._apply(ingredient_id, 1, quantity)
+        return self
+
+    def remove(self, lines):
+        for ingredient_id, quantity in lines:
+            self._apply(ingredient_id, -1, -quantity)
+        return self
+
+    def change(self, ingredient_id, old, new):
+        self._apply(ingredient_id, 0, new - old)
+        return self
+
+    def _apply(self, ingredient_id, recipes, quantity):
+        count, total = self.deltas.get(ingredient_id, (0, Decimal(0)))
+        self.deltas[ingredient_id] = (count + recipes, total + quantity)
+
+def record_usage(changes: UsageChanges):
+    # One upsert, plus one delete when an ingredient may have lost its last recipe
+    deltas = {id: delta for id, delta in changes.deltas.items() if delta != (0, 0)}
+    if not deltas:
+        return
+    params = []
+    for ingredient_id, (count, total) in sorted(deltas.items()):
+        params += [ingredient_id, count, str(total)]
+    with connection.cursor() as cursor:
+        cursor.execute(UPSERT.format(values=", ".join(["(%s, %s, %s)"] * len(deltas))), params)
+    emptied = [ingredient_id for ingredient_id, (count, _) in deltas.items() if count < 0]
+    if emptied:
+        IngredientUsageModel.objects.filter(ingredient_id__in=emptied, recipe_count__lte=0).delete()
+
+def computed_usage() -> dict:
+    # {ingredient_id: (recipe_count, total_quantity)} from the lines: the full
+    # GROUP BY that the summary table saves the reads from. Quantities are
+    # summed in hundredths, exactly, as in the shopping list.
+    rows = (RecipeIngredientModel.objects.values('ingredient_id')
+            .annotate(recipes=Count('id'), cents=Sum(Cast(Round(F('quantity') * 100), BigIntegerField())))
+            .values_list('ingredient_id', 'recipes', 'cents'))
+    return {ingredient_id: (recipes, Decimal(cents).scaleb(-2)) for ingredient_id, recipes, cents in rows}
+
+def stored_usage() -> dict:
+    rows = IngredientUsageModel.objects.values_list('ingredient_id', 'recipe_count', 'total_quantity')
+    return {ingredient_id: (count, total) for ingredient_id, count, total in rows}
+
+def usage_mismatches(computed, stored) -> dict:
+    # {ingredient_id: (stored, computed)}, None where a side has no row
+    return {ingredient_id: (stored.get(ingredient_id), computed.get(ingredient_id))
+            for ingredient_id in computed.keys() | stored.keys()
+            if stored.get(ingredient_id) != computed.get(ingredient_id)}
+
+def rebuild_usage(computed, mismatches):
+    # Overwrite the rows of mismatches with the computed values
+    gone = [ingredient_id for ingredient_id in mismatches if ingredient_id not in computed]
+    if gone:
+        IngredientUsageModel.objects.filter(ingredient_id__in=gone).delete()
+    IngredientUsageModel.objects.bulk_create(
+        [IngredientUsageModel(ingredient_id=ingredient_id, recipe_count=computed[ingredient_id][0],
+                              total_quantity=computed[ingredient_id][1])
+         for ingredient_id in mismatches if ingredient_id in computed],
+        update_conflicts=True, unique_fields=['ingredient'], update_fields=['recipe_count', 'total_quantity'],
+        batch_size=1000)
+
+def reconcile_usage(fix=False):
+    # (computed, mismatches) from one snapshot of both sides; with fix, the
+    # rows that differ are rewritten in the same transaction
+    with transaction.atomic():
+        computed = computed_usage()
+        mismatches = usage_mismatches(computed, stored_usage())
+        if fix and mismatches:
+            rebuild_usage(computed, mismatches)
+    return computed, mismatches
@@ -1,15 +1,100 @@
 # storage/models.py
 from django.db import models
+from django.db.models.functions import Upper
+
+# On PostgreSQL, unique CharFields also get a varchar_pattern_ops index, so
+# startswith lookups are index-backed. The UPPER(name) indexes back iexact;
+# migration 0004_name_indexes adds their text_pattern_ops twins for istartswith.
 
 class IngredientModel(models.Model):
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, unique=True)
     description = models.TextField()
 
+    class Meta:
+        indexes = [
+            models.Index(Upper('name'), name='ingredient_name_upper'),
+        ]
+
 class RecipeModel(models.Model):
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, unique=True)
     elaboration = models.TextField()
 
+    class Meta:
+        indexes = [
+            models.Index(Upper('name'), name='recipe_name_upper'),
+        ]
+
 class RecipeIngredientModel(models.Model):
     recipe = models.ForeignKey(RecipeModel, on_delete=models.CASCADE)
     ingredient = models.ForeignKey(IngredientModel, on_delete=models.CASCADE)
     quantity = models.DecimalField(max_digits=5, decimal_places=2)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipe', 'ingredient'], name='unique_recipe_ingredient'),
+        ]
+
+class ImportCheckpointModel(models.Model):
+    # One row per committed batch of an import_catalog run, written in the
+    # same transaction as the batch itself so a restart never imports it twice.
+    source = models.CharField(max_length=255)
+    batch = models.IntegerField()
+    batch_size = models.IntegerField()
+    records = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'batch'], name='unique_import_checkpoint'),
+        ]
+
+class RecipeDocumentModel(models.Model):
+    # Denormalized read model: each recipe with its lines, as the API renders
+    # it, so a read is one row and no JOIN. Written in the transaction of every
+    # write that changes what a recipe renders (storage/read_model.py);
+    # `manage.py rebuild_read_model` regenerates it.
+    recipe = models.OneToOneField(RecipeModel, on_delete=models.CASCADE, primary_key=True, related_name='document')
+    name = models.CharField(max_length=255, db_index=True)
+    document = models.JSONField()
+
+class IngredientUsageModel(models.Model):
+    # How many recipes use an ingredient and their summed quantity, kept up
+    # to date by the recipe writes (storage/ingredient_usage.py). Only used
+    # ingredients have a row: the orphans are the ingredients without one.
+    # `manage.py reconcile_ingredient_usage` checks it against the lines.
+    ingredient = models.OneToOneField(IngredientModel, on_delete=models.CASCADE, primary_key=True,
+                                      related_name='usage')
+    recipe_count = models.IntegerField()
+    total_quantity = models.DecimalField(max_digits=14, decimal_places=2)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-recipe_count', 'ingredient'], name='usage_by_recipe_count'),
+            models.Index(fields=['-total_quantity', 'ingredient'], name='usage_by_total_quantity'),
+        ]
+
+class JobModel(models.Model):
+    # A background job of recipes/jobs.py, run by `manage.py run_workers`.
+    # The table is the queue: workers claim queued rows with a conditional
+    # UPDATE, so no broker is needed.
+    QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+    STATUSES = [(status, status) for status in (QUEUED, RUNNING, SUCCEEDED, FAILED)]
+
+    kind = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED)
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(null=True)
+    result = models.JSONField(null=True)
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    worker = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    heartbeat_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            # The queue scan: the oldest queued jobs, and the running ones for stale checks
+            models.Index(fields=['status', 'id'], name='job_status'),
+        ]
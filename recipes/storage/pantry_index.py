@@ -0,0 +1,172 @@
+# storage/pantry_index.py
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import chain, compress
+from operator import neg, sub
+
+from django.conf import settings
+
+from recipes.storage.models import RecipeIngredientModel
+
+
+class _Postings:
+    # One build of the index: postings and the forward map, changed in place
+    # by the incremental updates
+
+    def __init__(self, postings, recipes):
+        self.postings = postings
+        self.recipes = recipes
+        self.built_at = time.monotonic()
+
+    def match(self, pantry, limit):
+        have = Counter(chain.from_iterable(
+            self.postings[ingredient_id] for ingredient_id in pantry if ingredient_id in self.postings))
+        if not have:
+            return []
+        # Per-candidate work stays in C (map/compress); only the recipes
+        # within the cutoff are ranked in Python.
+        recipe_ids = list(have)
+        matched = list(have.values())
+        missing = list(map(sub, map(len, map(self.recipes.__getitem__, recipe_ids)), matched))
+        seen = 0
+        for cutoff, count in sorted(Counter(missing).items()):
+            seen += count
+            if seen >= limit:
+                break
+        ranked = sorted(compress(zip(missing, map(neg, matched), recipe_ids),
+                                 map(cutoff.__ge__, missing)))[:limit]
+        return [
+            (recipe_id, [ingredient_id for ingredient_id in self.recipes[recipe_id] if ingredient_id not in pantry])
+            for _, _, recipe_id in ranked
+        ]
+
+    def set_recipe(self, recipe_id, ingredient_ids):
+        self.unlink(recipe_id)
+        if ingredient_ids:
+            self.recipes[recipe_id] = ingredient_ids
+            for ingredient_id in ingredient_ids:
+                insort(self.postings.setdefault(ingredient_id, array('q')), recipe_id)
+
+    def unlink(self, recipe_id):
+        for ingredient_id in self.recipes.pop(recipe_id, ()):
+            postings = self.postings[ingredient_id]
+            del postings[bisect_left(postings, recipe_id)]
+            if not postings:
+                del self.postings[ingredient_id]
+
+    def remove_ingredient(self, ingredient_id):
+        for recipe_id in self.postings.pop(ingredient_id, ()):
+            remaining = array('q', (i for i in self.recipes[recipe_id] if i != ingredient_id))
+            if remaining:
+                self.recipes[recipe_id] = remaining
+            else:
+                del self.recipes[recipe_id]
+
+
+class PantryIndex:
+    """In-memory inverted index from ingredient id to the recipes that use it.
+
+    Each worker process holds its own copy. Postings are sorted arrays of
+    recipe ids (8 bytes per entry), and a forward map from recipe to its
+    ingredient ids gives the recipe size and the missing list. The write use
+    cases of this process update it incrementally. Writes made by other
+    processes become visible when the copy is older than PANTRY_INDEX_TTL
+    seconds and is rebuilt.
+
+    A rebuild scans the lines table without holding the lock: one request
+    builds the new copy while the others keep matching on the old one, and
+    the new copy replaces it once the updates made during the scan are
+    replayed on it. Only the very first build makes requests wait.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = threading.Condition(self._lock)
+        self._index = None
+        # While a build runs: the updates to replay on the new copy
+        self._pending = None
+        self._generation = 0
+
+    def match(self, ingredient_ids, limit):
+        # [(recipe_id, missing ingredient ids)] with fully cookable recipes
+        # first, then by fewest missing, then by most matched, then by id.
+        index = self._fresh()
+        with self._lock:
+            return index.match(set(ingredient_ids), limit)
+
+    def update_recipe(self, recipe_id):
+        # Re-read one recipe's lines and replace its postings
+        if self._index is None and self._pending is None:
+            return
+        ingredient_ids = array('q', sorted(
+            RecipeIngredientModel.objects.filter(recipe_id=recipe_id).values_list('ingredient_id', flat=True)))
+        self._update(lambda index: index.set_recipe(recipe_id, ingredient_ids))
+
+    def remove_recipe(self, recipe_id):
+        self._update(lambda index: index.unlink(recipe_id))
+
+    def remove_ingredient(self, ingredient_id):
+        # Deleting an ingredient cascades to every line that uses it
+        self._update(lambda index: index.remove_ingredient(ingredient_id))
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+            # A build running now must not install its copy
+            self._generation += 1
+
+    def _update(self, change):
+        with self._lock:
+            if self._index is not None:
+                change(self._index)
+            if self._pending is not None:
+                self._pending.append(change)
+
+    def _fresh(self) -> _Postings:
+        ttl = getattr(settings, 'PANTRY_INDEX_TTL', 300)
+        with self._built:
+            while True:
+                index = self._index
+                if index is not None and time.monotonic() - index.built_at <= ttl:
+                    return index
+                if self._pending is None:
+                    break
+                if index is not None:
+                    # Another request is rebuilding: the old copy serves meanwhile
+                    return index
+                self._built.wait()
+            self._pending = []
+            generation = self._generation
+        try:
+            index = self._build()
+        except BaseException:
+            with self._built:
+                self._pending = None
+                self._built.notify_all()
+            raise
+        with self._built:
+            # The scan may have read some lines before the updates made meanwhile
+            for change in self._pending:
+                change(index)
+            self._pending = None
+            if generation == self._generation:
+                self._index = index
+            self._built.notify_all()
+        return index
+
+    def _build(self) -> _Postings:
+        postings = {}
+        recipes = {}
+        lines = (RecipeIngredientModel.objects.order_by('recipe_id', 'ingredient_id')
+                 .values_list('recipe_id', 'ingredient_id').iterator(chunk_size=10000))
+        for recipe_id, ingredient_id in lines:
+            # Rows arrive sorted by recipe, so every postings list stays sorted
+            postings.setdefault(ingredient_id, array('q')).append(recipe_id)
+            recipes.setdefault(recipe_id, array('q')).append(ingredient_id)
+        return _Postings(postings, recipes)
+
+
+pantry_index = PantryIndex()
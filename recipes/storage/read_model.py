@@ -0,0 +1,83 @@
+# storage/read_model.py
+from decimal import Decimal
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from recipes.core.entities import Recipe, RecipeLine
+from recipes.storage.models import RecipeDocumentModel, RecipeIngredientModel, RecipeModel
+
+# The documents of RecipeDocumentModel, kept in step with the normalized
+# tables by the write use cases, inside their transactions and on the
+# primary. Quantities are strings, so they keep their two decimals exactly.
+
+DOCUMENT_BATCH_SIZE = 1000
+
+def render_documents(recipe_ids, using=DEFAULT_DB_ALIAS) -> dict:
+    # {recipe_id: document} for the recipes that exist: one query for the
+    # recipes, one for all their lines
+    recipe_ids = set(recipe_ids)
+    documents = {
+        recipe_id: {'id': recipe_id, 'name': name, 'elaboration': elaboration, 'ingredients': []}
+        for recipe_id, name, elaboration in RecipeModel.objects.using(using).filter(
+            id__in=recipe_ids).values_list('id', 'name', 'elaboration')
+    }
+    lines = (RecipeIngredientModel.objects.using(using).filter(recipe_id__in=documents).order_by('id')
+             .values_list('recipe_id', 'id', 'ingredient__name', 'quantity'))
+    for recipe_id, line_id, name, quantity in lines:
+        documents[recipe_id]['ingredients'].append({'id': line_id, 'name': name, 'quantity': str(quantity)})
+    return documents
+
+def document_from_recipe(recipe: Recipe) -> dict:
+    lines = sorted(recipe.ingredients, key=lambda line: line.id)
+    return {'id': recipe.id, 'name': recipe.name, 'elaboration': recipe.elaboration,
+            'ingredients': [{'id': line.id, 'name': line.name, 'quantity': str(line.quantity)} for line in lines]}
+
+def recipe_from_document(document) -> Recipe:
+    return Recipe(name=document['name'], elaboration=document['elaboration'], id=document['id'],
+                  ingredients=[RecipeLine(name=line['name'], quantity=Decimal(line['quantity']), id=line['id'])
+                               for line in document['ingredients']])
+
+def save_documents(recipes):
+    # For writes that already hold the whole recipe: one upsert, no reads
+    _upsert({recipe.id: document_from_recipe(recipe) for recipe in recipes})
+
+def refresh_documents(recipe_ids):
+    # Re-render the documents of recipe_ids; those of deleted recipes go away
+    recipe_ids = set(recipe_ids)
+    if not recipe_ids:
+        return
+    documents = render_documents(recipe_ids)
+    if recipe_ids - documents.keys():
+        RecipeDocumentModel.objects.filter(recipe_id__in=recipe_ids - documents.keys()).delete()
+    _upsert(documents)
+
+def _upsert(documents):
+    if not documents:
+        return
+    RecipeDocumentModel.objects.bulk_create(
+        [RecipeDocumentModel(recipe_id=recipe_id, name=document['name'], document=document)
+         for recipe_id, document in documents.items()],
+        update_conflicts=True, unique_fields=['recipe'], update_fields=['name', 'document'],
+        batch_size=DOCUMENT_BATCH_SIZE)
+
+def rebuild_documents(batch_size=DOCUMENT_BATCH_SIZE, progress=None) -> int:
+    # Every document, in keyset batches of one short transaction each.
+    # progress(rebuilt, total) is called after every batch.
+    total = RecipeModel.objects.count()
+    rebuilt = 0
+    after = 0
+    while True:
+        recipe_ids = list(RecipeModel.objects.filter(id__gt=after).order_by('id')
+                          .values_list('id', flat=True)[:batch_size])
+        if not recipe_ids:
+            return rebuilt
+        with transaction.atomic():
+            refresh_documents(recipe_ids)
+        rebuilt += len(recipe_ids)
+        after = recipe_ids[-1]
+        if progress:
+            progress(rebuilt, max(total, rebuilt))
+
+def recipes_using(ingredient_ids) -> set:
+    return set(RecipeIngredientModel.objects.filter(ingredient_id__in=ingredient_ids)
+               .values_list('recipe_id', flat=True))
@@ -1,11 +1,262 @@
 # storage/repositories.py
-from recipes.core.entities import Ingredient
-from recipes.storage.models import IngredientModel
-
-class IngredientRepositoryImpl:
-    def get_by_name(self, name):
-        try:
-            ingredient_model = IngredientModel.objects.get(name=name)
-            return Ingredient(ingredient_model.name, ingredient_model.description)
-        except IngredientModel.DoesNotExist:
-            return None  # Handle the case when the ingredient is not found
+from decimal import Decimal
+
+from django.db.models import BigIntegerField, Case, F, Sum, Value, When
+from django.db.models.functions import Cast, Round
+
+from recipes.core.entities import Ingredient, Recipe, RecipeLine, ShoppingListItem
+from recipes.core.repositories import IngredientRepository, RecipeLineRepository, RecipeRepository
+from recipes.storage.models import IngredientModel, RecipeDocumentModel, RecipeIngredientModel, RecipeModel
+from recipes.storage.read_model import recipe_from_document
+from recipes.storage.router import aread_alias, read_alias
+
+# Django repositories: one query per call whatever the number of keys, on
+# the database read_alias() picks. Recipes and their lines are read from the
+# same database, in two queries. Recipe lookups by key read the documents of
+# the read model instead, in one query, and fall back to the tables for the
+# recipes that have no document yet.
+
+INGREDIENT_FIELDS = ('id', 'name', 'description')
+RECIPE_FIELDS = ('id', 'name', 'elaboration')
+LINE_FIELDS = ('recipe_id', 'id', 'ingredient__name', 'quantity')
+
+def ingredient_from_row(row) -> Ingredient:
+    id, name, description = row
+    return Ingredient(name=name, description=description, id=id)
+
+def line_rows(recipe_ids, using):
+    # The ingredient name comes from a join, not one query per line
+    return (RecipeIngredientModel.objects.using(using).filter(recipe_id__in=list(recipe_ids))
+            .order_by('id').values_list(*LINE_FIELDS))
+
+def lines_by_recipe(rows) -> dict:
+    # {recipe_id: [(line id, ingredient name, quantity)]} from LINE_FIELDS rows
+    lines = {}
+    for recipe_id, *line in rows:
+        lines.setdefault(recipe_id, []).append(tuple(line))
+    return lines
+
+def group_lines(rows) -> dict:
+    return {recipe_id: [RecipeLine(name=name, quantity=quantity, id=line_id) for line_id, name, quantity in lines]
+            for recipe_id, lines in lines_by_recipe(rows).items()}
+
+def shopping_item_from_row(row) -> ShoppingListItem:
+    id, name, total = row
+    # total is in ten-thousandths: hundredths of quantity times hundredths of servings
+    return ShoppingListItem(name=name, quantity=Decimal(total).scaleb(-4), id=id)
+
+def recipes_from_rows(rows, lines) -> list:
+    return [Recipe(name=name, ingredients=lines.get(id, []), elaboration=elaboration, id=id)
+            for id, name, elaboration in rows]
+
+
+class DjangoIngredientRepository(IngredientRepository):
+    def get_many(self, ids):
+        rows = IngredientModel.objects.using(read_alias()).filter(id__in=list(ids)).values_list(*INGREDIENT_FIELDS)
+        return {row[0]: ingredient_from_row(row) for row in rows}
+
+    def get_by_names(self, names):
+        rows = (IngredientModel.objects.using(read_alias()).filter(name__in=list(names))
+                .values_list(*INGREDIENT_FIELDS))
+        return {row[1]: ingredient_from_row(row) for row in rows}
+
+    def page(self, after=None, limit=None):
+        return [ingredient_from_row(row) for row in self._page(read_alias(), after, limit)]
+
+    async def aget_many(self, ids):
+        rows = (IngredientModel.objects.using(await aread_alias()).filter(id__in=list(ids))
+                .values_list(*INGREDIENT_FIELDS))
+        return {row[0]: ingredient_from_row(row) async for row in rows}
+
+    async def aget_by_names(self, names):
+        rows = (IngredientModel.objects.using(await aread_alias()).filter(name__in=list(names))
+                .values_list(*INGREDIENT_FIELDS))
+        return {row[1]: ingredient_from_row(row) async for row in rows}
+
+    async def apage(self, after=None, limit=None):
+        return [ingredient_from_row(row) async for row in self._page(await aread_alias(), after, limit)]
+
+    def _page(self, using, after, limit):
+        # Seek past the last seen id instead of using OFFSET
+        rows = IngredientModel.objects.using(using).order_by('id').values_list(*INGREDIENT_FIELDS)
+        if after is not None:
+            rows = rows.filter(id__gt=after)
+        return rows[:limit] if limit is not None else rows
+
+
+class DjangoRecipeLineRepository(RecipeLineRepository):
+    # using: the database the recipes were read from, when called by DjangoRecipeRepository
+    def lines_for_recipes(self, recipe_ids, using=None):
+        return group_lines(line_rows(recipe_ids, using or read_alias()))
+
+    async def alines_for_recipes(self, recipe_ids, using=None):
+        return group_lines([row async for row in line_rows(recipe_ids, using or await aread_alias())])
+
+    def shopping_list(self, servings):
+        return [shopping_item_from_row(row) for row in self._totals(servings, read_alias())]
+
+    async def ashopping_list(self, servings):
+        return [shopping_item_from_row(row) async for row in self._totals(servings, await aread_alias())]
+
+    def _totals(self, servings, using):
+        # One GROUP BY over the lines of every recipe. The sum is of integers,
+        # quantity in hundredths times servings in hundredths, so it is exact
+        # on every backend: SQLite would do decimal arithmetic in floats.
+        by_multiplier = {}
+        for recipe_id, multiplier in servings.items():
+            by_multiplier.setdefault(int(multiplier * 100), []).append(recipe_id)
+        # One WHEN per distinct multiplier, not per recipe
+        multiplier = Case(*[When(recipe_id__in=recipe_ids, then=Value(hundredths))
+                            for hundredths, recipe_ids in by_multiplier.items()], output_field=BigIntegerField())
+        # bigint: 999.99 × 1000 servings (ShoppingListUseCase.MAX_SERVINGS) overflows a 32-bit product
+        cents = Cast(Round(F('quantity') * 100), BigIntegerField())
+        return (RecipeIngredientModel.objects.using(using).filter(recipe_id__in=list(servings))
+                .values('ingredient_id', 'ingredient__name')
+                .annotate(total=Sum(cents * multiplier, output_field=BigIntegerField()))
+                .order_by('ingredient__name').values_list('ingredient_id', 'ingredient__name', 'total'))
+
+
+class DjangoRecipeRepository(RecipeRepository):
+    def __init__(self, lines=None):
+        self.lines = lines or DjangoRecipeLineRepository()
+
+    def get_many(self, ids):
+        ids = list(ids)
+        found = self._documents(read_alias(), recipe_id__in=ids)
+        missing = [id for id in ids if id not in found]
+        if missing:
+            found.update((recipe.id, recipe) for recipe in self._read(lambda rows: rows.filter(id__in=missing)))
+        return found
+
+    def get_by_names(self, names):
+        names = list(names)
+        found = {recipe.name: recipe for recipe in self._documents(read_alias(), name__in=names).values()}
+        missing = [name for name in names if name not in found]
+        if missing:
+            found.update((recipe.name, recipe) for recipe in self._read(lambda rows: rows.filter(name__in=missing)))
+        return found
+
+    def page(self, after=None, limit=None):
+        return self._read(lambda rows: self._page(rows, after, limit))
+
+    def names_for(self, ids):
+        return dict(RecipeModel.objects.using(read_alias()).filter(id__in=list(ids)).values_list('id', 'name'))
+
+    async def aget_many(self, ids):
+        ids = list(ids)
+        found = await self._adocuments(await aread_alias(), recipe_id__in=ids)
+        missing = [id for id in ids if id not in found]
+        if missing:
+            found.update((recipe.id, recipe) for recipe in await self._aread(lambda rows: rows.filter(id__in=missing)))
+        return found
+
+    async def aget_by_names(self, names):
+        names = list(names)
+        found = {recipe.name: recipe for recipe in (await self._adocuments(await aread_alias(), name__in=names)).values()}
+        missing = [name for name in names if name not in found]
+        if missing:
+            found.update((recipe.name, recipe)
+                         for recipe in await self._aread(lambda rows: rows.filter(name__in=missing)))
+        return found
+
+    async def apage(self, after=None, limit=None):
+        return await self._aread(lambda rows: self._page(rows, after, limit))
+
+    def _documents(self, using, **lookup):
+        rows = RecipeDocumentModel.objects.using(using).filter(**lookup).values_list('document', flat=True)
+        return {document['id']: recipe_from_document(document) for document in rows}
+
+    async def _adocuments(self, using, **lookup):
+        rows = RecipeDocumentModel.objects.using(using).filter(**lookup).values_list('document', flat=True)
+        return {document['id']: recipe_from_document(document) async for document in rows}
+
+    def _read(self, select):
+        using = read_alias()
+        rows = list(select(RecipeModel.objects.using(using).order_by('id').values_list(*RECIPE_FIELDS)))
+        lines = self.lines.lines_for_recipes([row[0] for row in rows], using=using) if rows else {}
+        return recipes_from_rows(rows, lines)
+
+    async def _aread(self, select):
+        using = await aread_alias()
+        rows = [row async for row in select(RecipeModel.objects.using(using).order_by('id')
+                                            .values_list(*RECIPE_FIELDS))]
+        lines = await self.lines.alines_for_recipes([row[0] for row in rows], using=using) if rows else {}
+        return recipes_from_rows(rows, lines)
+
+    def _page(self, rows, after, limit):
+        if after is not None:
+            rows = rows.filter(id__gt=after)
+        return rows[:limit] if limit is not None else rows
+
+
+class InMemoryIngredientRepository(IngredientRepository):
+    """Ingredients in a dict, for unit tests of the use cases without a database.
+
+    calls records every lookup as (method, keys), so tests can check batching.
+    """
+
+    def __init__(self, ingredients=()):
+        self.ingredients = {ingredient.id: ingredient for ingredient in ingredients}
+        self.calls = []
+
+    def get_many(self, ids):
+        ids = list(ids)
+        self.calls.append(('get_many', ids))
+        return {id: self.ingredients[id] for id in ids if id in self.ingredients}
+
+    def get_by_names(self, names):
+        names = set(names)
+        self.calls.append(('get_by_names', sorted(names)))
+        return {ingredient.name: ingredient for ingredient in self.ingredients.values() if ingredient.name in names}
+
+    def page(self, after=None, limit=None):
+        self.calls.append(('page', [after, limit]))
+        ids = sorted(id for id in self.ingredients if after is None or id > after)
+        return [self.ingredients[id] for id in ids[:limit]]
+
+
+class InMemoryRecipeLineRepository(RecipeLineRepository):
+    def __init__(self, lines=None):
+        # {recipe_id: [RecipeLine]}
+        self.lines = dict(lines or {})
+        self.calls = []
+
+    def lines_for_recipes(self, recipe_ids):
+        recipe_ids = list(recipe_ids)
+        self.calls.append(('lines_for_recipes', recipe_ids))
+        return {recipe_id: list(self.lines[recipe_id]) for recipe_id in recipe_ids if self.lines.get(recipe_id)}
+
+    def shopping_list(self, servings):
+        # RecipeLine has no ingredient id, so items are keyed by name and have none
+        self.calls.append(('shopping_list', dict(servings)))
+        totals = {}
+        for recipe_id, multiplier in servings.items():
+            for line in self.lines.get(recipe_id, ()):
+                totals[line.name] = totals.get(line.name, Decimal(0)) + line.quantity * multiplier
+        return [ShoppingListItem(name=name, quantity=totals[name], id=None) for name in sorted(totals)]
+
+
+class InMemoryRecipeRepository(RecipeRepository):
+    def __init__(self, recipes=()):
+        self.recipes = {recipe.id: recipe for recipe in recipes}
+        self.calls = []
+
+    def get_many(self, ids):
+        ids = list(ids)
+        self.calls.append(('get_many', ids))
+        return {id: self.recipes[id] for id in ids if id in self.recipes}
+
+    def get_by_names(self, names):
+        names = set(names)
+        self.calls.append(('get_by_names', sorted(names)))
+        return {recipe.name: recipe for recipe in self.recipes.values() if recipe.name in names}
+
+    def page(self, after=None, limit=None):
+        self.calls.append(('page', [after, limit]))
+        ids = sorted(id for id in self.recipes if after is None or id > after)
+        return [self.recipes[id] for id in ids[:limit]]
+
+    def names_for(self, ids):
+        ids = list(ids)
+        self.calls.append(('names_for', ids))
+        return {id: self.recipes[id].name for id in ids if id in self.recipes}
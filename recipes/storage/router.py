@@ -0,0 +1,91 @@
+# storage/router.py
+import contextvars
+import itertools
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+# Set for the current request by recipes.middleware.ReplicaPinMiddleware
+_pinned = contextvars.ContextVar('recipes_pinned_to_primary', default=False)
+
+_down_until = {}
+_down_lock = threading.Lock()
+_rotation = itertools.count()
+
+
+def replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+def pin_to_primary(pinned=True):
+    # Returns the token to pass to unpin()
+    return _pinned.set(pinned)
+
+
+def unpin(token):
+    _pinned.reset(token)
+
+
+def read_alias():
+    """The database the read use cases query.
+
+    A replica from DATABASE_REPLICAS, in turn, unless the current request is
+    pinned to the primary: it writes, or its client wrote recently. A
+    replica that cannot be connected to is skipped for REPLICA_RETRY_SECONDS;
+    with none left, reads go to the primary. Other reads, and every write,
+    stay on the primary (see ReplicaRouter).
+    """
+    aliases = replicas()
+    if not aliases or _pinned.get():
+        return DEFAULT_DB_ALIAS
+    start = next(_rotation)
+    for offset in range(len(aliases)):
+        alias = aliases[(start + offset) % len(aliases)]
+        if _available(alias):
+            return alias
+    return DEFAULT_DB_ALIAS
+
+
+def reads_replicas():
+    # Whether read_alias() picks among replicas for the current request
+    return bool(replicas()) and not _pinned.get()
+
+
+async def aread_alias():
+    # Checking a connection is blocking I/O, so it runs in the thread the async ORM uses
+    if not replicas() or _pinned.get():
+        return DEFAULT_DB_ALIAS
+    return await sync_to_async(read_alias)()
+
+
+def _available(alias):
+    if _down_until.get(alias, 0) > time.monotonic():
+        return False
+    try:
+        connections[alias].ensure_connection()
+        return True
+    except DatabaseError:
+        with _down_lock:
+            _down_until[alias] = time.monotonic() + getattr(settings, 'REPLICA_RETRY_SECONDS', 30)
+        return False
+
+
+class ReplicaRouter:
+    """Keeps every write, and every read not routed by read_alias(), on the primary."""
+
+    def db_for_read(self, model, **hints):
+        # None lets Django use the database of the instance a related lookup
+        # starts from, so the lines prefetch follows its recipes to the replica.
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
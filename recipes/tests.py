@@ -1,3 +1,1466 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.models import Count
+from django.db.models.functions import Upper
+from django.db.utils import load_backend
+from django.http import JsonResponse
+from django.test import AsyncClient, Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from recipes.core import loaders
+from recipes.core.entities import Ingredient, Recipe, RecipeLine
+from recipes.core.repositories import IngredientRepository
+from recipes.core.usecases import (INGREDIENT_ROW, RECIPE_ROW, DeleteIngredientUseCase, DeleteRecipeUseCase,
+                                   ImportCatalogUseCase, ReadIngredientUseCase, ReadRecipeUseCase, ShoppingListUseCase,
+                                   UpdateRecipeUseCase)
+from recipes.serializers import ingredient_serializer, ingredient_to_dict, page_json, recipe_serializer, recipe_to_dict
+from recipes.views import encode_cursor
+from recipes.storage.models import (IngredientModel, RecipeModel, RecipeIngredientModel, ImportCheckpointModel,
+                                    RecipeDocumentModel, IngredientUsageModel, JobModel)
+from recipes.storage.entity_cache import EntityCache, ingredient_cache, recipe_cache
+from recipes.storage.repositories import (DjangoRecipeRepository, InMemoryIngredientRepository,
+                                          InMemoryRecipeLineRepository, InMemoryRecipeRepository)
+from recipes.storage.pantry_index import pantry_index
+from recipes.storage.read_model import refresh_documents, render_documents
+from recipes.storage import router
+from recipes.storage.connection_stats import reset_connection_stats
+from recipes import jobs, urls as recipe_urls
+from recipes.management.commands.benchmark_routes import HttpTransport, compare
+from recipes.metrics import registry
+from recipes.middleware import PIN_COOKIE
+
+
+@override_settings(DATABASE_REPLICAS=[])
+class RecipesTestCase(TestCase):
+    """Resets the per-process caches and indexes, which outlive test transactions.
+
+    Reads stay on 'default' unless a test class routes them to a replica.
+    """
+
+    def setUp(self):
+        cache.clear()
+        for entity_cache in (ingredient_cache, recipe_cache):
+            entity_cache.clear_local()
+        pantry_index.invalidate()
+
+
+def make_catalog(recipes=3, lines_per_recipe=3):
+    ingredients = [
+        IngredientModel.objects.get_or_create(name=f"ingredient {i}", defaults={'description': f"description {i}"})[0]
+        for i in range(lines_per_recipe)
+    ]
+    recipe_models = []
+    offset = RecipeModel.objects.count()
+    for r in range(offset, offset + recipes):
+        recipe_model = RecipeModel.objects.create(name=f"recipe {r}", elaboration=f"elaboration {r}")
+        for ingredient_model in ingredients:
+            RecipeIngredientModel.objects.create(recipe=recipe_model, ingredient=ingredient_model,
+                                                 quantity=Decimal("1.50"))
+        recipe_models.append(recipe_model)
+    refresh_documents(recipe_model.id for recipe_model in recipe_models)
+    return ingredients, recipe_models
+
+
+def staff_session():
+    # The session key of a staff user, for the views that require one
+    client = Client()
+    client.force_login(User.objects.create_user('staff', is_staff=True))
+    return client.cookies[settings.SESSION_COOKIE_NAME].value
+
+
+class ReadQueryBudgetTests(RecipesTestCase):
+    """Each read endpoint runs a fixed number of queries whatever the catalog size."""
+
+    def assertBudget(self, url, queries):
+        with self.assertNumQueries(queries):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_get_all_recipes_budget_is_constant(self):
+        make_catalog(recipes=2, lines_per_recipe=2)
+        self.assertBudget(reverse('get-all-recipes'), 2)
+        make_catalog(recipes=20, lines_per_recipe=5)
+        cache.clear()  # make_catalog writes through the ORM, not the write paths
+        response = self.assertBudget(reverse('get-all-recipes'), 2)
+        self.assertEqual(len(response.json()['results']), 22)
+
+    def test_get_recipe_by_id_budget(self):
+        _, recipe_models = make_catalog(recipes=1, lines_per_recipe=10)
+        response = self.assertBudget(reverse('get-recipe-by-id', args=[recipe_models[0].id]), 1)
+        self.assertEqual(len(response.json()['ingredients']), 10)
+
+    def test_get_recipe_by_name_budget(self):
+        make_catalog(recipes=1, lines_per_recipe=10)
+        response = self.assertBudget(reverse('get-recipe-by-name', args=["recipe 0"]), 1)
+        self.assertEqual(response.json()['ingredients'][0]['name'], "ingredient 0")
+
+    def test_ingredient_read_budgets(self):
+        ingredients, _ = make_catalog(recipes=1, lines_per_recipe=5)
+        self.assertBudget(reverse('get-all-ingredients'), 1)
+        self.assertBudget(reverse('get-ingredient-by-id', args=[ingredients[0].id]), 1)
+        self.assertBudget(reverse('get-ingredient', args=["ingredient 0"]), 1)
+
+
+class KeysetPaginationTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        make_catalog(recipes=5, lines_per_recipe=2)
+
+    def walk(self, url, limit):
+        pages = []
+        response = self.client.get(url, {'limit': limit})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            pages.append([item['id'] for item in body['results']])
+            if not body['next']:
+                return pages
+            response = self.client.get(url, {'limit': limit, 'cursor': body['next']})
+
+    def test_recipe_pages_follow_cursor(self):
+        pages = self.walk(reverse('get-all-recipes'), 2)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        ids = [recipe_id for page in pages for recipe_id in page]
+        self.assertEqual(ids, sorted(ids))
+
+    def test_ingredient_after_id(self):
+        first = IngredientModel.objects.order_by('id').first()
+        response = self.client.get(reverse('get-all-ingredients'), {'after': first.id})
+        self.assertEqual(len(response.json()['results']), 1)
+        self.assertIsNone(response.json()['next'])
+
+    def test_deep_page_query_budget(self):
+        last = RecipeModel.objects.order_by('id').last()
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('get-all-recipes'), {'after': last.id})
+        self.assertEqual(response.json()['results'], [])
+
+    def test_limit_is_capped(self):
+        with mock.patch('recipes.views.MAX_PAGE_SIZE', 3):
+            response = self.client.get(reverse('get-all-recipes'), {'limit': 1000})
+        self.assertEqual(len(response.json()['results']), 3)
+
+    def test_invalid_parameters(self):
+        for params in ({'limit': 0}, {'after': 'x'}, {'cursor': 'not-a-cursor'}):
+            response = self.client.get(reverse('get-all-ingredients'), params)
+            self.assertEqual(response.status_code, 400)
+
+
+class StreamingListingTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        make_catalog(recipes=3, lines_per_recipe=2)
+
+    def read_stream(self, response):
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_recipes_stream_as_json_array(self):
+        response = self.client.get(reverse('get-all-recipes'), {'stream': 1})
+        recipes = json.loads(self.read_stream(response))
+        self.assertEqual(len(recipes), 3)
+        self.assertEqual(recipes[0]['ingredients'][0]['quantity'], "1.50")
+
+    def test_ingredients_stream_as_ndjson(self):
+        response = self.client.get(reverse('get-all-ingredients'), HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = self.read_stream(response).splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ["ingredient 0", "ingredient 1"])
+
+    def test_empty_stream_is_valid_json(self):
+        IngredientModel.objects.all().delete()
+        response = self.client.get(reverse('get-all-ingredients'), {'stream': 1})
+        self.assertEqual(json.loads(self.read_stream(response)), [])
+
+
+class BulkIngredientTests(RecipesTestCase):
+    def post(self, body, content_type='application/json', **params):
+        url = reverse('bulk-create-ingredients')
+        if params:
+            url += '?' + '&'.join(f'{key}={value}' for key, value in params.items())
+        return self.client.post(url, body, content_type=content_type)
+
+    def test_json_array_creates_in_one_insert(self):
+        items = [{'name': f'salt {i}', 'description': 'fine'} for i in range(50)]
+        with self.assertNumQueries(3):  # savepoint, INSERT, release
+            response = self.post(json.dumps(items))
+        self.assertEqual(response.status_code, 201)
+        results = response.json()['results']
+        self.assertEqual(len(results), 50)
+        self.assertTrue(all(result['status'] == 'created' and result['id'] for result in results))
+        self.assertEqual(IngredientModel.objects.count(), 50)
+
+    def test_ndjson_upsert_updates_by_name(self):
+        IngredientModel.objects.create(name='pepper', description='old')
+        body = '{"name": "pepper", "description": "new"}\n{"name": "cumin", "description": "seeds"}\n'
+        response = self.post(body, content_type='application/x-ndjson', upsert=1)
+        statuses = {result['name']: result['status'] for result in response.json()['results']}
+        self.assertEqual(statuses, {'pepper': 'updated', 'cumin': 'created'})
+        self.assertEqual(IngredientModel.objects.get(name='pepper').description, 'new')
+        self.assertEqual(IngredientModel.objects.count(), 2)
+
+    def test_upsert_is_one_insert_per_batch(self):
+        IngredientModel.objects.create(name='pepper', description='old')
+        items = [{'name': 'pepper', 'description': 'new'}, {'name': 'cumin'}, {'name': 'cumin', 'description': 'seeds'}]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(json.dumps(items), upsert=1)
+        self.assertEqual(response.status_code, 201)
+        writes = [query['sql'] for query in queries if query['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len(writes), 1)
+        self.assertIn('ON CONFLICT', writes[0])
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['updated', 'created', 'created'])
+        self.assertEqual(results[1]['id'], results[2]['id'])
+        self.assertEqual(dict(IngredientModel.objects.values_list('name', 'description')),
+                         {'pepper': 'new', 'cumin': 'seeds'})
+
+    def test_invalid_item_writes_nothing(self):
+        response = self.post(json.dumps([{'name': 'ok'}, {'description': 'no name'}]))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(IngredientModel.objects.exists())
+
+    def test_duplicate_name_without_upsert_conflicts(self):
+        IngredientModel.objects.create(name='pepper', description='old')
+        response = self.post(json.dumps([{'name': 'salt'}, {'name': 'pepper'}]))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(IngredientModel.objects.count(), 1)
+
+
+class ImportCatalogCommandTests(RecipesTestCase):
+    def write_catalog(self, suffix, content):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, 'w') as catalog:
+            catalog.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def import_catalog(self, path, **options):
+        call_command('import_catalog', path, stdout=StringIO(), **options)
+
+    def test_ndjson_import_reuses_and_creates_ingredients(self):
+        IngredientModel.objects.create(name='flour', description='wheat')
+        path = self.write_catalog('.ndjson', "".join(
+            json.dumps({'name': f'bread {i}', 'elaboration': 'bake',
+                        'ingredients': [{'name': 'flour', 'quantity': 2.5}, {'name': 'yeast', 'quantity': '0.10'}]})
+            + "\n"
+            for i in range(5)))
+        self.import_catalog(path, batch_size=2)
+        self.assertEqual(RecipeModel.objects.count(), 5)
+        self.assertEqual(RecipeIngredientModel.objects.count(), 10)
+        self.assertEqual(IngredientModel.objects.count(), 2)
+        self.assertEqual(ImportCheckpointModel.objects.count(), 3)
+        self.assertEqual(RecipeIngredientModel.objects.filter(ingredient__name='flour').first().quantity,
+                         Decimal('2.50'))
+
+    def test_csv_import_resumes_after_last_committed_batch(self):
+        path = self.write_catalog('.csv', "recipe,elaboration,ingredient,quantity\n"
+                                          "soup,boil,water,1\nsoup,boil,salt,0.5\n"
+                                          "stew,simmer,water,2\n")
+        ImportCheckpointModel.objects.create(source=os.path.abspath(path), batch=0, batch_size=1, records=1)
+        self.import_catalog(path, batch_size=1)
+        self.assertEqual(list(RecipeModel.objects.values_list('name', flat=True)), ['stew'])
+        self.import_catalog(path, batch_size=1)
+        self.assertEqual(RecipeModel.objects.count(), 1)
+
+    def test_existing_and_repeated_recipe_names_are_skipped(self):
+        RecipeModel.objects.create(name='soup', elaboration='old')
+        path = self.write_catalog('.ndjson', "".join(
+            json.dumps({'name': name, 'ingredients': [{'name': 'water', 'quantity': 1}]}) + "\n"
+            for name in ('soup', 'stew', 'stew')))
+        self.import_catalog(path)
+        self.assertEqual(sorted(RecipeModel.objects.values_list('name', flat=True)), ['soup', 'stew'])
+        self.assertEqual(RecipeModel.objects.get(name='soup').elaboration, 'old')
+
+    def test_bad_record_stops_the_import_before_any_batch(self):
+        records = [{'name': f'soup {i}', 'ingredients': [{'name': 'water', 'quantity': 1}]} for i in range(5)]
+        for bad, message in (({'name': 'stew', 'ingredients': [{'name': 'water'}]},
+                              "Record 3: ingredient 0 quantity None is not a number"),
+                             ({'name': 'stew', 'ingredients': [{'name': 'water', 'quantity': 5000}]},
+                              "Record 3: ingredient 0 quantity 5000.00 is over 999.99"),
+                             ({'ingredients': []}, "Record 3: name is missing"),
+                             ([], "Record 3: not an object")):
+            with self.subTest(message=message):
+                path = self.write_catalog('.ndjson', "".join(
+                    json.dumps(record) + "\n" for record in records[:3] + [bad] + records[3:]))
+                with self.assertRaisesMessage(CommandError, message):
+                    self.import_catalog(path, batch_size=2)
+                self.assertFalse(RecipeModel.objects.exists())
+        path = self.write_catalog('.ndjson', json.dumps(records[0]) + "\n\n{not json\n")
+        with self.assertRaisesMessage(CommandError, "Record 1: invalid JSON"):
+            self.import_catalog(path)
+
+    def test_import_batch_reports_the_index_in_the_catalog(self):
+        with self.assertRaisesMessage(ValueError, "Record 7: ingredients is not a list"):
+            ImportCatalogUseCase().import_batch([{'name': 'soup', 'ingredients': []}, {'name': 'stew'}],
+                                                'test', batch=3, batch_size=2)
+        self.assertFalse(ImportCheckpointModel.objects.exists())
+
+
+class NameIndexTests(RecipesTestCase):
+    """By-name lookups are answered from an index, not a table scan."""
+
+    def assertUsesIndex(self, queryset, indexes):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Tiny test tables would otherwise always be scanned sequentially
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = queryset.explain()
+        self.assertTrue(indexes, "no index to look for")
+        self.assertTrue(any(index in plan for index in indexes), plan)
+
+    def indexes_on(self, model, *columns):
+        # The indexes over exactly these columns. SQLite backs unique
+        # constraints with sqlite_autoindex_* indexes, which introspection does
+        # not list; on PostgreSQL they are named after the constraint.
+        table = model._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'PRAGMA index_list("{table}")')
+                names = [row[1] for row in cursor.fetchall()]
+                found = []
+                for name in names:
+                    cursor.execute(f'PRAGMA index_info("{name}")')
+                    if tuple(row[2] for row in cursor.fetchall()) == columns:
+                        found.append(name)
+                return found
+            constraints = connection.introspection.get_constraints(cursor, table)
+        return [name for name, constraint in constraints.items()
+                if tuple(constraint['columns']) == columns and not constraint['primary_key']]
+
+    def test_ingredient_name_lookup(self):
+        self.assertUsesIndex(IngredientModel.objects.filter(name="salt"), self.indexes_on(IngredientModel, 'name'))
+
+    def test_recipe_name_lookup(self):
+        self.assertUsesIndex(RecipeModel.objects.filter(name="soup"), self.indexes_on(RecipeModel, 'name'))
+
+    def test_case_insensitive_name_lookup(self):
+        # Created by migration 0004_name_indexes, with their _like twins on PostgreSQL
+        self.assertUsesIndex(IngredientModel.objects.annotate(upper_name=Upper('name')).filter(upper_name="SALT"),
+                             ['ingredient_name_upper'])
+        self.assertUsesIndex(RecipeModel.objects.annotate(upper_name=Upper('name')).filter(upper_name="SOUP"),
+                             ['recipe_name_upper'])
+
+    def test_recipe_lines_lookup(self):
+        self.assertUsesIndex(RecipeIngredientModel.objects.filter(recipe_id=1, ingredient_id=1),
+                             self.indexes_on(RecipeIngredientModel, 'recipe_id', 'ingredient_id'))
+
+    def test_name_is_unique(self):
+        IngredientModel.objects.create(name="salt", description="")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            IngredientModel.objects.create(name="salt", description="again")
+
+
+class RecipeSearchTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        RecipeModel.objects.create(name="Tomato soup", elaboration="Simmer the tomatoes with garlic.")
+        RecipeModel.objects.create(name="Garlic bread", elaboration="Toast bread with butter.")
+        RecipeModel.objects.create(name="Pancakes", elaboration="Whisk flour, eggs and milk.")
+
+    def search(self, **params):
+        response = self.client.get(reverse('search-recipes'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_name_matches_rank_above_elaboration_matches(self):
+        results = self.search(q="garlic")['results']
+        self.assertEqual([result['name'] for result in results], ["Garlic bread", "Tomato soup"])
+        self.assertEqual(set(results[0]), {'id', 'name', 'rank'})
+
+    def test_index_follows_writes(self):
+        recipe_model = RecipeModel.objects.get(name="Pancakes")
+        recipe_model.elaboration = "Whisk buttermilk and eggs."
+        recipe_model.save()
+        self.assertEqual(self.search(q="buttermilk")['results'][0]['name'], "Pancakes")
+        self.assertEqual(self.search(q="flour")['results'], [])
+        recipe_model.delete()
+        self.assertEqual(self.search(q="eggs")['results'], [])
+
+    def test_results_are_paginated(self):
+        first = self.search(q="garlic", limit=1)
+        second = self.search(q="garlic", limit=1, cursor=first['next'])
+        self.assertEqual(second['results'][0]['name'], "Tomato soup")
+        self.assertIsNone(second['next'])
+
+    def test_negative_offset_is_rejected(self):
+        response = self.client.get(reverse('search-recipes'), {'q': "garlic", 'cursor': encode_cursor(-1, kind="offset")})
+        self.assertEqual(response.status_code, 400)
+
+    def test_operators_in_query_are_literal(self):
+        self.assertEqual(self.search(q='"garlic (bread')['results'][0]['name'], "Garlic bread")
+        response = self.client.get(reverse('search-recipes'), {'q': ' '})
+        self.assertEqual(response.status_code, 400)
+
+
+class PantryMatchTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        names = ['flour', 'eggs', 'milk', 'sugar', 'salt']
+        self.ingredients = {name: IngredientModel.objects.create(name=name, description='') for name in names}
+        self.recipes = {}
+        for recipe_name, ingredient_names in [('pancakes', ['flour', 'eggs', 'milk']),
+                                              ('omelette', ['eggs', 'salt']),
+                                              ('cake', ['flour', 'eggs', 'milk', 'sugar'])]:
+            recipe_model = RecipeModel.objects.create(name=recipe_name, elaboration='')
+            for name in ingredient_names:
+                RecipeIngredientModel.objects.create(recipe=recipe_model, ingredient=self.ingredients[name],
+                                                     quantity=Decimal('1'))
+            self.recipes[recipe_name] = recipe_model
+
+    def match(self, **params):
+        response = self.client.get(reverse('pantry-match'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_cookable_first_then_fewest_missing(self):
+        results = self.match(names='flour,eggs,milk')
+        self.assertEqual([result['name'] for result in results], ['pancakes', 'cake', 'omelette'])
+        self.assertTrue(results[0]['cookable'])
+        self.assertEqual(results[1]['missing'], [{'id': self.ingredients['sugar'].id, 'name': 'sugar'}])
+
+    def test_ids_and_limit(self):
+        results = self.match(ids=f"{self.ingredients['eggs'].id},{self.ingredients['salt'].id}", limit=1)
+        self.assertEqual([result['name'] for result in results], ['omelette'])
+
+    def test_index_follows_recipe_writes(self):
+        self.match(names='salt')
+        with self.captureOnCommitCallbacks(execute=True):
+            DeleteRecipeUseCase().delete(self.recipes['omelette'].id)
+        self.assertEqual(self.match(names='salt'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            DeleteIngredientUseCase().delete(self.ingredients['sugar'].id)
+        with self.assertNumQueries(2):  # names in, recipe names out; no rebuild
+            results = self.match(names='flour,eggs,milk')
+        self.assertEqual([result['name'] for result in results if result['cookable']], ['pancakes', 'cake'])
+
+
+    def test_rebuild_does_not_block_matches(self):
+        salt, eggs = self.ingredients['salt'].id, self.ingredients['eggs'].id
+        omelette = self.recipes['omelette'].id
+        self.assertEqual(pantry_index.match([salt], 5), [(omelette, [eggs])])
+        scanning, scanned = threading.Event(), threading.Event()
+        build = pantry_index._build
+
+        def slow_build():
+            scanning.set()
+            scanned.wait(5)
+            return postings
+
+        # The test data is only visible to this thread's connection, so the scan runs here
+        postings = build()
+        with override_settings(PANTRY_INDEX_TTL=0), mock.patch.object(pantry_index, '_build', slow_build):
+            rebuild = threading.Thread(target=pantry_index.match, args=([salt], 5))
+            rebuild.start()
+            self.assertTrue(scanning.wait(5))
+            # The old copy answers while the scan runs, and takes the updates made meanwhile
+            self.assertEqual(pantry_index.match([salt], 5), [(omelette, [eggs])])
+            pantry_index.remove_recipe(omelette)
+            self.assertEqual(pantry_index.match([salt], 5), [])
+            scanned.set()
+            rebuild.join(5)
+        # The new copy replaced it, with the update replayed
+        self.assertIs(pantry_index._index, postings)
+        self.assertEqual(pantry_index.match([salt], 5), [])
+
+
+class EntityCacheTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingredients, self.recipe_models = make_catalog(recipes=1, lines_per_recipe=2)
+
+    def test_repeated_reads_skip_the_database(self):
+        url = reverse('get-recipe-by-id', args=[self.recipe_models[0].id])
+        before = recipe_cache.stats()
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        recipe_cache.clear_local()
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        after = recipe_cache.stats()
+        self.assertEqual([after[name] - before[name] for name in ('misses', 'local_hits', 'shared_hits')],
+                         [1, 1, 1])
+
+    def test_a_load_that_races_an_invalidation_is_not_cached(self):
+        entity_cache = EntityCache(f"test-{self.id()}")
+
+        def racing_load(keys=None):
+            # The writer commits and invalidates while the pre-write row is being read
+            entity_cache.invalidate(ids=[1, 2])
+            return {key: 'stale' for key in keys} if keys else 'stale'
+
+        self.assertEqual(entity_cache.get('id', 1, racing_load), 'stale')
+        entity_cache.clear_local()  # as another process, with only the shared tier
+        self.assertEqual(entity_cache.get('id', 1, lambda: 'fresh'), 'fresh')
+        self.assertEqual(entity_cache.get_many('id', [2], racing_load), ['stale'])
+        entity_cache.clear_local()
+        self.assertEqual(entity_cache.get_many('id', [2], lambda keys: {2: 'fresh'}), ['fresh'])
+
+    def test_misses_are_cached(self):
+        url = reverse('get-ingredient', args=["saffron"])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, 404)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('ingredient-crud'), {'name': 'saffron', 'description': 'red'},
+                             content_type='application/json')
+        self.assertEqual(self.client.get(url).json()['description'], 'red')
+
+    def test_ingredient_rename_reaches_cached_recipes(self):
+        url = reverse('get-recipe-by-name', args=["recipe 0"])
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(reverse('update-ingredient', args=[self.ingredients[0].id]),
+                            {'new_name': 'renamed', 'new_description': ''}, content_type='application/json')
+        names = [line['name'] for line in self.client.get(url).json()['ingredients']]
+        self.assertIn('renamed', names)
+
+    def test_delete_invalidates(self):
+        url = reverse('get-recipe-by-id', args=[self.recipe_models[0].id])
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('delete-recipe', args=[self.recipe_models[0].id]))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_local_tier_is_bounded(self):
+        evictions = ingredient_cache.stats()['evictions']
+        with self.settings(RECIPES_CACHE={'LOCAL_MAX_ENTRIES': 1}):
+            for ingredient_model in self.ingredients:
+                self.client.get(reverse('get-ingredient-by-id', args=[ingredient_model.id]))
+        self.assertEqual(ingredient_cache.stats()['evictions'] - evictions, 1)
+        self.assertEqual(ingredient_cache.stats()['local_entries'], 1)
+
+
+class ListingResponseCacheTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingredients, self.recipe_models = make_catalog(recipes=2, lines_per_recipe=2)
+        self.url = reverse('get-all-recipes')
+
+    def test_if_none_match_is_answered_without_queries(self):
+        response = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url)
+            not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+    def test_gzip_copy(self):
+        plain = self.client.get(self.url)
+        compressed = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.content), plain.content)
+        self.assertNotEqual(compressed['ETag'], plain['ETag'])
+
+    def test_writes_change_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(reverse('update-ingredient', args=[self.ingredients[0].id]),
+                            {'new_name': 'renamed', 'new_description': ''}, content_type='application/json')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'renamed', response.content)
+
+    def test_query_string_and_streams_are_separate(self):
+        first_page = self.client.get(self.url, {'limit': 1}).json()
+        self.assertEqual(len(first_page['results']), 1)
+        self.assertTrue(self.client.get(self.url, HTTP_ACCEPT='application/x-ndjson').streaming)
+
+
+class AsyncReadPathTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingredients, self.recipe_models = make_catalog(recipes=3, lines_per_recipe=2)
+
+    async def test_async_views_under_asgi(self):
+        response = await self.async_client.get(reverse('get-recipe-by-id', args=[self.recipe_models[0].id]))
+        self.assertEqual(response.json()['ingredients'][1]['name'], "ingredient 1")
+        response = await self.async_client.get(reverse('get-ingredient', args=["ingredient 0"]))
+        self.assertEqual(response.json()['description'], "description 0")
+        response = await self.async_client.get(reverse('get-all-recipes'), {'limit': 2})
+        self.assertEqual(len(response.json()['results']), 2)
+        response = await self.async_client.get(reverse('get-recipe-by-name', args=["missing"]))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_async_stream(self):
+        response = await self.async_client.get(reverse('get-all-recipes'), {'stream': 'ndjson'})
+        lines = [line async for line in response.streaming_content]
+        recipes = [json.loads(line) for line in b"".join(lines).splitlines()]
+        self.assertEqual([recipe['name'] for recipe in recipes], ["recipe 0", "recipe 1", "recipe 2"])
+
+    async def test_async_iteration_walks_every_chunk(self):
+        rows = [row async for row in ReadRecipeUseCase().aiter_rows(chunk_size=2)]
+        self.assertEqual([row[1] for row in rows], ["recipe 0", "recipe 1", "recipe 2"])
+        self.assertEqual(len(rows[2][3]), 2)
+
+
+class RecipeUpdateTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingredients, self.recipe_models = make_catalog(recipes=2, lines_per_recipe=30)
+        self.recipe_model = self.recipe_models[0]
+        self.lines = [{"name": ingredient.name, "quantity": 1} for ingredient in self.ingredients]
+
+    def update(self, lines, name=None):
+        return self.client.put(reverse('update-recipe', args=[self.recipe_model.id]), {
+            'new_name': name or self.recipe_model.name,
+            'new_ingredients': lines,
+            'new_elaboration': self.recipe_model.elaboration,
+        }, content_type='application/json')
+
+    def stored_lines(self):
+        return dict(RecipeIngredientModel.objects.filter(recipe=self.recipe_model)
+                    .values_list('ingredient__name', 'quantity'))
+
+    def test_one_quantity_costs_a_handful_of_queries(self):
+        self.update(self.lines)
+        self.lines[5]["quantity"] = 3
+        ids = list(IngredientModel.objects.values_list('id', flat=True))
+        # savepoint, recipe, names, names locked, lines, one UPDATE, usage, document, release
+        with self.assertNumQueries(9):
+            UpdateRecipeUseCase().update(mock.Mock(), self.recipe_model.id, self.recipe_model.name,
+                                         self.lines, self.recipe_model.elaboration)
+        self.assertEqual(self.stored_lines()["ingredient 5"], Decimal("3"))
+        self.assertEqual(list(IngredientModel.objects.values_list('id', flat=True)), ids)
+
+    def test_lines_are_added_and_removed(self):
+        lines = self.lines[1:] + [{"name": "saffron", "quantity": 2}, {"id": self.ingredients[0].id, "quantity": 4}]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.update(lines).status_code, 200)
+        stored = self.stored_lines()
+        self.assertEqual(len(stored), 31)
+        self.assertEqual((stored["saffron"], stored["ingredient 0"]), (Decimal("2"), Decimal("4")))
+        # Ingredients shared with the other recipe are left alone
+        self.assertEqual(RecipeIngredientModel.objects.filter(recipe=self.recipe_models[1]).count(), 30)
+        recipe = self.client.get(reverse('get-recipe-by-id', args=[self.recipe_model.id])).json()
+        self.assertEqual(len(recipe['ingredients']), 31)
+
+    def test_failed_update_writes_nothing(self):
+        response = self.update(self.lines[:1] + [{"id": 999999, "quantity": 1}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.stored_lines()), 30)
+        self.assertEqual(self.update(self.lines, name=self.recipe_models[1].name).status_code, 409)
+        self.assertEqual(RecipeModel.objects.get(id=self.recipe_model.id).name, self.recipe_model.name)
+
+    def test_malformed_lines_are_rejected(self):
+        for lines in ([{"name": "salt", "quantity": "a lot"}], [{"name": "salt"}], ["salt"]):
+            with self.subTest(lines=lines):
+                response = self.update(lines)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('Invalid ingredients', response.json()['error'])
+        self.assertEqual(len(self.stored_lines()), 30)
+
+
+class RecipeCreateTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingredients, _ = make_catalog(recipes=1, lines_per_recipe=40)
+
+    def create(self, name, lines):
+        return self.client.post(reverse('create-recipe'), {
+            'name': name, 'ingredients': lines, 'elaboration': 'mix',
+        }, content_type='application/json')
+
+    def test_lines_are_inserted_in_one_statement(self):
+        lines = [{"ingredient_id": ingredient.id, "quantity": 2} for ingredient in self.ingredients]
+        with self.assertNumQueries(7):  # savepoint, ids, recipe, lines, usage, document, release
+            response = self.create('stew', lines)
+        self.assertEqual(response.status_code, 201)
+        recipe = response.json()
+        self.assertEqual(len(recipe['ingredients']), 40)
+        self.assertEqual(recipe['ingredients'][0]['name'], 'ingredient 0')
+        # Lines get their own keys, so recipes sharing ingredients do not collide
+        self.assertEqual(self.create('soup', lines[:3]).status_code, 201)
+        stored = self.client.get(reverse('get-recipe-by-id', args=[recipe['id']])).json()
+        self.assertEqual(stored['ingredients'], recipe['ingredients'])
+
+    def test_failures_leave_no_partial_recipe(self):
+        lines = [{"ingredient_id": self.ingredients[0].id, "quantity": 1}, {"ingredient_id": 999999, "quantity": 1}]
+        self.assertEqual(self.create('stew', lines).status_code, 400)
+        self.assertEqual(self.create('recipe 0', lines[:1]).status_code, 409)
+        self.assertEqual(self.create('stew', [{"ingredient_id": self.ingredients[0].id}]).status_code, 400)
+        self.assertFalse(RecipeModel.objects.filter(name='stew').exists())
+        self.assertEqual(RecipeIngredientModel.objects.count(), 40)
+
+
+class RowSerializerTests(RecipesTestCase):
+    def test_listings_match_the_entity_serialization(self):
+        ingredient = IngredientModel.objects.create(name='crème "brûlée"', description='a\\b\n☃')
+        recipe_model = RecipeModel.objects.create(name='tarte', elaboration='<bake>')
+        RecipeIngredientModel.objects.create(recipe=recipe_model, ingredient=ingredient, quantity=Decimal('1.5'))
+        for use_case, serializer, to_dict in (
+                (ReadIngredientUseCase(), ingredient_serializer(INGREDIENT_ROW), ingredient_to_dict),
+                (ReadRecipeUseCase(), recipe_serializer(RECIPE_ROW), recipe_to_dict)):
+            expected = JsonResponse({'results': [to_dict(entity) for entity in use_case.get_all()],
+                                     'next': 'abc'}).content
+            self.assertEqual(page_json(use_case.get_all_rows(), serializer, 'abc'), expected)
+
+    def test_entities_have_no_instance_dict(self):
+        make_catalog(recipes=1, lines_per_recipe=1)
+        recipe = ReadRecipeUseCase().get_all()[0]
+        self.assertFalse(hasattr(recipe, '__dict__'))
+        self.assertIsInstance(recipe.ingredients[0], RecipeLine)
+        self.assertFalse(hasattr(recipe.ingredients[0], '__dict__'))
+
+
+class SparseFieldsetTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingredients, self.recipe_models = make_catalog(recipes=3, lines_per_recipe=2)
+
+    def test_listing_skips_lines_and_unrequested_columns(self):
+        url = reverse('get-all-recipes') + '?fields=name&limit=2'
+        with CaptureQueriesContext(connection) as queries:
+            page = self.client.get(url).json()
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('elaboration', queries[0]['sql'])
+        self.assertEqual(page['results'][0], {'id': self.recipe_models[0].id, 'name': 'recipe 0'})
+        next_page = self.client.get(url + f"&cursor={page['next']}").json()
+        self.assertEqual([recipe['name'] for recipe in next_page['results']], ['recipe 2'])
+
+    def test_ingredient_listing_and_stream(self):
+        page = self.client.get(reverse('get-all-ingredients') + '?fields=name').json()
+        self.assertEqual(page['results'][1], {'id': self.ingredients[1].id, 'name': 'ingredient 1'})
+        response = self.client.get(reverse('get-all-recipes') + '?fields=ingredients&stream=ndjson')
+        first = json.loads(b"".join(response.streaming_content).splitlines()[0])
+        self.assertEqual(list(first), ['id', 'ingredients'])
+
+    def test_single_reads_and_unknown_fields(self):
+        recipe = self.client.get(reverse('get-recipe-by-id', args=[self.recipe_models[0].id]) + '?fields=name').json()
+        self.assertEqual(recipe, {'id': self.recipe_models[0].id, 'name': 'recipe 0'})
+        ingredient = self.client.get(reverse('get-ingredient', args=['ingredient 0']) + '?fields=description').json()
+        self.assertEqual(set(ingredient), {'id', 'description'})
+        for url in (reverse('get-all-recipes'), reverse('get-ingredient-by-id', args=[self.ingredients[0].id])):
+            self.assertEqual(self.client.get(url + '?fields=name,secret').status_code, 400)
+
+
+class BatchReadTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingredients, self.recipe_models = make_catalog(recipes=30, lines_per_recipe=5)
+
+    def test_recipes_in_request_order_with_missing_ids(self):
+        ids = [recipe_model.id for recipe_model in reversed(self.recipe_models)] + [999999]
+        url = reverse('get-recipes-batch') + '?ids=' + ','.join(map(str, ids))
+        with self.assertNumQueries(2):  # documents, then recipes for the id without one
+            body = self.client.get(url).json()
+        self.assertEqual([recipe['id'] for recipe in body['results']], ids[:-1])
+        self.assertEqual(len(body['results'][0]['ingredients']), 5)
+        self.assertEqual(body['missing'], [999999])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).json(), body)
+
+    def test_partly_cached_set_loads_only_the_rest(self):
+        first = self.recipe_models[0].id
+        self.client.get(reverse('get-recipe-by-id', args=[first]))
+        ids = [first, self.recipe_models[1].id]
+        recipes = ReadRecipeUseCase().get_many(ids)
+        self.assertEqual([recipe.id for recipe in recipes], ids)
+        before = recipe_cache.stats()
+        ReadRecipeUseCase().get_many(ids + [999999])
+        after = recipe_cache.stats()
+        self.assertEqual([after[name] - before[name] for name in ('local_hits', 'misses')], [2, 1])
+
+    def test_ingredients_and_invalid_ids(self):
+        ids = [self.ingredients[2].id, self.ingredients[0].id]
+        body = self.client.get(reverse('get-ingredients-batch') + f'?ids={ids[0]},{ids[1]},{ids[0]}&fields=name').json()
+        self.assertEqual(body['results'], [{'id': ids[0], 'name': 'ingredient 2'}, {'id': ids[1], 'name': 'ingredient 0'}])
+        for query in ('', '?ids=a', '?ids=' + ','.join(map(str, range(2000)))):
+            self.assertEqual(self.client.get(reverse('get-ingredients-batch') + query).status_code, 400)
+
+
+@skipUnless('replica' in settings.DATABASES, "needs a 'replica' database, see dei0/settings_sqlite_replica.py")
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(RecipesTestCase):
+    databases = {'default', 'replica'} & set(settings.DATABASES)
+
+    def setUp(self):
+        super().setUp()
+        # Nothing replicates in tests: the description tells which database answered
+        IngredientModel.objects.create(name='salt', description='primary')
+        IngredientModel.objects.using('replica').create(name='salt', description='replica')
+
+    def description(self, client=None):
+        return (client or self.client).get(reverse('get-ingredient', args=['salt'])).json()['description']
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.description(), 'replica')
+        page = self.client.get(reverse('get-all-ingredients')).json()
+        self.assertEqual(page['results'][0]['description'], 'replica')
+
+    def test_writer_reads_its_own_writes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('ingredient-crud'), {'name': 'pepper', 'description': 'black'},
+                                        content_type='application/json')
+        self.assertIn(PIN_COOKIE, response.cookies)
+        self.assertEqual(self.client.get(reverse('get-ingredient', args=['pepper'])).status_code, 200)
+        cache.clear()
+        ingredient_cache.clear_local()
+        self.assertEqual(Client().get(reverse('get-ingredient', args=['pepper'])).status_code, 404)
+        # Once the pin expires the writer is back on the replica
+        self.client.cookies[PIN_COOKIE] = str(time.time() - 1)
+        self.assertEqual(self.description(), 'replica')
+
+    def test_replica_reads_right_after_a_write_are_not_cached(self):
+        url = reverse('get-ingredient', args=['pepper'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('ingredient-crud'), {'name': 'pepper', 'description': 'black'},
+                             content_type='application/json')
+        # The replica has not replayed the insert: another client misses...
+        self.assertEqual(Client().get(url).status_code, 404)
+        # ...without caching the miss for the writer, whose read of the primary is cached for all
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(Client().get(url).status_code, 200)
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            self.description(Client())
+            with self.assertNumQueries(0, using='replica'):
+                self.assertEqual(self.description(Client()), 'replica')
+
+    def test_streamed_listings_read_the_database_picked_by_the_request(self):
+        RecipeModel.objects.create(name='soup', elaboration='primary')
+        RecipeModel.objects.using('replica').create(name='soup', elaboration='replica')
+
+        async def astream(client, url):
+            response = await client.get(url, {'stream': 'ndjson'})
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        def stream(client, url):
+            return b"".join(client.get(url, {'stream': 'ndjson'}).streaming_content)
+
+        def values(body):
+            return [row.get('description', row.get('elaboration')) for row in map(json.loads, body.splitlines())]
+
+        for name in ('get-all-ingredients', 'get-all-recipes'):
+            url = reverse(name)
+            with self.subTest(url=url):
+                self.assertEqual(values(stream(Client(), url)), ['replica'])
+                self.assertEqual(values(async_to_sync(astream)(AsyncClient(), url)), ['replica'])
+                # A client that wrote recently streams from the primary
+                pinned, apinned = Client(), AsyncClient()
+                pinned.cookies[PIN_COOKIE] = apinned.cookies[PIN_COOKIE] = str(time.time() + 60)
+                self.assertEqual(values(stream(pinned, url)), ['primary'])
+                self.assertEqual(values(async_to_sync(astream)(apinned, url)), ['primary'])
+
+    def test_shopping_list_reads_the_replica_without_pinning(self):
+        recipe_model = RecipeModel.objects.using('replica').create(name='soup', elaboration='')
+        RecipeIngredientModel.objects.using('replica').create(
+            recipe=recipe_model, ingredient=IngredientModel.objects.using('replica').get(name='salt'),
+            quantity=Decimal('2.00'))
+        plan = {'recipes': [{'id': recipe_model.id}]}
+        response = self.client.post(reverse('shopping-list'), plan, content_type='application/json')
+        self.assertEqual([item['quantity'] for item in response.json()['results']], ['2.00'])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        # A client that wrote recently still reads the primary
+        self.client.cookies[PIN_COOKIE] = str(time.time() + 60)
+        response = self.client.post(reverse('shopping-list'), plan, content_type='application/json')
+        self.assertEqual(response.json()['results'], [])
+
+    def test_unavailable_replica_falls_back_to_the_primary(self):
+        with mock.patch.dict(router._down_until), \
+                mock.patch.object(connections['replica'], 'ensure_connection', side_effect=OperationalError):
+            self.assertEqual(self.description(), 'primary')
+            self.assertIn('replica', router._down_until)
+
+
+class ConnectionStatsTests(RecipesTestCase):
+    def wrapper(self, conn_max_age):
+        backend = load_backend('recipes.storage.backends.sqlite3')
+        # A file, as in-memory SQLite connections are never closed
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_dict = dict(connection.settings_dict, NAME=os.path.join(directory.name, 'stats.sqlite3'),
+                             CONN_MAX_AGE=conn_max_age)
+        wrapper = backend.DatabaseWrapper(settings_dict, alias='stats')
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def request(self, wrapper):
+        wrapper.close_if_unusable_or_obsolete()
+        with wrapper.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        wrapper.close_if_unusable_or_obsolete()
+
+    def totals(self, wrapper):
+        from recipes.storage import connection_stats as module
+        return module._totals[wrapper.alias]
+
+    def setUp(self):
+        super().setUp()
+        reset_connection_stats()
+        self.addCleanup(reset_connection_stats)
+
+    def test_persistent_connection_is_reused(self):
+        wrapper = self.wrapper(conn_max_age=60)
+        for _ in range(3):
+            self.request(wrapper)
+        self.assertEqual(self.totals(wrapper)['opened'], 1)
+        self.assertEqual(self.totals(wrapper)['checkouts'], 3)
+        self.assertEqual(self.totals(wrapper)['reused'], 2)
+        self.assertIsNotNone(wrapper.connection)
+
+    def test_connection_per_request_without_max_age(self):
+        wrapper = self.wrapper(conn_max_age=0)
+        for _ in range(3):
+            self.request(wrapper)
+        self.assertEqual(self.totals(wrapper)['opened'], 3)
+        self.assertEqual(self.totals(wrapper)['recycled'], 3)
+        self.assertEqual(self.totals(wrapper)['reused'], 0)
+
+    def test_stats_endpoint(self):
+        stats = self.client.get(reverse('db-stats')).json()
+        self.assertEqual(set(stats), set(settings.DATABASES))
+        self.assertEqual(set(stats['default']), {
+            'instrumented', 'conn_max_age', 'health_checks', 'server_side_cursors', 'open', 'in_use',
+            'utilization', 'age_seconds', 'opened', 'recycled', 'checkouts', 'reused', 'reuse_ratio',
+            'connect_ms'})
+        if not stats['default']['instrumented']:
+            self.assertEqual((stats['default']['open'], stats['default']['checkouts']), (0, 0))
+            return
+        # The test client does not end requests on the connection, so start one by hand
+        connection.in_use = False
+        self.client.get(reverse('get-all-ingredients'))
+        stats = self.client.get(reverse('db-stats')).json()['default']
+        self.assertEqual((stats['open'], stats['in_use'], stats['opened']), (1, 1, 0))
+        self.assertEqual((stats['checkouts'], stats['reused'], stats['reuse_ratio']), (1, 1, 1.0))
+
+
+
+class MetricsTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        IngredientModel.objects.create(name='salt', description='fine')
+
+    def metrics(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_server_timing_counts_queries(self):
+        response = self.client.get(reverse('get-all-ingredients'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="1 queries", total;dur=[\d.]+$')
+
+    def test_requests_recorded_per_url_name(self):
+        before = self.metrics()
+        self.client.get(reverse('get-all-ingredients'))
+        after = self.metrics()
+        series = 'recipes_http_request_db_queries_count{view="get-all-ingredients"}'
+        count = lambda text: next((float(line.split()[-1]) for line in text.splitlines()
+                                   if line.startswith(series)), 0)
+        self.assertEqual(count(after), count(before) + 1)
+        self.assertIn('recipes_http_requests_total{method="GET",status="200",view="get-all-ingredients"}', after)
+        self.assertRegex(after, r'recipes_usecase_duration_seconds_count'
+                                r'\{method="a?get_all_rows",use_case="ReadIngredientUseCase"\} [1-9]')
+
+    def test_other_processes_are_added_up(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            labels = {'method': 'GET', 'status': '200', 'view': 'elsewhere'}
+            with open(os.path.join(directory, '1-other.json'), 'w') as file:
+                json.dump([['recipes_http_requests_total', labels, 3]], file)
+            registry.inc('recipes_http_requests_total', **labels)
+            self.assertIn('recipes_http_requests_total{method="GET",status="200",view="elsewhere"} 4',
+                          self.metrics())
+            registry.flush(force=True)
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+    def test_concurrent_flushes_write_one_file(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            registry.inc('recipes_http_requests_total', method='GET', status='200', view='here')
+            threads = [threading.Thread(target=registry.flush, kwargs={'force': True}) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(os.listdir(directory), [registry._file])
+            with open(os.path.join(directory, registry._file)) as file:
+                self.assertIn('here', json.dumps(json.load(file)))
+
+
+class BenchmarkTests(RecipesTestCase):
+    def test_seed_catalog_is_reproducible(self):
+        call_command('seed_catalog', ingredients=50, recipes=20, lines_per_recipe='2..6', seed=7, stdout=StringIO())
+        first = list(RecipeModel.objects.order_by('id').values_list('name', 'elaboration'))
+        self.assertEqual(IngredientModel.objects.count(), 50)
+        self.assertTrue(all(2 <= count <= 6 for count in RecipeIngredientModel.objects.values('recipe').annotate(
+            count=Count('id')).values_list('count', flat=True)))
+        with self.assertRaises(CommandError):
+            call_command('seed_catalog', ingredients=50, recipes=20, stdout=StringIO())
+        call_command('seed_catalog', ingredients=50, recipes=20, lines_per_recipe='2..6', seed=7, clear=True,
+                     stdout=StringIO())
+        self.assertEqual(list(RecipeModel.objects.order_by('id').values_list('name', 'elaboration')), first)
+
+    def test_benchmark_runs_every_route_and_cleans_up(self):
+        call_command('seed_catalog', ingredients=30, recipes=10, lines_per_recipe='2..4', stdout=StringIO())
+        counts = IngredientModel.objects.count(), RecipeModel.objects.count()
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('benchmark_routes', requests=3, warmup=1, output=output, session=staff_session(),
+                             stdout=StringIO())
+            with open(output) as file:
+                results = json.load(file)
+        self.assertEqual(set(results['routes']), {pattern.name for pattern in recipe_urls.urlpatterns})
+        for name, route in results['routes'].items():
+            self.assertEqual(route['errors'], 0, name)
+            self.assertIsNotNone(route['queries_mean'], name)
+        self.assertGreater(results['meta']['peak_rss_kib'], 0)
+        self.assertEqual((IngredientModel.objects.count(), RecipeModel.objects.count()), counts)
+
+    def test_http_transport_retries_only_what_is_safe_to_resend(self):
+        transport = HttpTransport('http://127.0.0.1:8000')
+        for method, error, attempts in (('GET', TimeoutError, 2), ('POST', TimeoutError, 1),
+                                        ('POST', ConnectionResetError, 2)):
+            with self.subTest(method=method, error=error), \
+                    mock.patch('http.client.HTTPConnection') as connection_class:
+                conn = connection_class.return_value
+                conn.getresponse.side_effect = [error(), mock.Mock(status=200, getheader=lambda *_: '',
+                                                                   read=lambda: b'{}')]
+                transport.connections.clear()
+                if attempts == 1:
+                    with self.assertRaises(error):
+                        transport.request(method, '/recipes/ingredients/', {})
+                else:
+                    self.assertEqual(transport.request(method, '/recipes/ingredients/', {})[0], 200)
+                self.assertEqual(conn.request.call_count, attempts)
+
+    def test_regressions_against_baseline(self):
+        route = {'p95_ms': 10.0, 'throughput': 100.0, 'queries_mean': 2.0, 'errors': 0}
+        baseline = {'routes': {'get-all-recipes': route}}
+        self.assertEqual(compare({'routes': {'get-all-recipes': dict(route, p95_ms=11.0)}}, baseline, 0.25, 0.5), [])
+        regressions = compare({'routes': {'get-all-recipes': dict(route, p95_ms=20.0, queries_mean=12.0)}},
+                              baseline, 0.25, 0.5)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('queries per request', regressions[1])
+
+
+class RepositoryTests(RecipesTestCase):
+    # The use cases on in-memory repositories: no query is made
+    def setUp(self):
+        super().setUp()
+        self.repository = InMemoryIngredientRepository(
+            [Ingredient(name=name, description="", id=id) for id, name in enumerate(['salt', 'flour', 'egg'], 1)])
+        self.use_case = ReadIngredientUseCase(self.repository, cache=EntityCache(f"test-{self.id()}"))
+        token = loaders.start_request()
+        self.addCleanup(loaders.finish_request, token)
+
+    def test_get_many_is_one_lookup(self):
+        with self.assertNumQueries(0):
+            ingredients = self.use_case.get_many([3, 1, 99])
+        self.assertEqual([ingredient and ingredient.name for ingredient in ingredients], ['egg', 'salt', None])
+        self.assertEqual(self.repository.calls, [('get_many', [3, 1, 99])])
+
+    def test_request_memoizes_lookups(self):
+        self.use_case.get_by_name('salt')
+        self.use_case.cache.clear_local()
+        cache.clear()
+        self.assertEqual(self.use_case.get_by_name('salt').id, 1)
+        self.assertEqual(self.repository.calls, [('get_by_names', ['salt'])])
+        # A write forgets what the request has read
+        loaders.clear_request_loaders()
+        cache.clear()
+        self.use_case.cache.clear_local()
+        self.use_case.get_by_name('salt')
+        self.assertEqual(len(self.repository.calls), 2)
+
+    def test_concurrent_loads_are_merged(self):
+        loader = loaders.request_loader(self.repository, 'get_many')
+
+        async def load():
+            return await asyncio.gather(loader.aload(1), loader.aload(2), loader.aload(1), loader.aload(42))
+
+        ingredients = async_to_sync(load)()
+        self.assertEqual([ingredient and ingredient.name for ingredient in ingredients], ['salt', 'flour', 'salt', None])
+        self.assertEqual(self.repository.calls, [('get_many', [1, 2, 42])])
+        self.assertEqual(loader.load_many([2, 42]), {2: ingredients[1]})
+        self.assertEqual(len(self.repository.calls), 1)
+
+    def test_dispatch_keeps_its_task_until_done(self):
+        loader = loaders.request_loader(self.repository, 'get_many')
+
+        async def load():
+            load = asyncio.ensure_future(loader.aload(1))
+            # Let the load queue its key, then the dispatch create its task
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            tasks = set(loader._tasks)
+            return tasks, await load
+
+        tasks, ingredient = async_to_sync(load)()
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(ingredient.name, 'salt')
+        self.assertEqual(loader._tasks, set())
+
+    def test_repositories_must_implement_the_lookups(self):
+        class Partial(IngredientRepository):
+            def get_many(self, ids):
+                return {}
+
+        with self.assertRaises(TypeError):
+            Partial()
+
+    def test_recipe_listing_on_memory_repository(self):
+        recipes = InMemoryRecipeRepository([
+            Recipe(name=f"recipe {id}", ingredients=[RecipeLine(name='salt', quantity=Decimal('1.00'), id=id)],
+                   elaboration="", id=id)
+            for id in range(1, 6)])
+        use_case = ReadRecipeUseCase(recipes, cache=EntityCache(f"test-{self.id()}"))
+        self.assertEqual([recipe.id for recipe in use_case.get_all()], [1, 2, 3, 4, 5])
+        self.assertEqual([recipe.id for recipe in use_case.get_all(after=2, limit=2)], [3, 4])
+
+    def test_django_recipes_read_from_documents_or_the_tables(self):
+        salt = IngredientModel.objects.create(name='salt', description='')
+        flour = IngredientModel.objects.create(name='flour', description='')
+        recipe_ids = []
+        for number in range(3):
+            recipe_model = RecipeModel.objects.create(name=f"bread {number}", elaboration='')
+            RecipeIngredientModel.objects.create(recipe=recipe_model, ingredient=salt, quantity=1)
+            RecipeIngredientModel.objects.create(recipe=recipe_model, ingredient=flour, quantity=2)
+            recipe_ids.append(recipe_model.id)
+        def as_dicts(recipes):
+            return {id: recipe_to_dict(recipe) for id, recipe in recipes.items()}
+
+        with self.assertNumQueries(3):  # no documents yet: documents, recipes, lines
+            from_tables = as_dicts(DjangoRecipeRepository().get_many(recipe_ids))
+        self.assertEqual([line['name'] for line in from_tables[recipe_ids[0]]['ingredients']], ['salt', 'flour'])
+        refresh_documents(recipe_ids[:2])
+        with self.assertNumQueries(3):
+            self.assertEqual(as_dicts(DjangoRecipeRepository().get_many(recipe_ids)), from_tables)
+        refresh_documents(recipe_ids)
+        with self.assertNumQueries(1):
+            self.assertEqual(as_dicts(DjangoRecipeRepository().get_many(recipe_ids)), from_tables)
+        with self.assertNumQueries(2):  # 'bread 9' has no document, nor a recipe
+            self.assertEqual(set(DjangoRecipeRepository().get_by_names(['bread 1', 'bread 9'])), {'bread 1'})
+
+
+class ReadModelTests(RecipesTestCase):
+    # Every write path leaves the documents as render_documents() makes them from the tables
+    def setUp(self):
+        super().setUp()
+        self.ingredients, self.recipe_models = make_catalog(recipes=2, lines_per_recipe=3)
+
+    def assertDocumentsInStep(self):
+        stored = dict(RecipeDocumentModel.objects.values_list('recipe_id', 'document'))
+        self.assertEqual(stored, render_documents(RecipeModel.objects.values_list('id', flat=True)))
+        return stored
+
+    def test_recipe_writes(self):
+        response = self.client.post(reverse('create-recipe'), {
+            'name': 'stew', 'elaboration': 'mix',
+            'ingredients': [{'ingredient_id': ingredient.id, 'quantity': '2.5'} for ingredient in self.ingredients],
+        }, content_type='application/json')
+        recipe_id = response.json()['id']
+        self.assertEqual(self.assertDocumentsInStep()[recipe_id]['ingredients'][0]['quantity'], '2.50')
+        self.client.put(reverse('update-recipe', args=[recipe_id]), {
+            'new_name': 'hot stew', 'new_elaboration': 'mix well',
+            'new_ingredients': [{'name': 'pepper', 'quantity': 1}, {'id': self.ingredients[1].id, 'quantity': 3}],
+        }, content_type='application/json')
+        document = self.assertDocumentsInStep()[recipe_id]
+        self.assertEqual(document['name'], 'hot stew')
+        self.assertEqual(sorted(line['name'] for line in document['ingredients']), ['ingredient 1', 'pepper'])
+        self.client.delete(reverse('delete-recipe', args=[recipe_id]))
+        self.assertNotIn(recipe_id, self.assertDocumentsInStep())
+
+    def test_ingredient_rename_and_delete_reach_the_documents(self):
+        self.client.put(reverse('update-ingredient', args=[self.ingredients[0].id]),
+                        {'new_name': 'renamed', 'new_description': ''}, content_type='application/json')
+        self.assertEqual(self.assertDocumentsInStep()[self.recipe_models[0].id]['ingredients'][0]['name'], 'renamed')
+        self.client.delete(reverse('delete-ingredient', args=[self.ingredients[1].id]))
+        lines = self.assertDocumentsInStep()[self.recipe_models[1].id]['ingredients']
+        self.assertEqual([line['name'] for line in lines], ['renamed', 'ingredient 2'])
+
+    @skipUnless(connection.features.has_select_for_update, "the database ignores row locks")
+    def test_recipe_writes_lock_the_ingredient_names_they_render(self):
+        lines = [{'id': ingredient.id, 'quantity': 1} for ingredient in self.ingredients]
+        with CaptureQueriesContext(connection) as queries:
+            self.client.put(reverse('update-recipe', args=[self.recipe_models[0].id]), {
+                'new_name': 'stew', 'new_elaboration': 'mix', 'new_ingredients': lines,
+            }, content_type='application/json')
+        sql = [query['sql'] for query in queries]
+        locks = [index for index, statement in enumerate(sql)
+                 if 'recipes_ingredientmodel' in statement and 'FOR ' in statement]
+        documents = [index for index, statement in enumerate(sql)
+                     if statement.startswith('INSERT') and 'recipes_recipedocumentmodel' in statement]
+        self.assertTrue(locks and documents and locks[0] < documents[0])
+
+    def test_read_by_id_is_one_query(self):
+        with self.assertNumQueries(1):
+            recipe = ReadRecipeUseCase().get_by_id(self.recipe_models[0].id)
+        self.assertEqual(recipe.ingredients[0].quantity, Decimal('1.50'))
+
+    def test_rebuild_command(self):
+        RecipeDocumentModel.objects.all().delete()
+        RecipeIngredientModel.objects.filter(recipe=self.recipe_models[0]).update(quantity=Decimal('7.25'))
+        out = StringIO()
+        call_command('rebuild_read_model', batch_size=1, stdout=out)
+        self.assertIn("Rebuilt 2 documents", out.getvalue())
+        self.assertEqual(self.assertDocumentsInStep()[self.recipe_models[0].id]['ingredients'][0]['quantity'], '7.25')
+
+
+class ShoppingListTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.salt = IngredientModel.objects.create(name='salt', description='')
+        self.flour = IngredientModel.objects.create(name='flour', description='')
+        self.recipe_ids = []
+        for number in range(300):
+            recipe_model = RecipeModel.objects.create(name=f"bread {number}", elaboration='')
+            RecipeIngredientModel.objects.create(recipe=recipe_model, ingredient=self.salt, quantity=Decimal('0.10'))
+            if number % 2:
+                RecipeIngredientModel.objects.create(recipe=recipe_model, ingredient=self.flour,
+                                                     quantity=Decimal('999.99'))
+            self.recipe_ids.append(recipe_model.id)
+
+    def plan(self, recipes):
+        return self.client.post(reverse('shopping-list'), {'recipes': recipes}, content_type='application/json')
+
+    def test_hundreds_of_recipes_in_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.plan([{'id': recipe_id, 'servings': 3} for recipe_id in self.recipe_ids])
+        self.assertEqual(response.json()['results'], [
+            {'id': self.flour.id, 'name': 'flour', 'quantity': '449995.50'},
+            {'id': self.salt.id, 'name': 'salt', 'quantity': '90.00'},
+        ])
+
+    def test_totals_are_exact_decimals(self):
+        # 0.1 and 999.99 are not exact as floats. Recipe 1 is listed twice, so
+        # it counts 0.67 servings; salt adds up to 0.133, rounded once at the end
+        response = self.plan([{'id': recipe_id, 'servings': '0.33'} for recipe_id in self.recipe_ids[:3]]
+                             + [{'id': self.recipe_ids[1], 'servings': '0.34'}, {'id': 999999}])
+        self.assertEqual(response.json()['results'], [
+            {'id': self.flour.id, 'name': 'flour', 'quantity': '669.99'},
+            {'id': self.salt.id, 'name': 'salt', 'quantity': '0.13'},
+        ])
+
+    def test_invalid_plans(self):
+        for recipes in ([], [{'servings': 2}], [{'id': self.recipe_ids[0], 'servings': 0}],
+                        [{'id': self.recipe_ids[0], 'servings': '1.005'}], [{'id': 'x'}],
+                        [{'id': self.recipe_ids[0], 'servings': 'NaN'}],
+                        [{'id': self.recipe_ids[0], 'servings': 1e15}],
+                        [{'id': self.recipe_ids[0], 'servings': '1' * 20}],
+                        [{'id': self.recipe_ids[0], 'servings': 600}, {'id': self.recipe_ids[0], 'servings': 600}]):
+            self.assertEqual(self.plan(recipes).status_code, 400, recipes)
+
+    def test_servings_are_capped(self):
+        # The largest quantity times the largest servings is still exact
+        response = self.plan([{'id': self.recipe_ids[1], 'servings': ShoppingListUseCase.MAX_SERVINGS}])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn({'id': self.flour.id, 'name': 'flour', 'quantity': '999990.00'}, response.json()['results'])
+
+    def test_memory_repository(self):
+        lines = InMemoryRecipeLineRepository({
+            1: [RecipeLine(name='salt', quantity=Decimal('0.10'), id=1)],
+            2: [RecipeLine(name='salt', quantity=Decimal('0.05'), id=2),
+                RecipeLine(name='egg', quantity=Decimal('2.00'), id=3)],
+        })
+        items = ShoppingListUseCase(lines).build([(1, '1.5'), (2, 2), (3, 1)])
+        self.assertEqual([(item.name, item.quantity) for item in items], [('egg', Decimal('4.00')),
+                                                                          ('salt', Decimal('0.25'))])
+
+
+class IngredientUsageTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.salt, self.flour, self.egg = [IngredientModel.objects.create(name=name, description='')
+                                           for name in ('salt', 'flour', 'egg')]
+
+    def create(self, name, lines):
+        return self.client.post(reverse('create-recipe'), {
+            'name': name, 'elaboration': '',
+            'ingredients': [{'ingredient_id': ingredient.id, 'quantity': quantity} for ingredient, quantity in lines],
+        }, content_type='application/json').json()['id']
+
+    def assertInStep(self):
+        call_command('reconcile_ingredient_usage', stdout=StringIO())
+
+    def usage(self, ingredient):
+        return self.client.get(reverse('ingredient-usage', args=[ingredient.id])).json()
+
+    def test_recipe_writes_keep_the_summary_in_step(self):
+        bread = self.create('bread', [(self.salt, '0.10'), (self.flour, '500')])
+        self.create('cake', [(self.flour, '250.25'), (self.egg, '3')])
+        self.assertInStep()
+        self.assertEqual(self.usage(self.flour), {'id': self.flour.id, 'name': 'flour', 'recipes': 2,
+                                                  'total_quantity': '750.25'})
+        self.client.put(reverse('update-recipe', args=[bread]), {
+            'new_name': 'bread', 'new_elaboration': 'knead',
+            'new_ingredients': [{'id': self.flour.id, 'quantity': '400'}, {'id': self.egg.id, 'quantity': 1}],
+        }, content_type='application/json')
+        self.assertInStep()
+        self.assertEqual(self.usage(self.salt)['recipes'], 0)
+        self.assertEqual(self.usage(self.flour)['total_quantity'], '650.25')
+        self.client.delete(reverse('delete-recipe', args=[bread]))
+        self.assertInStep()
+        self.assertEqual(self.usage(self.egg), {'id': self.egg.id, 'name': 'egg', 'recipes': 1,
+                                                'total_quantity': '3.00'})
+
+    @skipUnless(connection.features.has_select_for_update, "the database ignores row locks")
+    def test_recipe_delete_locks_the_recipe_before_reading_its_lines(self):
+        bread = self.create('bread', [(self.salt, '0.10')])
+        with CaptureQueriesContext(connection) as queries:
+            self.client.delete(reverse('delete-recipe', args=[bread]))
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        self.assertIn('FOR UPDATE', selects[0])
+        self.assertIn('recipes_recipeingredientmodel', selects[1])
+
+    def test_stats_are_index_lookups(self):
+        self.create('bread', [(self.salt, '0.10'), (self.flour, '500')])
+        self.create('pancake', [(self.flour, '100'), (self.egg, '2')])
+        orphan = IngredientModel.objects.create(name='saffron', description='')
+        with CaptureQueriesContext(connection) as queries:
+            body = self.client.get(reverse('ingredient-stats') + '?limit=2').json()
+        self.assertEqual([usage['name'] for usage in body['top']], ['flour', 'salt'])
+        self.assertEqual(body['orphans'], [{'id': orphan.id, 'name': 'saffron'}])
+        self.assertFalse([query for query in queries if 'GROUP BY' in query['sql']])
+        by_quantity = self.client.get(reverse('ingredient-stats') + '?order=quantity&limit=1').json()
+        self.assertEqual(by_quantity['top'][0], {'id': self.flour.id, 'name': 'flour', 'recipes': 2,
+                                                 'total_quantity': '600.00'})
+        self.assertEqual(self.client.get(reverse('ingredient-stats') + '?order=name').status_code, 400)
+        self.assertEqual(self.client.get(reverse('ingredient-usage', args=[999999])).status_code, 404)
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        self.create('bread', [(self.salt, '0.10'), (self.flour, '500')])
+        RecipeIngredientModel.objects.filter(ingredient=self.salt).update(quantity=Decimal('0.20'))
+        IngredientUsageModel.objects.create(ingredient=self.egg, recipe_count=4, total_quantity=Decimal('1'))
+        with self.assertRaisesMessage(CommandError, "2 mismatches"):
+            call_command('reconcile_ingredient_usage', stdout=StringIO())
+        out = StringIO()
+        call_command('reconcile_ingredient_usage', fix=True, stdout=out)
+        self.assertIn(f"ingredient {self.salt.id}: stored 1 recipes, 0.10, lines say 1 recipes, 0.20", out.getvalue())
+        self.assertInStep()
+        self.assertEqual(self.usage(self.egg)['recipes'], 0)
+
+
+# run_workers refreshes connections between jobs, which would end the test transaction
+@mock.patch('recipes.management.commands.run_workers.close_old_connections')
+class JobTests(RecipesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = staff_session()
+
+    def submit(self, kind, payload):
+        return self.client.post(reverse('submit-job'), {'kind': kind, 'payload': payload},
+                                content_type='application/json')
+
+    def run_workers(self):
+        call_command('run_workers', concurrency=1, once=True, stdout=StringIO())
+
+    def test_import_job_runs_out_of_band(self, close_old_connections):
+        records = [{'name': f"stew {number}", 'elaboration': 'simmer',
+                    'ingredients': [{'name': 'salt', 'quantity': '0.5'}]} for number in range(5)]
+        response = self.submit('import_catalog', {'records': records, 'batch_size': 2})
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['id']
+        self.assertEqual(self.client.get(reverse('job-result', args=[job_id])).status_code, 202)
+        self.assertFalse(RecipeModel.objects.exists())
+
+        self.run_workers()
+        status = self.client.get(reverse('job-status', args=[job_id])).json()
+        self.assertEqual((status['status'], status['progress'], status['total']), ('succeeded', 3, 3))
+        self.assertEqual(self.client.get(reverse('job-result', args=[job_id])).json()['result'],
+                         {'imported': 5, 'skipped_batches': 0})
+        self.assertEqual(RecipeModel.objects.count(), 5)
+        self.assertEqual(self.client.get(reverse('get-recipe-by-name', args=['stew 3'])).status_code, 200)
+
+    def test_only_staff_can_submit(self, close_old_connections):
+        anonymous = Client().post(reverse('submit-job'), {'kind': 'rebuild_read_model', 'payload': {}},
+                                  content_type='application/json')
+        self.assertEqual(anonymous.status_code, 403)
+        self.assertFalse(JobModel.objects.exists())
+
+    def test_only_staff_can_read_jobs(self, close_old_connections):
+        job_id = self.submit('rebuild_read_model', {}).json()['id']
+        for name in ('job-status', 'job-result'):
+            with self.subTest(name=name):
+                self.assertEqual(Client().get(reverse(name, args=[job_id])).status_code, 403)
+                # Nor can anyone learn which ids exist
+                self.assertEqual(Client().get(reverse(name, args=[999999])).status_code, 403)
+                self.assertEqual(self.client.get(reverse(name, args=[job_id])).status_code,
+                                 200 if name == 'job-status' else 202)
+
+    def test_reconcile_job_only_reports_by_default(self, close_old_connections):
+        make_catalog(recipes=2, lines_per_recipe=2)
+        IngredientUsageModel.objects.all().delete()
+        job_id = self.submit('reconcile_ingredient_usage', {}).json()['id']
+        self.run_workers()
+        self.assertEqual(JobModel.objects.get(id=job_id).result, {'used_ingredients': 2, 'mismatches': 2})
+        self.assertFalse(IngredientUsageModel.objects.exists())
+
+    def test_failed_job_reports_its_error(self, close_old_connections):
+        job_id = self.submit('bulk_create_ingredients', {'items': [{'description': 'no name'}]}).json()['id']
+        with self.assertLogs('recipes.jobs', 'ERROR') as logs:
+            self.run_workers()
+        self.assertIn("Traceback", logs.output[0])
+        response = self.client.get(reverse('job-result', args=[job_id]))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error'], "KeyError: 'name'")
+        records = [{'name': 'soup', 'ingredients': []}, {'name': 'stew', 'ingredients': [{'quantity': 1}]}]
+        job_id = self.submit('import_catalog', {'records': records, 'batch_size': 1}).json()['id']
+        with self.assertLogs('recipes.jobs', 'ERROR'):
+            self.run_workers()
+        self.assertEqual(self.client.get(reverse('job-result', args=[job_id])).json()['error'],
+                         "ValueError: Record 1: ingredient 0 name is missing")
+        self.assertFalse(RecipeModel.objects.exists())
+        self.assertEqual(self.submit('drop_tables', {}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('job-status', args=[999999])).status_code, 404)
+
+    def test_claims_are_exclusive_and_stale_jobs_come_back(self, close_old_connections):
+        job_model = jobs.submit('rebuild_read_model', {})
+        self.assertEqual(jobs.claim('a'), job_model.id)
+        self.assertIsNone(jobs.claim('b'))
+        self.assertEqual(jobs.requeue_stale(), 0)
+        JobModel.objects.filter(id=job_model.id).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(jobs.claim('b'), job_model.id)
+        JobModel.objects.filter(id=job_model.id).update(heartbeat_at=timezone.now() - timedelta(hours=1),
+                                                        attempts=jobs.MAX_ATTEMPTS)
+        jobs.requeue_stale()
+        self.assertEqual(JobModel.objects.get(id=job_model.id).status, JobModel.FAILED)
+
+    def test_release_leaves_finished_jobs_alone(self, close_old_connections):
+        # As when the pool breaks: the ids in flight include jobs that finished meanwhile
+        done, lost = jobs.submit('rebuild_read_model', {}).id, jobs.submit('rebuild_read_model', {}).id
+        jobs.claim('a')
+        jobs.claim('a')
+        JobModel.objects.update(attempts=jobs.MAX_ATTEMPTS)
+        self.assertTrue(jobs.finish(done, 'a', result={}))
+        self.assertEqual(jobs.release(JobModel.objects.filter(id__in=[done, lost]), "The worker process died."), 1)
+        self.assertEqual(JobModel.objects.get(id=done).status, JobModel.SUCCEEDED)
+        self.assertEqual(JobModel.objects.get(id=lost).status, JobModel.FAILED)
+
+    def test_a_stale_claimant_cannot_overwrite_the_new_run(self, close_old_connections):
+        job_id = jobs.submit('rebuild_read_model', {}).id
+        jobs.claim('a')
+        JobModel.objects.filter(id=job_id).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        jobs.requeue_stale()
+        jobs.claim('b')
+        jobs.Job(job_id, 'a').progress(1, 1)
+        jobs.heartbeat([job_id], 'a')
+        self.assertFalse(jobs.finish(job_id, 'a', result={}))
+        job_model = JobModel.objects.get(id=job_id)
+        self.assertEqual((job_model.status, job_model.worker, job_model.progress), (JobModel.RUNNING, 'b', 0))
+        self.assertTrue(jobs.finish(job_id, 'b', result={}))
+
+    def test_inline_jobs_heartbeat_without_progress(self, close_old_connections):
+        with mock.patch('recipes.jobs.heartbeat') as heartbeat:
+            with jobs.heartbeating([7], 'a', interval=0.01):
+                time.sleep(0.1)
+        heartbeat.assert_called_with([7], 'a')
@@ -5,6 +5,10 @@ from . import views
 urlpatterns = [
     path('ingredients/delete/<int:ingredient_id>/', views.delete_ingredient_view, name='delete-ingredient'),  # New URL for deleting an ingredient
     path('ingredients/update/<int:ingredient_id>/', views.update_ingredient_view, name='update-ingredient'),  # New URL for updating an ingredient
+    path('ingredients/bulk/', views.bulk_create_ingredients_view, name='bulk-create-ingredients'),
+    path('ingredients/stats/', views.ingredient_stats_view, name='ingredient-stats'),
+    path('ingredients/<int:ingredient_id>/usage/', views.ingredient_usage_view, name='ingredient-usage'),
+    path('ingredients/batch/', views.get_ingredients_batch_view, name='get-ingredients-batch'),
     path('ingredients/all/', views.get_all_ingredients_view, name='get-all-ingredients'),  # New URL for all ingredients
     path('ingredients/<int:ingredient_id>/', views.get_ingredient_by_id_view, name='get-ingredient-by-id'),  # New URL
     path('ingredients/<str:name>/', views.get_ingredient_view, name='get-ingredient'),
@@ -12,8 +16,17 @@ urlpatterns = [
  # URLs for recipes
     path('recipes/update/<int:recipe_id>/', views.update_recipe_view, name='update-recipe'),
     path('recipes/delete/<int:recipe_id>/', views.delete_recipe_view, name='delete-recipe'),
+    path('recipes/search/', views.search_recipes_view, name='search-recipes'),
+    path('recipes/pantry/', views.pantry_match_view, name='pantry-match'),
+    path('recipes/shopping-list/', views.shopping_list_view, name='shopping-list'),
+    path('recipes/batch/', views.get_recipes_batch_view, name='get-recipes-batch'),
     path('recipes/all/', views.get_all_recipes_view, name='get-all-recipes'),
     path('recipes/<int:recipe_id>/', views.get_recipe_by_id_view, name='get-recipe-by-id'),
     path('recipes/<str:name>/', views.get_recipe_by_name_view, name='get-recipe-by-name'),
     path('recipes/', views.create_recipe_view, name='create-recipe'),
+    path('jobs/', views.submit_job_view, name='submit-job'),
+    path('jobs/<int:job_id>/', views.job_status_view, name='job-status'),
+    path('jobs/<int:job_id>/result/', views.job_result_view, name='job-result'),
+    path('cache/stats/', views.cache_stats_view, name='cache-stats'),
+    path('db/stats/', views.db_stats_view, name='db-stats'),
 ]
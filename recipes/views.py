@@ -1,15 +1,142 @@
+import base64
+import binascii
 import json
-from django.http import JsonResponse,HttpResponseBadRequest, HttpResponseNotFound, HttpResponseServerError
-from recipes.core.usecases import create_recipe, create_ingredient, ReadIngredientUseCase, UpdateIngredientUseCase, DeleteIngredientUseCase, ReadRecipeUseCase, UpdateRecipeUseCase,DeleteRecipeUseCase
-from recipes.storage.models import RecipeModel, IngredientModel, RecipeIngredientModel
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError
+from django.http import HttpResponse, JsonResponse,HttpResponseBadRequest, HttpResponseNotFound, HttpResponseServerError, StreamingHttpResponse
+from recipes.core.usecases import create_recipe, create_ingredient, ReadIngredientUseCase, UpdateIngredientUseCase, DeleteIngredientUseCase, BulkCreateIngredientUseCase, ReadRecipeUseCase, CreateRecipeUseCase, SearchRecipeUseCase, PantryMatchUseCase, ShoppingListUseCase, IngredientUsageUseCase, UpdateRecipeUseCase,DeleteRecipeUseCase, invalidate_ingredients, INGREDIENT_ROW, RECIPE_ROW
+from recipes.storage.models import IngredientModel, JobModel
+from recipes import jobs
+from recipes.metrics import registry
+from recipes.middleware import replica_ok
+from recipes.response_cache import cached_listing
+from recipes.serializers import (ingredient_serializer, ingredient_to_dict, line_to_dict, page_json,
+                                 recipe_serializer, recipe_to_dict, usage_to_dict)
+from recipes.storage.connection_stats import connection_stats
+from recipes.storage.entity_cache import ingredient_cache, recipe_cache
+from recipes.storage.router import aread_alias
 from django.views.decorators.csrf import csrf_exempt
 
 read_ingredient_use_case = ReadIngredientUseCase()
 update_ingredient_use_case = UpdateIngredientUseCase()
 delete_ingredient_use_case = DeleteIngredientUseCase()
+bulk_create_ingredient_use_case = BulkCreateIngredientUseCase()
 read_recipe_use_case = ReadRecipeUseCase()
+create_recipe_use_case = CreateRecipeUseCase()
 update_recipe_use_case = UpdateRecipeUseCase()
 delete_recipe_use_case = DeleteRecipeUseCase()
+search_recipe_use_case = SearchRecipeUseCase()
+pantry_match_use_case = PantryMatchUseCase()
+shopping_list_use_case = ShoppingListUseCase()
+ingredient_usage_use_case = IngredientUsageUseCase()
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+def encode_cursor(value, kind="id"):
+    return base64.urlsafe_b64encode(f"{kind}:{value}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor, kind="id"):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, value = raw.split(":", 1)
+        if prefix != kind:
+            raise ValueError
+        return int(value)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+
+def get_limit(request):
+    # ?limit=<n> capped at MAX_PAGE_SIZE
+    limit = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError("Invalid limit")
+    return min(limit, MAX_PAGE_SIZE)
+
+def get_page_params(request):
+    # ?after=<id> or the opaque ?cursor= from a previous page
+    after = None
+    if request.GET.get('cursor'):
+        after = decode_cursor(request.GET['cursor'])
+    elif request.GET.get('after'):
+        after = int(request.GET['after'])
+    return after, get_limit(request)
+
+def get_fields(request, row_fields):
+    # ?fields=name,description: the requested fields in row order. id is
+    # always included, since cursors and clients key on it.
+    if not request.GET.get('fields'):
+        return row_fields
+    wanted = set(request.GET['fields'].split(','))
+    if not wanted <= set(row_fields):
+        raise ValueError("Unknown field")
+    return tuple(field for field in row_fields if field == 'id' or field in wanted)
+
+def get_ids(request):
+    # ?ids=3,1,2: distinct ids in request order, at most MAX_PAGE_SIZE of them
+    ids = list(dict.fromkeys(int(value) for value in request.GET.get('ids', '').split(',') if value))
+    if not ids or len(ids) > MAX_PAGE_SIZE:
+        raise ValueError("Invalid ids")
+    return ids
+
+def batch_response(ids, entities, to_dict, fields):
+    return JsonResponse({
+        'results': [project(to_dict(entity), fields) for entity in entities if entity],
+        'missing': [entity_id for entity_id, entity in zip(ids, entities) if not entity],
+    })
+
+def project(data, fields):
+    return {field: data[field] for field in fields}
+
+def wants_stream(request):
+    return (request.GET.get('stream') in ('1', 'true', 'ndjson')
+            or NDJSON_CONTENT_TYPE in request.headers.get('Accept', ''))
+
+def streaming_response(request, rows, to_json):
+    # Encode row by row as the ORM iterator yields them, so nothing is
+    # buffered and the first bytes go out as soon as the first chunk is read.
+    # rows is a sync iterator under WSGI and an async one under ASGI.
+    ndjson = NDJSON_CONTENT_TYPE in request.headers.get('Accept', '') or request.GET.get('stream') == 'ndjson'
+
+    def encode(row, first):
+        if ndjson:
+            return to_json(row) + "\n"
+        return ("[" if first else ",") + to_json(row)
+
+    def closing(first):
+        if ndjson:
+            return ""
+        return "[]" if first else "]"
+
+    if hasattr(rows, '__aiter__'):
+        async def chunks():
+            first = True
+            async for row in rows:
+                yield encode(row, first)
+                first = False
+            yield closing(first)
+    else:
+        def chunks():
+            first = True
+            for row in rows:
+                yield encode(row, first)
+                first = False
+            yield closing(first)
+    return StreamingHttpResponse(chunks(), content_type=NDJSON_CONTENT_TYPE if ndjson else 'application/json')
+
+def is_asgi(request):
+    return isinstance(request, ASGIRequest)
+
+def paginated_response(rows, limit, serializer):
+    # The use case is asked for one extra row to tell whether another page exists.
+    # Rows start with their id.
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0])
+    return HttpResponse(page_json(rows, serializer, next_cursor), content_type='application/json')
 
 @csrf_exempt
 def create_ingredient_view(request):
@@ -26,22 +153,75 @@ def create_ingredient_view(request):
             name=name,
             description=description,
         )
-        ingredient_model.save()
+        try:
+            ingredient_model.save()
+        except IntegrityError:
+            return JsonResponse({'error': 'An ingredient with the same name already exists'}, status=409)
+        invalidate_ingredients(ids=[ingredient_model.id], names=[ingredient_model.name])
         # Return a JSON response
         return JsonResponse({
+            'id': ingredient_model.id,
             'name': ingredient_model.name,
             'description': ingredient_model.description,
         }, status=201)  # HTTP status 201 indicates creation
 
+def parse_json_items(request):
+    # A JSON array, or NDJSON with one object per line
+    body = request.body.decode()
+    if NDJSON_CONTENT_TYPE in request.content_type or not body.lstrip().startswith('['):
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    return json.loads(body)
+
 @csrf_exempt
-def get_ingredient_view(request, name):
+def bulk_create_ingredients_view(request):
+    if request.method == 'POST':
+        try:
+            items = parse_json_items(request)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return JsonResponse({'error': 'Invalid JSON data'}, status=400)
+
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not isinstance(item.get('name'), str) or not item['name']:
+                return JsonResponse({'error': f'Item {index} needs a name'}, status=400)
+            if not isinstance(item.get('description', ''), str):
+                return JsonResponse({'error': f'Item {index} has an invalid description'}, status=400)
+
+        upsert = request.GET.get('upsert') in ('1', 'true')
+        try:
+            results = bulk_create_ingredient_use_case.create(items, upsert=upsert)
+        except IntegrityError:
+            return JsonResponse({'error': 'An ingredient with the same name already exists'}, status=409)
+
+        return JsonResponse({
+            'results': [
+                dict(ingredient_to_dict(ingredient), status='created' if created else 'updated')
+                for ingredient, created in results
+            ],
+        }, status=201)
+    return HttpResponseBadRequest("Invalid request method.")
+
+# Read-only views are async: under ASGI they wait on the database without
+# holding a thread. GET needs no CSRF exemption, and the Django 4.2
+# csrf_exempt decorator would hide that these views are coroutines.
+
+# Single-entity reads are served whole from the entity cache and only
+# projected on ?fields=; the listings push ?fields= down into the query.
+
+async def get_ingredient_view(request, name):
     if request.method == 'GET':
+        try:
+            fields = get_fields(request, INGREDIENT_ROW)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid fields")
+
         # Use the read use case to retrieve an ingredient by name
-        ingredient_entity = read_ingredient_use_case.get_by_name(name)
+        ingredient_entity = await read_ingredient_use_case.aget_by_name(name)
 
         if not ingredient_entity:
             return JsonResponse({'error': 'Ingredient not found'}, status=404)
 
+        if request.GET.get('fields'):
+            return JsonResponse(project(ingredient_to_dict(ingredient_entity), fields))
         # Return a JSON response
         return JsonResponse({
             'name': ingredient_entity.name,
@@ -49,45 +229,90 @@ def get_ingredient_view(request, name):
         })
     return HttpResponseBadRequest("Invalid request method.")
 
-@csrf_exempt
-def get_ingredient_by_id_view(request, ingredient_id):
+async def get_ingredient_by_id_view(request, ingredient_id):
     if request.method == 'GET':
         try:
-            print("ingredient id",ingredient_id)
+            fields = get_fields(request, INGREDIENT_ROW)
             # Use the read use case to retrieve an ingredient by ID
-            ingredient_entity = read_ingredient_use_case.get_by_id(ingredient_id)
+            ingredient_entity = await read_ingredient_use_case.aget_by_id(ingredient_id)
 
             if not ingredient_entity:
                 return HttpResponseNotFound("Ingredient not found in database")
 
             # Return a JSON response
-            return JsonResponse({
-                'id': ingredient_id,
-                'name': ingredient_entity.name,
-                'description': ingredient_entity.description,
-            })
+            return JsonResponse(project(ingredient_to_dict(ingredient_entity), fields))
         except ValueError:
-            return HttpResponseBadRequest("Invalid ingredient ID")
+            return HttpResponseBadRequest("Invalid ingredient ID or fields")
     return HttpResponseBadRequest("Invalid request method.")
 
-@csrf_exempt
-def get_all_ingredients_view(request):
+# The most used ingredients, ?order=recipes (default) or ?order=quantity, and
+# the orphans no recipe uses. ?limit applies to both; the cursor pages the orphans.
+async def ingredient_stats_view(request):
+    if request.method == 'GET':
+        order = request.GET.get('order', 'recipes')
+        if order not in IngredientUsageUseCase.ORDERS:
+            return HttpResponseBadRequest(f"order is one of {', '.join(IngredientUsageUseCase.ORDERS)}")
+        try:
+            after, limit = get_page_params(request)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid pagination parameters")
+        top = await ingredient_usage_use_case.atop(order, limit)
+        orphans = await ingredient_usage_use_case.aorphans(after, limit + 1)
+        return JsonResponse({
+            'top': [usage_to_dict(usage) for usage in top],
+            'orphans': [{'id': ingredient.id, 'name': ingredient.name} for ingredient in orphans[:limit]],
+            'next': encode_cursor(orphans[limit - 1].id) if len(orphans) > limit else None,
+        })
+    return HttpResponseBadRequest("Invalid request method.")
+
+async def ingredient_usage_view(request, ingredient_id):
+    if request.method == 'GET':
+        usage = await ingredient_usage_use_case.ausage(ingredient_id)
+        if not usage:
+            return HttpResponseNotFound("Ingredient not found in database")
+        return JsonResponse(usage_to_dict(usage))
+    return HttpResponseBadRequest("Invalid request method.")
+
+# Many ingredients by id in one request: ?ids=1,2,3
+async def get_ingredients_batch_view(request):
     if request.method == 'GET':
-        # Use the read use case to retrieve all ingredients
-        ingredient_entities = read_ingredient_use_case.get_all()
-
-        # Create a list of dictionaries from the ingredient entities
-        ingredients_data = [
-            {
-                'id': ingredient.id,
-                'name': ingredient.name,
-                'description': ingredient.description,
-            }
-            for ingredient in ingredient_entities
-        ]
-
-        # Return a JSON response with all ingredients
-        return JsonResponse(ingredients_data, safe=False)
+        try:
+            ids = get_ids(request)
+            fields = get_fields(request, INGREDIENT_ROW)
+        except ValueError:
+            return HttpResponseBadRequest(f"Pass up to {MAX_PAGE_SIZE} ids as ?ids=, and known fields")
+        ingredients = await read_ingredient_use_case.aget_many(ids)
+        return batch_response(ids, ingredients, ingredient_to_dict, fields)
+    return HttpResponseBadRequest("Invalid request method.")
+
+@cached_listing(ingredient_cache, bypass=wants_stream)
+async def get_all_ingredients_view(request):
+    if request.method == 'GET':
+        try:
+            fields = get_fields(request, INGREDIENT_ROW)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid fields")
+        serializer = ingredient_serializer(fields)
+
+        if wants_stream(request):
+            # Stream the full catalog straight from a chunked ORM iterator. The
+            # database is picked now: the body is read after the request's pin
+            # is gone, and outside the event loop under WSGI.
+            using = await aread_alias()
+            rows = (read_ingredient_use_case.aiter_rows(fields=fields, using=using) if is_asgi(request)
+                    else read_ingredient_use_case.iter_rows(fields=fields, using=using))
+            return streaming_response(request, rows, serializer.row)
+
+        try:
+            after, limit = get_page_params(request)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid pagination parameters")
+
+        # Use the read use case to retrieve one page of ingredients
+        rows = await read_ingredient_use_case.aget_all_rows(after=after, limit=limit + 1, fields=fields)
+
+        # Return a JSON response with the page and the cursor of the next one
+        return paginated_response(rows, limit, serializer)
     return HttpResponseBadRequest("Invalid request method.")
 
 @csrf_exempt
@@ -148,42 +373,28 @@ def create_recipe_view(request):
             name = json_data['name']
             ingredients = json_data['ingredients']
             elaboration = json_data['elaboration']
-        except json.JSONDecodeError as e:
+        except (json.JSONDecodeError, KeyError, TypeError):
             return JsonResponse({'error': 'Invalid JSON data'}, status=400)
 
-        recipe_model = RecipeModel(
-            name=name,
-            elaboration=elaboration
-        )
-        recipe_model.save()
-        for ingredient_data in ingredients:
-            ingredient_model = IngredientModel(name=ingredient_data["name"],description="",id=ingredient_data["ingredient_id"])
-            #ingredient_model.save()
-            # Create and save the RecipeIngredientModel linking the recipe and ingredient
-            recipe_ingredient_model = RecipeIngredientModel(recipe=recipe_model,
-                                                            ingredient=ingredient_model,
-                                                            quantity=ingredient_data["quantity"],
-                                                            id=ingredient_model.id)
-            recipe_ingredient_model.save()
+        try:
+            recipe = create_recipe_use_case.create(name, ingredients, elaboration)
+        except IntegrityError:
+            return JsonResponse({'error': 'A recipe with the same name already exists'}, status=409)
+        except (KeyError, TypeError, ValueError, ArithmeticError) as e:
+            return JsonResponse({'error': f'Invalid ingredients: {e}'}, status=400)
         # Return a JSON response
-        return JsonResponse({
-            'name': name,
-            'ingredients': ingredients,
-            'elaboration': elaboration,
-        }, status=201)  # HTTP status 201 indicates creation
+        return JsonResponse(recipe_to_dict(recipe), status=201)  # HTTP status 201 indicates creation
 
-@csrf_exempt
-def get_recipe_by_id_view(request, recipe_id):
+async def get_recipe_by_id_view(request, recipe_id):
     if request.method == 'GET':
         try:
-            recipe = read_recipe_use_case.get_by_id(recipe_id)
+            fields = get_fields(request, RECIPE_ROW)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid fields")
+        try:
+            recipe = await read_recipe_use_case.aget_by_id(recipe_id)
             if recipe:
-                return JsonResponse({
-                    'id':recipe.id,
-                    'name': recipe.name,
-                    'ingredients': recipe.ingredients,
-                    'elaboration': recipe.elaboration,
-                })
+                return JsonResponse(project(recipe_to_dict(recipe), fields))
             else:
                 return HttpResponseNotFound("Recipe not found")
         except Exception as e:
@@ -191,18 +402,16 @@ def get_recipe_by_id_view(request, recipe_id):
     return HttpResponseBadRequest("Invalid request method.")
 
 # Get a recipe by name
-@csrf_exempt
-def get_recipe_by_name_view(request, name):
+async def get_recipe_by_name_view(request, name):
     if request.method == 'GET':
         try:
-            recipe = read_recipe_use_case.get_by_name(name)
+            fields = get_fields(request, RECIPE_ROW)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid fields")
+        try:
+            recipe = await read_recipe_use_case.aget_by_name(name)
             if recipe:
-                return JsonResponse({
-                    'id':recipe.id,
-                    'name': recipe.name,
-                    'ingredients': recipe.ingredients,
-                    'elaboration': recipe.elaboration,
-                })
+                return JsonResponse(project(recipe_to_dict(recipe), fields))
             else:
                 return HttpResponseNotFound("Recipe not found")
         except Exception as e:
@@ -228,11 +437,13 @@ def update_recipe_view(request, recipe_id):
 
             updated_recipe = update_recipe_use_case.update(recipe, recipe_id, new_name, new_ingredients, new_elaboration)
 
-            return JsonResponse({
-                'name': updated_recipe.name,
-                'ingredients': updated_recipe.ingredients,
-                'elaboration': updated_recipe.elaboration,
-            })
+            return JsonResponse(recipe_to_dict(updated_recipe))
+        except IntegrityError:
+            return JsonResponse({'error': 'A recipe with the same name already exists'}, status=409)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        except (ArithmeticError, KeyError, TypeError) as e:
+            return JsonResponse({'error': f'Invalid ingredients: {e}'}, status=400)
         except Exception as e:
             return HttpResponseServerError(str(e))
     return HttpResponseBadRequest("Invalid request method.")
@@ -248,22 +459,200 @@ def delete_recipe_view(request, recipe_id):
             return HttpResponseServerError(str(e))
     return HttpResponseBadRequest("Invalid request method.")
 
+# Many recipes by id in one request: ?ids=1,2,3
+async def get_recipes_batch_view(request):
+    if request.method == 'GET':
+        try:
+            ids = get_ids(request)
+            fields = get_fields(request, RECIPE_ROW)
+        except ValueError:
+            return HttpResponseBadRequest(f"Pass up to {MAX_PAGE_SIZE} ids as ?ids=, and known fields")
+        recipes = await read_recipe_use_case.aget_many(ids)
+        return batch_response(ids, recipes, recipe_to_dict, fields)
+    return HttpResponseBadRequest("Invalid request method.")
+
 # Get all recipes
-@csrf_exempt
-def get_all_recipes_view(request):
+# Ingredient renames and deletes bump the recipe generation too
+@cached_listing(recipe_cache, bypass=wants_stream)
+async def get_all_recipes_view(request):
     if request.method == 'GET':
         try:
-            recipes = read_recipe_use_case.get_all()
-            recipe_data = [
-                {
-                    'name': recipe.name,
-                    'ingredients': recipe.ingredients,
-                    'elaboration': recipe.elaboration,
-                    'id': recipe.id
-                }
-                for recipe in recipes
-            ]
-            return JsonResponse(recipe_data, safe=False)
+            fields = get_fields(request, RECIPE_ROW)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid fields")
+        serializer = recipe_serializer(fields)
+        if wants_stream(request):
+            using = await aread_alias()
+            rows = (read_recipe_use_case.aiter_rows(fields=fields, using=using) if is_asgi(request)
+                    else read_recipe_use_case.iter_rows(fields=fields, using=using))
+            return streaming_response(request, rows, serializer.row)
+        try:
+            after, limit = get_page_params(request)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid pagination parameters")
+        try:
+            rows = await read_recipe_use_case.aget_all_rows(after=after, limit=limit + 1, fields=fields)
+            return paginated_response(rows, limit, serializer)
         except Exception as e:
             return HttpResponseServerError(str(e))
     return HttpResponseBadRequest("Invalid request method.")
+
+# Full-text search over recipe names and elaborations
+async def search_recipes_view(request):
+    if request.method == 'GET':
+        query = request.GET.get('q', '')
+        if not query.strip():
+            return HttpResponseBadRequest("Missing search query")
+        try:
+            # Ranked results page by position; the cursor carries the offset
+            offset = decode_cursor(request.GET['cursor'], kind="offset") if request.GET.get('cursor') else 0
+            if offset < 0:
+                raise ValueError("Invalid cursor")
+            limit = get_limit(request)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid pagination parameters")
+
+        # Raw SQL has no async API in Django 4.2, so it runs in the thread pool
+        results = await sync_to_async(search_recipe_use_case.search)(query, limit + 1, offset)
+        next_cursor = encode_cursor(offset + limit, kind="offset") if len(results) > limit else None
+        return JsonResponse({
+            'results': [
+                {'id': result.id, 'name': result.name, 'rank': result.rank}
+                for result in results[:limit]
+            ],
+            'next': next_cursor,
+        })
+    return HttpResponseBadRequest("Invalid request method.")
+
+# Recipes that can be cooked with the ingredients on hand
+async def pantry_match_view(request):
+    if request.method == 'GET':
+        # ?ids=1,2,3 and/or ?names=salt,flour
+        try:
+            ids = [int(ingredient_id) for ingredient_id in request.GET.get('ids', '').split(',') if ingredient_id]
+            limit = get_limit(request)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid ingredient ids or limit")
+        names = [name for name in request.GET.get('names', '').split(',') if name]
+        if not ids and not names:
+            return HttpResponseBadRequest("Pass the pantry as ?ids= or ?names=")
+
+        matches = await sync_to_async(pantry_match_use_case.match)(
+            ingredient_ids=ids, ingredient_names=names, limit=limit)
+        return JsonResponse({
+            'results': [
+                {
+                    'id': match.id,
+                    'name': match.name,
+                    'cookable': not match.missing,
+                    'missing': match.missing,
+                }
+                for match in matches
+            ],
+        })
+    return HttpResponseBadRequest("Invalid request method.")
+
+# The ingredients of a meal plan, summed over its recipes and servings:
+# {"recipes": [{"id": 1, "servings": 2}, ...]}. It only reads, but the plan
+# can list hundreds of recipes, too many for a query string. The flag is set
+# by hand: csrf_exempt would hide the coroutine, see above.
+@replica_ok
+async def shopping_list_view(request):
+    if request.method == 'POST':
+        try:
+            plan = [(entry['id'], entry.get('servings', 1)) for entry in json.loads(request.body)['recipes']]
+        except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError, AttributeError):
+            return JsonResponse({'error': 'Pass the plan as {"recipes": [{"id", "servings"}]}'}, status=400)
+        if not plan or len(plan) > MAX_PAGE_SIZE:
+            return JsonResponse({'error': f'Pass 1 to {MAX_PAGE_SIZE} recipes'}, status=400)
+        try:
+            items = await shopping_list_use_case.abuild(plan)
+        except (TypeError, ValueError, ArithmeticError) as e:
+            return JsonResponse({'error': f'Invalid plan: {e}'}, status=400)
+        return JsonResponse({'results': [line_to_dict(item) for item in items]})
+    return HttpResponseBadRequest("Invalid request method.")
+
+shopping_list_view.csrf_exempt = True
+
+def job_to_dict(job_model):
+    return {
+        'id': job_model.id,
+        'kind': job_model.kind,
+        'status': job_model.status,
+        'progress': job_model.progress,
+        'total': job_model.total,
+        'attempts': job_model.attempts,
+        'error': job_model.error or None,
+        'created_at': job_model.created_at,
+        'started_at': job_model.started_at,
+        'finished_at': job_model.finished_at,
+    }
+
+# Queue a background job for `manage.py run_workers`: {"kind", "payload"}.
+# The response is the job to poll at jobs/<id>/. Jobs rewrite the catalog
+# and hold a worker for minutes, so only staff sessions may queue them, with
+# Django's CSRF check.
+def submit_job_view(request):
+    if request.method == 'POST':
+        if not request.user.is_staff:
+            return JsonResponse({'error': 'Only staff users can queue jobs'}, status=403)
+        try:
+            json_data = json.loads(request.body)
+            job_model = jobs.submit(json_data['kind'], json_data.get('payload', {}))
+        except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError):
+            return JsonResponse({'error': 'Pass {"kind", "payload"}'}, status=400)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse(job_to_dict(job_model), status=202)
+    return HttpResponseBadRequest("Invalid request method.")
+
+async def ais_staff(request):
+    # request.user is loaded by a query on first use, which cannot run in the event loop
+    return await sync_to_async(lambda: request.user.is_staff)()
+
+# Job payloads, results and errors are for staff only, like queuing them
+async def job_status_view(request, job_id):
+    if request.method == 'GET':
+        if not await ais_staff(request):
+            return JsonResponse({'error': 'Only staff users can read jobs'}, status=403)
+        job_model = await JobModel.objects.filter(id=job_id).afirst()
+        if not job_model:
+            return HttpResponseNotFound("Job not found")
+        return JsonResponse(job_to_dict(job_model))
+    return HttpResponseBadRequest("Invalid request method.")
+
+# 202 while the job is queued or running, 409 with its error if it failed
+async def job_result_view(request, job_id):
+    if request.method == 'GET':
+        if not await ais_staff(request):
+            return JsonResponse({'error': 'Only staff users can read jobs'}, status=403)
+        job_model = await JobModel.objects.filter(id=job_id).afirst()
+        if not job_model:
+            return HttpResponseNotFound("Job not found")
+        if job_model.status == JobModel.FAILED:
+            return JsonResponse({'status': job_model.status, 'error': job_model.error}, status=409)
+        if job_model.status != JobModel.SUCCEEDED:
+            return JsonResponse({'status': job_model.status}, status=202)
+        return JsonResponse({'status': job_model.status, 'result': job_model.result})
+    return HttpResponseBadRequest("Invalid request method.")
+
+# Hit/miss/eviction counters of the entity caches of this worker
+async def cache_stats_view(request):
+    if request.method == 'GET':
+        return JsonResponse({
+            'ingredient': ingredient_cache.stats(),
+            'recipe': recipe_cache.stats(),
+        })
+    return HttpResponseBadRequest("Invalid request method.")
+
+async def db_stats_view(request):
+    # Connections of the worker that serves the request
+    if request.method == 'GET':
+        return JsonResponse(connection_stats())
+    return HttpResponseBadRequest("Invalid request method.")
+
+def metrics_view(request):
+    # Prometheus text format, every worker process included (see METRICS_DIR)
+    if request.method == 'GET':
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    return HttpResponseBadRequest("Invalid request method.")